@@ -1,10 +1,14 @@
-import spidev
+import struct
+import threading
+import numpy as np
 
-from time import sleep
-from enum import IntEnum
+from time import sleep, monotonic, perf_counter
+from enum import IntEnum, IntFlag
+from contextlib import contextmanager
 from dataclasses import dataclass
 
 from defs import *
+from spi import SpidevTransport, check_read
 
 
 # Operating modes
@@ -24,6 +28,15 @@ class ODR(IntEnum):
     ODR_6400Hz = 4
 
 
+ODR_HZ = {
+    ODR.ODR_400Hz: 400,
+    ODR.ODR_800Hz: 800,
+    ODR.ODR_1600Hz: 1600,
+    ODR.ODR_3200Hz: 3200,
+    ODR.ODR_6400Hz: 6400,
+}
+
+
 # Filter Bandwidth (should be no more than half ODR)
 class BW(IntEnum):
     BW_200Hz = 0
@@ -64,6 +77,19 @@ class FIFOFormat(IntEnum):
     XYZ_PEAK_FIFO = 7
 
 
+# Axes held by each FIFO format, in the order they come out of FIFO_DATA
+FIFO_FORMAT_AXES = {
+    FIFOFormat.XYZ_FIFO: ("x", "y", "z"),
+    FIFOFormat.X_FIFO: ("x",),
+    FIFOFormat.Y_FIFO: ("y",),
+    FIFOFormat.XY_FIFO: ("x", "y"),
+    FIFOFormat.Z_FIFO: ("z",),
+    FIFOFormat.XZ_FIFO: ("x", "z"),
+    FIFOFormat.YZ_FIFO: ("y", "z"),
+    FIFOFormat.XYZ_PEAK_FIFO: ("x", "y", "z"),
+}
+
+
 # FIFO operating modes
 class FIFOMode(IntEnum):
     BYPASSED = 0
@@ -72,6 +98,17 @@ class FIFOMode(IntEnum):
     OLDEST_SAVED = 3
 
 
+# Interrupt sources that can be routed to INT1/INT2
+class Interrupt(IntFlag):
+    DATA_RDY = INT_MAP_DATA_RDY
+    FIFO_RDY = INT_MAP_FIFO_RDY
+    FIFO_FULL = INT_MAP_FIFO_FULL
+    FIFO_OVR = INT_MAP_FIFO_OVR
+    INACT = INT_MAP_INACT
+    ACT = INT_MAP_ACT
+    AWAKE = INT_MAP_AWAKE
+
+
 # Instant on impact detection threshold
 class InstantOnThresh(IntEnum):
     ADXL_INSTAON_LOW_THRESH = 0  # 10-15g
@@ -84,8 +121,36 @@ class FilterSettle(IntEnum):
     FILTER_SETTLE_16 = 1  # best for when filters are disabled
 
 
+def decode_samples(
+    data, qformat: FIFOFormat = FIFOFormat.XYZ_FIFO, out: np.ndarray = None
+) -> np.ndarray:
+    """
+    Decode a buffer of packed samples into an (N, axes) int16 array, with the
+    columns ordered as in FIFO_FORMAT_AXES. Each axis is a big-endian 16-bit
+    word holding the 12-bit reading left justified, so viewing the buffer as
+    big-endian int16 and arithmetic shifting right by 4 sign extends every
+    value at once. Trailing bytes that don't make up a full sample are ignored
+
+    data: bytes, bytearray, memoryview or list of bytes as read from the device
+    qformat: The FIFO format the data was stored in, defaults to all three axes
+    out: Optional int16 array of shape (M, axes) to decode into instead of
+    allocating a new one. The filled rows are returned as a view
+    """
+    if isinstance(data, list):
+        data = bytes(data)
+
+    axes = len(FIFO_FORMAT_AXES[qformat])
+    count = len(data) // (2 * axes) * axes
+    raw = np.frombuffer(data, dtype=">i2", count=count).reshape(-1, axes)
+    if out is None:
+        return (raw >> 4).astype(np.int16)
+    return np.right_shift(raw, 4, out=out[: len(raw)])
+
+
 @dataclass
 class Sample:
+    __slots__ = ("x", "y", "z")
+
     x: int
     y: int
     z: int
@@ -101,11 +166,196 @@ class Sample:
     __rmul__ = __mul__
 
 
+# STATUS_1 through Z_DATA_L, read in one burst by snapshot()
+_SNAPSHOT = struct.Struct(">BBH3h")
+
+
+@dataclass
+class Snapshot:
+    """
+    Device state from one burst read of STATUS_1 through Z_DATA_L
+
+    status: STATUS_1
+    activity: STATUS_2
+    fifo_entries: Number of entries in the FIFO
+    sample: Latest reading from the data registers, in counts
+    new: DATA_RDY was set, so sample hasn't been read before
+    """
+
+    status: int
+    activity: int
+    fifo_entries: int
+    sample: Sample
+    new: bool
+
+
+class SampleBatch:
+    """
+    A run of samples held as one contiguous (N, axes) int16 array rather than
+    a Sample object per reading, with an optional float64 timestamp column.
+    Indexing with an int returns a Sample, slicing returns a SampleBatch of
+    views over the same memory. Scaling to g or m/s^2 is one vectorized
+    multiply. The samples can be exported without copying through
+    np.asarray(batch), memoryview(batch) on Python 3.12+, or batch.data.
+    Batches from a stream say whether they follow on from the previous one,
+    dropped counts the samples lost just before the first sample and
+    overrun is set if the device reported its FIFO overran
+
+    data: (N, axes) int16 array, anything else is converted
+    timestamps: Optional (N,) array of sample times in seconds
+    axes: Names of the columns, FIFO_FORMAT_AXES[fmt] for FIFO data
+    dropped: Samples missing between the previous batch and this one
+    overrun: True if samples were lost to a FIFO overrun before this batch
+    """
+
+    __slots__ = ("data", "timestamps", "axes", "dropped", "overrun")
+
+    def __init__(self, data, timestamps=None, axes=("x", "y", "z"), dropped=0, overrun=False):
+        data = np.asarray(data, dtype=np.int16).reshape(-1, len(axes))
+        if timestamps is not None:
+            timestamps = np.asarray(timestamps, dtype=np.float64)
+            if len(timestamps) != len(data):
+                raise ValueError("need one timestamp per sample")
+        self.data = data
+        self.timestamps = timestamps
+        self.axes = tuple(axes)
+        self.dropped = dropped
+        self.overrun = overrun
+
+    @classmethod
+    def from_bytes(cls, data, qformat: FIFOFormat = FIFOFormat.XYZ_FIFO, timestamps=None):
+        """
+        Decode packed samples, e.g. from read_fifo_raw, into a batch
+        """
+        return cls(decode_samples(data, qformat), timestamps, FIFO_FORMAT_AXES[qformat])
+
+    @classmethod
+    def from_samples(cls, samples, timestamps=None):
+        """
+        Pack a sequence of Sample objects into a batch
+        """
+        data = np.array([(s.x, s.y, s.z) for s in samples], dtype=np.int16)
+        return cls(data, timestamps)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            values = {"x": None, "y": None, "z": None}
+            for axis, val in zip(self.axes, self.data[index]):
+                values[axis] = int(val)
+            return Sample(**values)
+
+        timestamps = None if self.timestamps is None else self.timestamps[index]
+        batch = SampleBatch(self.data[index], timestamps, self.axes)
+        # a gap before the batch is only before the slice if it starts there
+        if isinstance(index, slice) and index.indices(len(self))[0] == 0:
+            batch.dropped, batch.overrun = self.dropped, self.overrun
+        return batch
+
+    def __iter__(self):
+        for i in range(len(self.data)):
+            yield self[i]
+
+    @property
+    def start(self) -> float:
+        """
+        Time of the first sample, None without timestamps or samples
+        """
+        if self.timestamps is None or not len(self.timestamps):
+            return None
+        return float(self.timestamps[0])
+
+    @property
+    def gap(self) -> bool:
+        """
+        True if this batch doesn't follow straight on from the previous one
+        """
+        return bool(self.dropped or self.overrun)
+
+    def axis(self, name: str) -> np.ndarray:
+        """
+        Returns a view of a single axis column
+        """
+        return self.data[:, self.axes.index(name)]
+
+    def scaled(self, factor: float = ADXL372_SCALEG, dtype=np.float32) -> np.ndarray:
+        """
+        Returns the samples multiplied by factor as a new float array
+
+        factor: ADXL372_SCALEG for g, ADXL372_SCALE for m/s^2
+        dtype: Float type of the result, float32 halves the memory of float64
+        """
+        return np.multiply(self.data, factor, dtype=dtype)
+
+    def to_g(self, dtype=np.float32) -> np.ndarray:
+        return self.scaled(ADXL372_SCALEG, dtype)
+
+    def to_ms2(self, dtype=np.float32) -> np.ndarray:
+        return self.scaled(ADXL372_SCALE, dtype)
+
+    # support multiplying by some scalar like Sample does
+    def __mul__(self, other: float):
+        return self.scaled(other)
+
+    __rmul__ = __mul__
+
+    @property
+    def nbytes(self) -> int:
+        if self.timestamps is None:
+            return self.data.nbytes
+        return self.data.nbytes + self.timestamps.nbytes
+
+    def __array__(self, dtype=None, copy=None):
+        # stream batches are views into the ring buffer, only hand out the
+        # samples themselves when the caller allows it
+        if dtype is None:
+            return self.data.copy() if copy else self.data
+        return self.data.astype(dtype, copy=bool(copy))
+
+    def __buffer__(self, flags):
+        return memoryview(self.data)
+
+    def __repr__(self):
+        gap = ", dropped=%d" % self.dropped if self.gap else ""
+        return "SampleBatch(%d samples, axes=%s%s)" % (len(self), "".join(self.axes), gap)
+
+
 class ADXL372:
-    def __init__(self, major, minor):
-        self.dev = spidev.SpiDev(major, minor)
-        self.dev.max_speed_hz = 10 ** 7
-        self.dev.open(major, minor)
+    def __init__(self, major=0, minor=0, transport=None):
+        """
+        Open the device on /dev/spidev<major>.<minor>, or talk to it through
+        transport instead, any spi.Transport such as sim.SimulatedADXL372
+        """
+        if transport is None:
+            transport = SpidevTransport(major, minor)
+        self.dev = transport
+        self.major = major
+        self.minor = minor
+        # preallocated buffers for the allocation free read path
+        self._reg_buf = bytearray(2)
+        self._status_buf = bytearray(4)
+        self._snapshot_buf = bytearray(_SNAPSHOT.size)
+        # when snapshot() last found a new sample
+        self._sample_seen = 0.0
+        self._fifo_buf = bytearray(FIFO_MAX_ENTRIES * 2)
+        self._fifo_view = memoryview(self._fifo_buf)
+        for buf in (self._reg_buf, self._status_buf, self._snapshot_buf, self._fifo_buf):
+            transport.register_buffer(buf)
+        # serializes bus access between the caller and a running stream
+        self.lock = threading.RLock()
+        self.stream = None
+        # interrupt sources routed to each INT pin and the host lines watching them
+        self.int_map = {1: Interrupt(0), 2: Interrupt(0)}
+        self.int_active_low = {1: False, 2: False}
+        self.int_gpio = {1: None, 2: None}
+        # last known contents of every writable register, see sync()
+        self.shadow = bytearray(SHADOW_SIZE)
+        # registers written inside a configure() block, None outside of one
+        self._staged = None
+        # counters kept while enable_metrics is on
+        self.metrics = None
 
         # Registers start out zeroed except when otherwise stated
         self.op_mode = OP_MODES.FULL_BW_MEASUREMENT
@@ -118,18 +368,48 @@ class ADXL372:
         self.instant_on_thresh = InstantOnThresh.ADXL_INSTAON_LOW_THRESH
         self.act_time_ms = 6.6
         self.inact_time_ms = 26
+        self.hpf = True
+        self.offset_trim = (0, 0, 0)
         self.fifo_samples = 0x80  # This is the default register value
         self.fifo_mode = FIFOMode.BYPASSED
         self.fifo_format = FIFOFormat.XYZ_FIFO
+        # STATUS_1 and the entry count as of the last FIFO drain, and STATUS_2
+        # bits that drain cleared before get_activity_status could see them
+        self.fifo_status = 0
+        self.fifo_level = 0
+        self._status2 = 0
+
+        self.sync()
 
     def read(self, reg, nbytes=1):
         reg = reg << 1 | ADXL_SPI_RNW
-        data = self.dev.xfer([reg] + [0x00] * nbytes)
+        with self.lock:
+            data = self.dev.xfer([reg] + [0x00] * nbytes)
         if len(data) == 2:
             return data[1]
         else:
             return data[1:]
 
+    def readinto(self, reg, buf, nbytes=None) -> int:
+        """
+        Read nbytes starting at reg directly into buf, a preallocated writable
+        buffer such as a bytearray or uint8 array. With a spidev transport
+        this goes through the SPI ioctl, so no lists are built. Returns the
+        number of bytes read
+
+        reg: Register to start reading from
+        buf: Writable contiguous buffer to read into
+        nbytes: Bytes to read, defaults to the size of buf, ValueError if it
+        is more
+        """
+        if nbytes is None:
+            nbytes = memoryview(buf).nbytes
+        else:
+            check_read(buf, nbytes)
+        with self.lock:
+            self.dev.readinto(reg << 1 | ADXL_SPI_RNW, buf, nbytes)
+        return nbytes
+
     def write(self, reg, msg):
         reg = reg << 1
         if type(msg) != list:
@@ -138,14 +418,177 @@ class ADXL372:
             else:
                 raise TypeError("msg must be int or list")
 
-        self.dev.xfer([reg] + msg)
+        with self.lock:
+            start = (reg >> 1) - SHADOW_FIRST
+            staging = (
+                self._staged is not None
+                and 0 <= start
+                and start + len(msg) <= SHADOW_SIZE
+            )
+            if staging:
+                self._staged.update(range(start, start + len(msg)))
+            else:
+                self.dev.xfer([reg] + msg)
+
+            # registers auto-increment, so keep every byte written in the shadow
+            for i, val in enumerate(msg):
+                if 0 <= start + i < SHADOW_SIZE:
+                    self.shadow[start + i] = val
 
     def update(self, reg, mask, shift, val):
-        old = self.read(reg)
-        new = old & mask
-        # xor oxff cause python's bitwise not is signed
-        new |= (val << shift) & (mask ^ 0xFF)
-        self.write(reg, new)
+        """
+        Change a field of a register. Writable registers are taken from the
+        shadow map, so this costs a single write. Anything else still needs
+        a read first
+        """
+        with self.lock:
+            if SHADOW_FIRST <= reg <= SHADOW_LAST:
+                old = self.shadow[reg - SHADOW_FIRST]
+            else:
+                old = self.read(reg)
+            new = old & mask
+            # xor oxff cause python's bitwise not is signed
+            new |= (val << shift) & (mask ^ 0xFF)
+            self.write(reg, new)
+
+    @contextmanager
+    def configure(self):
+        """
+        Batch configuration changes into as few transfers as possible. Setters
+        called inside the block only update the shadow map. On exit the
+        registers that actually changed are written as auto-incrementing
+        bursts, joining runs separated by a few unchanged registers. If FIFO
+        or timing registers change while the device is measuring, it is put
+        in standby once before the bursts, and POWER_CTL, the highest
+        register, goes out last to restore the final mode. Nothing is sent
+        if the block raises, and the shadow map and the settings cached on
+        the driver go back to what they were. Nested blocks join the outer
+        one
+
+        with dev.configure() as cfg:
+            cfg.set_ODR(ODR.ODR_6400Hz)
+            cfg.set_bandwidth(BW.BW_3200Hz)
+        """
+        with self.lock:
+            if self._staged is not None:
+                yield self
+                return
+
+            committed = bytes(self.shadow)
+            self._staged = set()
+            try:
+                yield self
+            except BaseException:
+                self.shadow[:] = committed
+                self._staged = None
+                # the setters already updated the cached settings too
+                self._decode_shadow()
+                raise
+
+            staged, self._staged = self._staged, None
+            self._flush(staged, committed)
+
+    def _flush(self, staged, committed):
+        changed = sorted(i for i in staged if self.shadow[i] != committed[i])
+        if not changed:
+            return
+
+        power_ctl = ADI_ADXL372_POWER_CTL - SHADOW_FIRST
+        opmode = PWRCTRL_OPMODE_MASK ^ 0xFF
+        need_standby = {ADI_ADXL372_FIFO_SAMPLES, ADI_ADXL372_FIFO_CTL, ADI_ADXL372_TIMING}
+        if committed[power_ctl] & opmode and any(
+            SHADOW_FIRST + i in need_standby for i in changed
+        ):
+            self.dev.xfer(
+                [ADI_ADXL372_POWER_CTL << 1, committed[power_ctl] & PWRCTRL_OPMODE_MASK]
+            )
+            if power_ctl not in changed:
+                changed.append(power_ctl)
+
+        runs = [[changed[0], changed[0]]]
+        for i in changed[1:]:
+            if i - runs[-1][1] - 1 <= BURST_MAX_GAP:
+                runs[-1][1] = i
+            else:
+                runs.append([i, i])
+
+        for first, last in runs:
+            self.dev.xfer(
+                [(SHADOW_FIRST + first) << 1] + list(self.shadow[first : last + 1])
+            )
+
+    def shadowed(self, reg) -> int:
+        """
+        Returns the last known value of a writable register without any bus
+        traffic
+        """
+        return self.shadow[reg - SHADOW_FIRST]
+
+    def verify(self) -> dict:
+        """
+        Read back every writable register in one burst and compare it against
+        the shadow map. Returns {register: (shadow, device)} for each register
+        that differs, an empty dict means the shadow is accurate
+        """
+        actual = self.read(SHADOW_FIRST, SHADOW_SIZE)
+        drift = {}
+        for i, val in enumerate(actual):
+            if self.shadow[i] != val:
+                drift[SHADOW_FIRST + i] = (self.shadow[i], val)
+        return drift
+
+    def sync(self) -> dict:
+        """
+        Reseed the shadow map from the device with one burst read, and the
+        settings kept here from the shadow, so a driver opened on a device
+        that is already configured knows how. Returns the drift found, as
+        verify does
+        """
+        with self.lock:
+            drift = self.verify()
+            for reg, (_, val) in drift.items():
+                self.shadow[reg - SHADOW_FIRST] = val
+            self._decode_shadow()
+        return drift
+
+    def _decode_shadow(self):
+        def field(reg, mask, shift=0):
+            return (self.shadowed(reg) & (mask ^ 0xFF)) >> shift
+
+        self.op_mode = OP_MODES(field(ADI_ADXL372_POWER_CTL, PWRCTRL_OPMODE_MASK))
+        # ODR and bandwidth codes past the last one are reserved
+        self.odr = ODR(min(field(ADI_ADXL372_TIMING, TIMING_ODR_MASK, TIMING_ODR_POS), ODR.ODR_6400Hz))
+        self.bw = BW(min(field(ADI_ADXL372_MEASURE, MEASURE_BANDWIDTH_MASK), BW.BW_3200Hz))
+        self.autosleep = bool(field(ADI_ADXL372_MEASURE, MEASURE_AUTOSLEEP_MASK, MEASURE_AUTOSLEEP_POS))
+        self.wakeup_rate = WUR(field(ADI_ADXL372_TIMING, TIMING_WUR_MASK, TIMING_WUR_POS))
+        self.activity_mode = ActivityMode(
+            min(field(ADI_ADXL372_MEASURE, MEASURE_ACTPROC_MASK, MEASURE_ACTPROC_POS), ActivityMode.LOOPED)
+        )
+        self.filter_settle = FilterSettle(
+            field(ADI_ADXL372_POWER_CTL, PWRCTRL_FILTER_SETTLE_MASK, PWRCTRL_FILTER_SETTLE_POS)
+        )
+        self.instant_on_thresh = InstantOnThresh(
+            field(ADI_ADXL372_POWER_CTL, PWRCTRL_INSTAON_THRESH_MASK, INSTAON_THRESH_POS)
+        )
+        self.hpf = not field(ADI_ADXL372_POWER_CTL, PWRCTRL_HPF_DISABLE_MASK, PWRCTRL_HPF_DISABLE_POS)
+        trims = [self.shadowed(reg) & 0xF for reg in (ADI_ADXL372_OFFSET_X, ADI_ADXL372_OFFSET_Y, ADI_ADXL372_OFFSET_Z)]
+        self.offset_trim = tuple(v - 16 if v > 7 else v for v in trims)
+
+        fast = self.odr == ODR.ODR_6400Hz
+        self.act_time_ms = self.shadowed(ADI_ADXL372_TIME_ACT) * (3.3 if fast else 6.6)
+        time_inact = self.shadowed(ADI_ADXL372_TIME_INACT_H) << 8 | self.shadowed(ADI_ADXL372_TIME_INACT_L)
+        self.inact_time_ms = time_inact * (13 if fast else 26)
+
+        self.fifo_samples = (
+            field(ADI_ADXL372_FIFO_CTL, FIFO_CRL_SAMP8_MASK) << 8 | self.shadowed(ADI_ADXL372_FIFO_SAMPLES)
+        ) + 1
+        self.fifo_mode = FIFOMode(field(ADI_ADXL372_FIFO_CTL, FIFO_CRL_MODE_MASK, FIFO_CRL_MODE_POS))
+        self.fifo_format = FIFOFormat(field(ADI_ADXL372_FIFO_CTL, FIFO_CRL_FORMAT_MASK, FIFO_CRL_FORMAT_POS))
+
+        for pin, reg in ((1, ADI_ADXL372_INT1_MAP), (2, ADI_ADXL372_INT2_MAP)):
+            val = self.shadowed(reg)
+            self.int_map[pin] = Interrupt(val & (INT_MAP_LOW ^ 0xFF))
+            self.int_active_low[pin] = bool(val & INT_MAP_LOW)
 
     def set_op_mode(self, mode: OP_MODES):
         """
@@ -250,6 +693,118 @@ class ADXL372:
         )
         self.instant_on_thresh = mode
 
+    def set_high_pass_filter(self, enable: bool, corner: int = None):
+        """
+        Enable or bypass the internal high pass filter. It is on after reset
+        and removes gravity and any offset from the output, so it has to be
+        off to measure them
+
+        enable: Set to filter, unset to bypass
+        corner: Optional corner setting 0-3 for the HPF register, higher is
+        a lower corner frequency, see page 38 of the datasheet
+        """
+        self.update(
+            ADI_ADXL372_POWER_CTL,
+            PWRCTRL_HPF_DISABLE_MASK,
+            PWRCTRL_HPF_DISABLE_POS,
+            int(not enable),
+        )
+        if corner is not None:
+            self.update(ADI_ADXL372_HPF, HPF_CORNER_MASK, 0, corner & 0x3)
+        self.hpf = enable
+
+    def set_offset_trim(self, x: int, y: int, z: int):
+        """
+        Set the user offset trims, which the device adds to every output
+        sample so offset correction costs the host nothing. Each trim is a
+        4-bit two's complement code from -8 to 7
+
+        x, y, z: Trim codes per axis, out of range values are clamped
+        """
+        codes = [min(max(int(v), -8), 7) for v in (x, y, z)]
+        olds = [self.shadowed(reg) for reg in (ADI_ADXL372_OFFSET_X, ADI_ADXL372_OFFSET_Y, ADI_ADXL372_OFFSET_Z)]
+        # OFFSET_X/Y/Z are adjacent, one burst sets all three
+        self.write(
+            ADI_ADXL372_OFFSET_X,
+            [old & OFFSET_TRIM_MASK | code & (OFFSET_TRIM_MASK ^ 0xFF) for old, code in zip(olds, codes)],
+        )
+        self.offset_trim = tuple(codes)
+
+    def map_interrupts(self, pin: int, events: Interrupt, active_low: bool = False):
+        """
+        Route interrupt sources to the INT1 or INT2 pin, replacing whatever
+        was mapped to it before. The pin is asserted while any of the mapped
+        status bits are set, so e.g. FIFO_RDY stays high until the FIFO is
+        drained below the watermark
+
+        pin: 1 or 2
+        events: The Interrupt flags to route, combine several with |
+        active_low: Drive the pin low rather than high on an interrupt
+        """
+        if pin not in self.int_map:
+            raise ValueError("pin must be 1 or 2")
+        reg = ADI_ADXL372_INT1_MAP if pin == 1 else ADI_ADXL372_INT2_MAP
+
+        self.write(reg, int(events) | (INT_MAP_LOW if active_low else 0))
+        self.int_map[pin] = Interrupt(events)
+        self.int_active_low[pin] = active_low
+
+    def attach_interrupt(self, pin: int, gpio=None, chip: str = "/dev/gpiochip0"):
+        """
+        Attach the host GPIO line wired to INT1 or INT2 so waits can sleep on
+        the pin edge instead of polling STATUS_1 over SPI. Call map_interrupts
+        first so the right edge is chosen. Returns the backend
+
+        pin: 1 or 2
+        gpio: Any gpio.GPIOBackend, such as a FakeGPIO. If unset, the line
+        ADXL_INT1_PIN or ADXL_INT2_PIN on chip is opened through the GPIO
+        character device
+        chip: The gpiochip device the line belongs to
+        """
+        from gpio import ChardevGPIO, RISING_EDGE, FALLING_EDGE
+
+        if pin not in self.int_gpio:
+            raise ValueError("pin must be 1 or 2")
+        if gpio is None:
+            line = ADXL_INT1_PIN if pin == 1 else ADXL_INT2_PIN
+            edge = FALLING_EDGE if self.int_active_low[pin] else RISING_EDGE
+            gpio = ChardevGPIO(line, chip, edge)
+
+        self.detach_interrupt(pin)
+        self.int_gpio[pin] = gpio
+        return gpio
+
+    def detach_interrupt(self, pin: int):
+        """
+        Close and forget the GPIO backend attached to pin
+        """
+        gpio, self.int_gpio[pin] = self.int_gpio[pin], None
+        if gpio is not None:
+            gpio.close()
+
+    def interrupt_gpio(self, event: Interrupt):
+        """
+        Returns the attached GPIO backend of a pin that event is mapped to,
+        or None if the event can only be found by polling
+        """
+        for pin in (1, 2):
+            if self.int_gpio[pin] is not None and self.int_map[pin] & event:
+                return self.int_gpio[pin]
+        return None
+
+    def wait_for_interrupt(self, pin: int = 1, timeout: float = None):
+        """
+        Sleep until the attached line for pin sees an edge. Returns the time
+        of the edge in seconds or None if timeout passed first
+
+        pin: 1 or 2
+        timeout: Seconds to wait, None waits forever
+        """
+        gpio = self.int_gpio[pin]
+        if gpio is None:
+            raise RuntimeError("no GPIO attached to INT%d, call attach_interrupt" % pin)
+        return gpio.wait(timeout)
+
     def get_dev_id(self):
         """
         Returns the content of the device id. If it's not 0xAD somethign is wrong
@@ -261,14 +816,19 @@ class ADXL372:
         Read the STATUS1 register to get information about device state
         for a breakdown of the fields check page 33 of the datasheet
         """
-        return self.read(ADI_ADXL372_STATUS_1)
+        with self.lock:
+            self.readinto(ADI_ADXL372_STATUS_1, self._reg_buf, 1)
+            return self._reg_buf[0]
 
     def get_activity_status(self):
         """
         Read the STATUS2 register to get information about activity detection state
-        for a breakdown of the fields check page 33 of the datasheet
+        for a breakdown of the fields check page 33 of the datasheet. Bits
+        cleared by a FIFO drain since the last call are included
         """
-        return self.read(ADI_ADXL372_STATUS_2)
+        with self.lock:
+            status, self._status2 = self.read(ADI_ADXL372_STATUS_2) | self._status2, 0
+        return status
 
     def set_activity_threshold(
         self,
@@ -375,8 +935,8 @@ class ADXL372:
         w_val_high = (w_val >> 8) & 0xFF
         w_val_low = w_val & 0xFF
 
-        self.write(ADI_ADXL372_TIME_INACT_H, w_val_high)
-        self.write(ADI_ADXL372_TIME_INACT_L, w_val_low)
+        # TIME_INACT_L follows TIME_INACT_H so one burst sets both
+        self.write(ADI_ADXL372_TIME_INACT_H, [w_val_high, w_val_low])
         self.inact_time_ms = duration_ms
 
     @staticmethod
@@ -385,24 +945,8 @@ class ADXL372:
         Function to process samples, handles all the gross conversions
         needed to handle the accelerometers data format
         """
-        x = ((data[0] & 0xFF) << 8) | data[1]
-        y = ((data[2] & 0xFF) << 8) | data[3]
-        z = ((data[4] & 0xFF) << 8) | data[5]
-
-        x = x >> 4
-        y = y >> 4
-        z = z >> 4
-
-        def twos_complement(val):
-            if val & (1 << (12 - 1)):
-                val = val - (1 << 12)
-            return val
-
-        x = twos_complement(x)
-        y = twos_complement(y)
-        z = twos_complement(z)
-
-        return Sample(x, y, z)
+        x, y, z = decode_samples(data)[0]
+        return Sample(int(x), int(y), int(z))
 
     def get_highest_peak_accel_data(self) -> Sample:
         """
@@ -413,17 +957,82 @@ class ADXL372:
         data = self.read(ADI_ADXL372_X_MAXPEAK_H, 6)
         return self.process_sample(data)
 
-    def get_accel_data(self) -> Sample:
+    def snapshot(self) -> Snapshot:
         """
-        Read the raw acceleration data for all three axes from the
-        X_DATA_X register
+        Read STATUS_1, STATUS_2, FIFO_ENTRIES and the X/Y/Z data registers
+        in one auto-incrementing transaction. They are adjacent, so the
+        status, activity flags, FIFO level and latest sample come back
+        together for the cost of a single transfer. STATUS_2 bits read here
+        are kept for get_activity_status
         """
-        status = 0
-        while not (status & DATA_RDY):
-            status = self.get_status()
+        with self.lock:
+            self.readinto(ADI_ADXL372_STATUS_1, self._snapshot_buf)
+            status, activity, entries, x, y, z = _SNAPSHOT.unpack(self._snapshot_buf)
+            self._status2 |= activity
+        if status & DATA_RDY:
+            self._sample_seen = monotonic()
+        return Snapshot(
+            status,
+            activity,
+            entries & 0x3FF,
+            # readings are left justified, the shift sign extends them
+            Sample(x >> 4, y >> 4, z >> 4),
+            bool(status & DATA_RDY),
+        )
 
-        data = self.read(ADI_ADXL372_X_DATA_H, 6)
-        return self.process_sample(data)
+    def get_accel_data(self, timeout: float = None, backoff: bool = True) -> Sample:
+        """
+        Read the raw acceleration data for all three axes. Each attempt is a
+        single snapshot() of the status and data registers, which is
+        returned as soon as DATA_RDY says the sample is new. If DATA_RDY is
+        mapped to an attached interrupt line this sleeps on the edge between
+        attempts, otherwise it polls. Raises TimeoutError if timeout passes
+        first
+
+        timeout: Seconds to wait for a new sample, None waits ten sample periods
+        backoff: Sleep between polls rather than spinning on the bus, as
+        poll_backoff() paces them
+        """
+        gpio = self.interrupt_gpio(Interrupt.DATA_RDY)
+        period = 1.0 / ODR_HZ[self.odr]
+        if timeout is None:
+            timeout = 10 * period
+        end = monotonic() + timeout
+        naps = self.poll_backoff()
+
+        while True:
+            snap = self.snapshot()
+            if snap.new:
+                return snap.sample
+            if self.metrics is not None:
+                self.metrics.spin()
+            left = end - monotonic()
+            if left <= 0:
+                raise TimeoutError("no new sample in %gs" % timeout)
+            if gpio is not None:
+                # an edge can be missed if it came before we started waiting,
+                # so only trust it for a few sample periods before checking again
+                gpio.wait(min(10 * period, left))
+            elif backoff:
+                sleep(min(next(naps), left))
+
+    def poll_backoff(self):
+        """
+        Generator of the sleeps between polls for a new sample, shared by
+        the blocking and async get_accel_data. The first lasts until shortly
+        before the next sample is due after the last one snapshot() found,
+        later ones start at an eighth of the sample period and double up to
+        a whole one
+        """
+        period = 1.0 / ODR_HZ[self.odr]
+        # waking a little early keeps the polls from drifting behind the samples
+        due = self._sample_seen + 0.75 * period - monotonic()
+        if due > 0:
+            yield due
+        wait = period / 8
+        while True:
+            yield wait
+            wait = min(2 * wait, period)
 
     def get_fifo_entries(self) -> int:
         """
@@ -435,6 +1044,24 @@ class ADXL372:
         ret_val = (data[0] << 8) | data[1]
         return ret_val
 
+    @property
+    def fifo_sets(self) -> int:
+        """
+        The FIFO watermark in sample sets of the configured format
+        """
+        return self.fifo_samples // len(FIFO_FORMAT_AXES[self.fifo_format])
+
+    def _fifo_level(self) -> int:
+        # STATUS_1, STATUS_2 and FIFO_ENTRIES are adjacent, so the drain sees
+        # overrun flags for the cost of two extra bytes
+        self.readinto(ADI_ADXL372_STATUS_1, self._status_buf, 4)
+        self.fifo_status = self._status_buf[0]
+        self._status2 |= self._status_buf[1]
+        self.fifo_level = ((self._status_buf[2] & 0x3) << 8) | self._status_buf[3]
+        if self.metrics is not None:
+            self.metrics.drain(self.fifo_level, self.fifo_status)
+        return self.fifo_level
+
     def configure_fifo(
         self, samples: int, mode: FIFOMode, qformat: FIFOFormat
     ):  # TODO: think of a better name
@@ -443,30 +1070,36 @@ class ADXL372:
         number of samples up to 512, the format of the samples (x-y-z, z, x-z, etc),
         and the mode the FIFO operates in. Note that for 3-axis and impact peak
         the samples can be set to a max of 170, and for 2-axis a max of 256. The
-        512 sample maximum is only for single axis measurements. There are several
+        512 sample maximum is only for single axis measurements. Out of range
+        values are set to the maximum for the format. There are several
         modes, in BYPASS the FIFO is disabled, in OLDEST_SAVED the FIFO will store
         the first N samples, and must be disabled and reenabled to collect a new set,
         in STREAMED mode it essentially acts like a buffer, holding the last N, and
         in TRIGGERED it acts like stream mode till an event, after which it stores
         the samples around the event
 
-        samples: The number of samples stored, should be informed by the format arg
+        samples: The number of samples stored, should be informed by the format arg.
+        Each sample is one set of all the axes in the format
         mode: The mode the FIFO will operate in,
         qformat: The format that samples should be stored in, chooses axes to be sampled
         """
         # FIFO must be configured in standby
-        self.set_op_mode(OP_MODES.STAND_BY)
+        if self.shadowed(ADI_ADXL372_POWER_CTL) & (PWRCTRL_OPMODE_MASK ^ 0xFF):
+            self.set_op_mode(OP_MODES.STAND_BY)
 
-        if samples > 512 or samples < 0:
-            samples = 512
-        # You have to leave 1 sample in the FIFO queue when you read
-        samples -= 1
+        set_size = len(FIFO_FORMAT_AXES[qformat])
+        limit = FIFO_MAX_ENTRIES // set_size
+        if samples > limit or samples < 1:
+            samples = limit
+        # FIFO_SAMPLES counts single axis entries, and you have to leave 1
+        # sample in the FIFO queue when you read
+        samples = samples * set_size - 1
 
         samples_msb = int(samples > 0xFF)
         config = (
             (mode << FIFO_CRL_MODE_POS)
             | (qformat << FIFO_CRL_FORMAT_POS)
-            | (samples_MSB << FIFO_CRL_SAMP8_POS)
+            | (samples_msb << FIFO_CRL_SAMP8_POS)
         )
 
         self.write(ADI_ADXL372_FIFO_SAMPLES, samples & 0xFF)
@@ -478,9 +1111,200 @@ class ADXL372:
 
         self.set_op_mode(OP_MODES.FULL_BW_MEASUREMENT)
 
-    def reset(self):
+    def set_fifo_watermark(self, samples: int):
+        """
+        Change the FIFO watermark, keeping the FIFO mode and format and the
+        operating mode the device was in. The writes are batched so the
+        device is only out of measurement for two short transfers. The FIFO
+        has to be configured in standby, so what it held is lost
+
+        samples: The watermark in sample sets, limited as in configure_fifo
+        """
+        with self.configure():
+            op_mode = self.op_mode
+            self.configure_fifo(samples, self.fifo_mode, self.fifo_format)
+            self.set_op_mode(op_mode)
+
+    def read_fifo_raw(self) -> bytearray:
+        """
+        Drain every complete sample set queued in the FIFO and return the
+        undecoded bytes. The entry count is read once, and the data is then
+        pulled from FIFO_DATA in one transfer into the driver's buffer and
+        copied out. One sample has to stay in the FIFO, and the read is
+        rounded down to whole sample sets so the next drain starts on the
+        first axis again
+        """
+        nbytes = self._drain(self._fifo_buf, FIFO_MAX_ENTRIES, 1)
+        return bytearray(self._fifo_view[:nbytes])
+
+    def read_fifo(self) -> np.ndarray:
+        """
+        Drain the FIFO with read_fifo_raw and decode it according to the
+        configured FIFO format. Returns an (N, axes) int16 array with the
+        columns ordered as in FIFO_FORMAT_AXES[dev.fifo_format]. In
+        XYZ_PEAK_FIFO mode each row is the peak of one event rather than
+        a single reading
+        """
+        return self._decode(self.read_fifo_raw())
+
+    def read_fifo_into(self, out: np.ndarray, min_sets: int = 1) -> np.ndarray:
+        """
+        Steady state version of read_fifo. The status, entry count and FIFO
+        data are read into buffers the driver preallocated and decoded straight
+        into out, so a drain doesn't allocate anything per sample. At most
+        len(out) sample sets are taken, the rest stay queued. Returns the
+        filled rows of out as a view
+
+        out: int16 array of shape (M, axes) for the configured FIFO format
+        min_sets: Leave the FIFO alone unless at least this many sample sets
+        can be drained, so checking a device below its watermark costs one
+        short transfer
+        """
+        nbytes = self._drain(self._fifo_buf, len(out), min_sets)
+        return self._decode(self._fifo_view[:nbytes], out)
+
+    def _decode(self, data, out=None) -> np.ndarray:
+        if self.metrics is None:
+            return decode_samples(data, self.fifo_format, out)
+        start = perf_counter()
+        samples = decode_samples(data, self.fifo_format, out)
+        self.metrics.decoded(perf_counter() - start)
+        return samples
+
+    def read_fifo_raw_into(self, buf, min_sets: int = 1) -> memoryview:
+        """
+        Drain the FIFO straight into buf without decoding anything, for
+        recording the bytes as they come off the bus. Takes as many whole
+        sample sets as fit in buf. Returns a memoryview of the filled part
+
+        buf: Writable buffer, 1024 bytes holds a full FIFO in any format
+        min_sets: As in read_fifo_into
+        """
+        set_bytes = len(FIFO_FORMAT_AXES[self.fifo_format]) * 2
+        view = memoryview(buf).cast("B")
+        nbytes = self._drain(buf, len(view) // set_bytes, min_sets)
+        return view[:nbytes]
+
+    def _drain(self, buf, max_sets, min_sets) -> int:
+        set_size = len(FIFO_FORMAT_AXES[self.fifo_format])
+        with self.lock:
+            entries = self._fifo_level()
+            sets = min(max(entries - 1, 0) // set_size, max_sets)
+            if sets < min_sets:
+                sets = 0
+            nbytes = sets * set_size * 2
+            if nbytes:
+                self.readinto(ADI_ADXL372_FIFO_DATA, buf, nbytes)
+        return nbytes
+
+    def start_stream(self, capacity: int = 1 << 16, auto_watermark: bool = False, publish: str = None):
+        """
+        Start a background thread that owns the bus, drains the FIFO each
+        time the watermark should have been reached and writes the decoded
+        samples with their timestamps into a preallocated ring buffer.
+        If the FIFO is bypassed it is switched to STREAMED mode using the
+        current watermark and format. Returns the Stream, read it with
+        latest(n) or by iterating over it
+
+        capacity: Number of sample sets the ring buffer holds
+        auto_watermark: Let a WatermarkTuner pick the watermark from the ODR
+        and format and keep adjusting it to how promptly the FIFO is drained
+        publish: Put the ring buffer in shared memory under this name, so
+        shm.Subscriber can read the stream from other processes. The name is
+        unlinked when the stream stops
+        """
+        from stream import Stream
+        from watermark import WatermarkTuner
+
+        if self.stream is not None:
+            raise RuntimeError("stream already running, call stop_stream first")
+        tuner = WatermarkTuner(self) if auto_watermark else None
+        sets = tuner.initial() if tuner is not None else self.fifo_sets
+        if self.fifo_mode == FIFOMode.BYPASSED:
+            self.configure_fifo(sets, FIFOMode.STREAMED, self.fifo_format)
+        elif sets != self.fifo_sets:
+            self.set_fifo_watermark(sets)
+
+        ring = None
+        if publish is not None:
+            from shm import SharedRing
+
+            ring = SharedRing.create(publish, capacity, self.fifo_format, ODR_HZ[self.odr])
+        self.stream = Stream(self, capacity, tuner, ring)
+        self.stream.start()
+        return self.stream
+
+    def stop_stream(self):
+        """
+        Stop the acquisition thread started by start_stream. The ring buffer
+        stays readable through the returned Stream
+        """
+        stream, self.stream = self.stream, None
+        if stream is not None:
+            stream.stop()
+        return stream
+
+    def reset(self, timeout: float = 0.5):
+        """
+        Soft reset the device and wait for it to come back. Rather than
+        sleeping for the worst case the ID and STATUS_1 are polled in one
+        burst until the part answers and has finished loading its NVM, which
+        takes about a millisecond. The shadow map and the settings kept here
+        are then reloaded from the reset values
+
+        timeout: Seconds to wait for the device, raises TimeoutError after
+        """
         self.write(ADI_ADXL372_SRESET, 0x52)
-        sleep(1)
+        end = monotonic() + timeout
+        while not self.ready():
+            if monotonic() >= end:
+                raise TimeoutError("device did not come back from reset in %gs" % timeout)
+            sleep(RESET_POLL_INTERVAL)
+        self.sync()
+
+    def ready(self) -> bool:
+        """
+        Whether the device is answering on the bus and not busy loading its
+        NVM. ADI_DEVID reads back as zero while it is in reset
+        """
+        data = self.read(ADI_ADXL372_ADI_DEVID, ADI_ADXL372_STATUS_1 - ADI_ADXL372_ADI_DEVID + 1)
+        return data[0] == ADI_ADXL372_ADI_DEVID_VAL and not data[-1] & USER_NVM_BUSY
+
+    def enable_metrics(self):
+        """
+        Start counting bus transfers per register, their durations, status
+        polls, FIFO fill at each drain, overruns, dropped samples and decode
+        time. The transport is wrapped in a metrics.InstrumentedTransport
+        until disable_metrics. Returns the metrics.Metrics, calling this
+        again returns the same one
+        """
+        from metrics import Metrics, InstrumentedTransport
+
+        with self.lock:
+            if self.metrics is None:
+                self.metrics = Metrics("spi%d.%d" % (self.major, self.minor))
+                self.dev = InstrumentedTransport(self.dev, self.metrics)
+            return self.metrics
+
+    def disable_metrics(self):
+        """
+        Put the original transport back and stop counting. Returns the
+        metrics collected, or None if they weren't on
+        """
+        with self.lock:
+            metrics, self.metrics = self.metrics, None
+            if metrics is not None:
+                self.dev = self.dev.transport
+            return metrics
+
+    def close(self):
+        """
+        Stop any stream, release attached interrupt lines and the bus
+        """
+        self.stop_stream()
+        for pin in (1, 2):
+            self.detach_interrupt(pin)
+        self.dev.close()
 
 
 if __name__ == "__main__":
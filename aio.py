@@ -0,0 +1,197 @@
+import asyncio
+
+import numpy as np
+
+from time import monotonic
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from adxl372 import ADXL372, FIFOMode, Interrupt, ODR_HZ, FIFO_FORMAT_AXES, SampleBatch
+from defs import *
+from timebase import Timebase
+
+
+def _in_executor(name):
+    """
+    Build an awaitable version of the blocking ADXL372 method called name
+    """
+
+    async def method(self, *args, **kwargs):
+        return await self._call(getattr(self.dev, name), *args, **kwargs)
+
+    method.__name__ = name
+    method.__doc__ = getattr(ADXL372, name).__doc__
+    return method
+
+
+class AsyncADXL372:
+    """
+    asyncio facade over an ADXL372. Every SPI transfer runs on an executor
+    dedicated to this sensor, so a slow bus never stalls the event loop and
+    several sensors can be served from one loop. Data ready and watermark
+    waits await the attached interrupt line's file descriptor through the
+    loop when one is mapped, and fall back to asyncio.sleep polling at the
+    configured ODR otherwise
+
+    dev: The ADXL372 to wrap
+    executor: Executor to run transfers on. Defaults to a private single
+    worker pool, which also keeps transfers to this sensor in order
+    """
+
+    def __init__(self, dev: ADXL372, executor=None):
+        self.dev = dev
+        self._own_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="adxl372")
+        self.executor = executor
+
+    async def _call(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(fn, *args, **kwargs))
+
+    set_op_mode = _in_executor("set_op_mode")
+    set_ODR = _in_executor("set_ODR")
+    set_bandwidth = _in_executor("set_bandwidth")
+    set_autosleep = _in_executor("set_autosleep")
+    set_wakeup_rate = _in_executor("set_wakeup_rate")
+    set_activity_processing_mode = _in_executor("set_activity_processing_mode")
+    set_filter_settle = _in_executor("set_filter_settle")
+    set_instant_on_thresh = _in_executor("set_instant_on_thresh")
+    set_high_pass_filter = _in_executor("set_high_pass_filter")
+    set_offset_trim = _in_executor("set_offset_trim")
+    set_activity_threshold = _in_executor("set_activity_threshold")
+    set_activity_time = _in_executor("set_activity_time")
+    set_inactivity_time = _in_executor("set_inactivity_time")
+    configure_fifo = _in_executor("configure_fifo")
+    set_fifo_watermark = _in_executor("set_fifo_watermark")
+    map_interrupts = _in_executor("map_interrupts")
+    get_dev_id = _in_executor("get_dev_id")
+    get_status = _in_executor("get_status")
+    snapshot = _in_executor("snapshot")
+    get_activity_status = _in_executor("get_activity_status")
+    get_fifo_entries = _in_executor("get_fifo_entries")
+    get_highest_peak_accel_data = _in_executor("get_highest_peak_accel_data")
+    read_fifo_raw = _in_executor("read_fifo_raw")
+    read_fifo = _in_executor("read_fifo")
+    sync = _in_executor("sync")
+    verify = _in_executor("verify")
+
+    async def _edge(self, gpio, timeout: float = None):
+        """
+        Await an edge on gpio through the event loop. Returns the time of the
+        edge or None if timeout passed first
+        """
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = gpio.fileno()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await asyncio.wait_for(ready, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            loop.remove_reader(fd)
+        return gpio.read_events()
+
+    async def wait_for_interrupt(self, pin: int = 1, timeout: float = None):
+        """
+        Await an edge on the line attached to INT1 or INT2. Returns the time
+        of the edge in seconds or None if timeout passed first
+        """
+        gpio = self.dev.int_gpio[pin]
+        if gpio is None:
+            raise RuntimeError("no GPIO attached to INT%d, call attach_interrupt" % pin)
+        return await self._edge(gpio, timeout)
+
+    async def get_accel_data(self, timeout: float = None):
+        """
+        Await the next sample, one snapshot() per attempt. Waits on the
+        DATA_RDY edge if it is mapped to an attached line, otherwise polls
+        with the same backoff as ADXL372.get_accel_data, from
+        ADXL372.poll_backoff. Raises TimeoutError
+        if timeout passes first, None waits ten sample periods
+        """
+        dev = self.dev
+        gpio = dev.interrupt_gpio(Interrupt.DATA_RDY)
+        period = 1.0 / ODR_HZ[dev.odr]
+        if timeout is None:
+            timeout = 10 * period
+        end = monotonic() + timeout
+        naps = dev.poll_backoff()
+
+        while True:
+            snap = await self.snapshot()
+            if snap.new:
+                return snap.sample
+            if dev.metrics is not None:
+                dev.metrics.spin()
+            left = end - monotonic()
+            if left <= 0:
+                raise TimeoutError("no new sample in %gs" % timeout)
+            if gpio is not None:
+                await self._edge(gpio, min(10 * period, left))
+            else:
+                await asyncio.sleep(min(next(naps), left))
+
+    async def stream(self, interval: float = None):
+        """
+        Async generator yielding each decoded FIFO batch as a SampleBatch.
+        Waits on the FIFO_RDY edge if it is mapped to an attached
+        line, otherwise sleeps for half the watermark period between drains.
+        The FIFO is switched to STREAMED mode if it is bypassed. Batches are
+        timestamped and marked with gaps by a Timebase, as in Stream
+
+        interval: Seconds between drains when polling, overrides the default
+        """
+        dev = self.dev
+        if dev.fifo_mode == FIFOMode.BYPASSED:
+            await self.configure_fifo(dev.fifo_sets, FIFOMode.STREAMED, dev.fifo_format)
+
+        gpio = dev.interrupt_gpio(Interrupt.FIFO_RDY)
+        axes = FIFO_FORMAT_AXES[dev.fifo_format]
+        if interval is None:
+            interval = max(dev.fifo_sets, 1) / ODR_HZ[dev.odr] / 2
+        timebase = Timebase(ODR_HZ[dev.odr])
+        out = np.empty((FIFO_MAX_ENTRIES // len(axes), len(axes)), dtype=np.int16)
+        timestamps = np.empty(len(out), dtype=np.float64)
+
+        edge = None
+        while True:
+            # the drain and its time are taken on the worker, not after the
+            # loop gets round to it
+            batch, _, dropped, overrun = await self._call(timebase.drain, dev, out, timestamps, edge)
+            n = len(batch)
+            if n:
+                # the consumer keeps the batch past the next drain
+                yield SampleBatch(batch.copy(), timestamps[:n].copy(), axes, dropped, overrun)
+            if gpio is not None:
+                edge = await self._edge(gpio, 8 * interval)
+            else:
+                await asyncio.sleep(interval)
+
+    async def reset(self, timeout: float = 0.5):
+        """
+        Soft reset the device without blocking the loop while it restarts,
+        see ADXL372.reset
+        """
+        await self._call(self.dev.write, ADI_ADXL372_SRESET, 0x52)
+        end = monotonic() + timeout
+        while not await self._call(self.dev.ready):
+            if monotonic() >= end:
+                raise TimeoutError("device did not come back from reset in %gs" % timeout)
+            await asyncio.sleep(RESET_POLL_INTERVAL)
+        await self.sync()
+
+    async def close(self):
+        """
+        Shut down the private executor once the transfers queued on it are
+        done, waiting in a thread so the loop keeps running meanwhile
+        """
+        if self._own_executor:
+            await asyncio.to_thread(self.executor.shutdown, wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -0,0 +1,253 @@
+"""
+Benchmarks for the bus and decode paths
+
+Measures SPI transactions and bytes per delivered sample, decode throughput
+for the scalar and batched decoders, host CPU per second of acquisition and
+the latency from a sample being ready to it being delivered, for each ODR.
+Runs against the simulator by default or a real device with --spi, and saves
+the results as JSON so runs from different versions can be compared
+
+    python bench.py --duration 2 --output results.json
+    python bench.py --spi 0.0 --compare results.json
+"""
+import sys
+import json
+import argparse
+import platform
+import numpy as np
+
+from time import perf_counter, process_time, monotonic, sleep, strftime
+
+from adxl372 import *
+from spi import CountingTransport, SpidevTransport
+from sim import SimulatedADXL372
+
+
+# metrics where a bigger number is an improvement, everything else is a cost
+HIGHER_IS_BETTER = {"samples_per_s", "delivered_rate"}
+
+
+def percentiles(values):
+    if not len(values):
+        return None, None
+    p50, p99 = np.percentile(np.asarray(values) * 1000, [50, 99])
+    return float(p50), float(p99)
+
+
+def bench_decode(sets: int = 170, repeat: int = 200) -> list:
+    """
+    Decode throughput in samples per second for process_sample called per
+    sample and decode_samples over a whole FIFO dump
+    """
+    data = np.random.default_rng(0).integers(0, 256, sets * 6, dtype=np.uint8).tobytes()
+
+    start = perf_counter()
+    for _ in range(repeat):
+        for i in range(0, len(data), 6):
+            ADXL372.process_sample(data[i : i + 6])
+    scalar = sets * repeat / (perf_counter() - start)
+
+    out = np.empty((sets, 3), dtype=np.int16)
+    start = perf_counter()
+    for _ in range(repeat * 10):
+        decode_samples(data, FIFOFormat.XYZ_FIFO, out)
+    batched = sets * repeat * 10 / (perf_counter() - start)
+
+    return [
+        {"path": "decode_scalar", "samples_per_s": scalar},
+        {"path": "decode_batched", "samples_per_s": batched},
+    ]
+
+
+class Run:
+    """
+    Bookkeeping for one acquisition benchmark
+    """
+
+    def __init__(self, bus, path, odr):
+        self.bus = bus
+        self.path = path
+        self.odr = odr
+        self.samples = 0
+        self.latencies = []
+
+    def __enter__(self):
+        self.bus.reset_counts()
+        self.wall = perf_counter()
+        self.cpu = process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = perf_counter() - self.wall
+        self.cpu = process_time() - self.cpu
+
+    def result(self) -> dict:
+        n = max(self.samples, 1)
+        p50, p99 = percentiles(self.latencies)
+        return {
+            "path": self.path,
+            "odr_hz": ODR_HZ[self.odr],
+            "samples": self.samples,
+            "delivered_rate": self.samples / self.wall,
+            "transactions_per_sample": self.bus.transactions / n,
+            "bytes_per_sample": self.bus.bytes / n,
+            "bus_time_per_sample_us": self.bus.bus_time / n * 1e6,
+            "cpu_per_s": self.cpu / self.wall,
+            "latency_p50_ms": p50,
+            "latency_p99_ms": p99,
+        }
+
+
+def _configure(dev, odr, fifo_samples, fifo_mode):
+    with dev.configure() as cfg:
+        cfg.set_op_mode(OP_MODES.STAND_BY)
+        cfg.set_ODR(odr)
+        cfg.set_bandwidth(BW(min(odr, BW.BW_3200Hz)))
+        cfg.configure_fifo(fifo_samples, fifo_mode, FIFOFormat.XYZ_FIFO)
+
+
+def bench_polling(dev, bus, sim, odr, duration) -> dict:
+    """
+    get_accel_data in a loop, one sample at a time
+    """
+    _configure(dev, odr, dev.fifo_sets, FIFOMode.BYPASSED)
+    with Run(bus, "polling", odr) as run:
+        end = monotonic() + duration
+        while monotonic() < end:
+            dev.get_accel_data()
+            delivered = monotonic()
+            run.samples += 1
+            if sim is not None:
+                run.latencies.append(delivered - sim.sample_time())
+    return run.result()
+
+
+def bench_fifo(dev, bus, sim, odr, duration, watermark: int = 50) -> dict:
+    """
+    read_fifo_into each half watermark period, or on the FIFO_RDY edge if
+    it is mapped to an attached line
+    """
+    _configure(dev, odr, watermark, FIFOMode.STREAMED)
+    gpio = dev.interrupt_gpio(Interrupt.FIFO_RDY)
+    interval = watermark / ODR_HZ[odr] / 2
+    out = np.empty((FIFO_MAX_ENTRIES // 3, 3), dtype=np.int16)
+
+    with Run(bus, "fifo", odr) as run:
+        end = monotonic() + duration
+        while monotonic() < end:
+            edge = gpio.wait(8 * interval) if gpio is not None else None
+            batch = dev.read_fifo_into(out)
+            delivered = monotonic()
+            if not len(batch):
+                if gpio is None:
+                    sleep(interval)
+                continue
+            run.samples += len(batch)
+            if edge is not None:
+                run.latencies.append(delivered - edge)
+            elif sim is not None:
+                # the newest sample drained is the one before those left behind
+                left = sim.fifo_entries // 3
+                run.latencies.append(delivered - sim.sample_time(left))
+            if gpio is None:
+                sleep(interval)
+    return run.result()
+
+
+def run_all(dev, bus, sim, odrs, duration) -> list:
+    results = bench_decode()
+    for odr in odrs:
+        results.append(bench_polling(dev, bus, sim, odr, duration))
+        results.append(bench_fifo(dev, bus, sim, odr, duration))
+    return results
+
+
+def compare(results, baseline) -> list:
+    """
+    Returns (path, odr, metric, old, new, change) for every metric present
+    in both runs, change is the relative difference with a positive value
+    meaning a regression
+    """
+    def key(r):
+        return (r["path"], r.get("odr_hz"))
+
+    old = {key(r): r for r in baseline}
+    rows = []
+    for r in results:
+        if key(r) not in old:
+            continue
+        for metric, new_val in r.items():
+            old_val = old[key(r)].get(metric)
+            if metric in ("path", "odr_hz", "samples") or not old_val or new_val is None:
+                continue
+            change = (new_val - old_val) / abs(old_val)
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            rows.append((r["path"], r.get("odr_hz"), metric, old_val, new_val, change))
+    return rows
+
+
+def print_results(results):
+    for r in results:
+        fields = ", ".join(
+            "%s=%.4g" % (k, v) for k, v in r.items() if k not in ("path", "odr_hz") and v is not None
+        )
+        odr = "" if "odr_hz" not in r else " @%dHz" % r["odr_hz"]
+        print("%s%s: %s" % (r["path"], odr, fields))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--spi", help="bus.cs of a real device, e.g. 0.0. Defaults to the simulator")
+    parser.add_argument("--duration", type=float, default=1.0, help="seconds per acquisition run")
+    parser.add_argument("--odr", type=int, nargs="*", default=[400, 800, 1600, 3200, 6400])
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per transaction")
+    parser.add_argument("--output", help="write results as JSON here")
+    parser.add_argument("--compare", help="JSON from an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change reported as a regression")
+    args = parser.parse_args(argv)
+
+    sim = None
+    if args.spi:
+        major, minor = (int(v) for v in args.spi.split("."))
+        transport = SpidevTransport(major, minor)
+    else:
+        sim = transport = SimulatedADXL372(latency=args.latency)
+    bus = CountingTransport(transport)
+    dev = ADXL372(transport=bus)
+
+    hz_to_odr = {hz: odr for odr, hz in ODR_HZ.items()}
+    odrs = [hz_to_odr[hz] for hz in args.odr]
+    try:
+        results = run_all(dev, bus, sim, odrs, args.duration)
+    finally:
+        dev.set_op_mode(OP_MODES.STAND_BY)
+        dev.close()
+
+    print_results(results)
+    report = {
+        "time": strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "transport": args.spi or "sim",
+        "duration": args.duration,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = 0
+        for path, odr, metric, old, new, change in compare(results, baseline):
+            flag = "REGRESSION" if change > args.threshold else ""
+            regressions += bool(flag)
+            print("%s @%s %s: %.4g -> %.4g (%+.1f%%) %s" % (path, odr, metric, old, new, change * 100, flag))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
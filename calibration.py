@@ -0,0 +1,240 @@
+"""
+Self-test and offset calibration
+
+The ADXL372 can add a 4-bit trim to each axis before the samples reach
+the data registers and the FIFO, so an offset corrected on the device
+costs the host nothing afterwards. calibrate() runs the on-chip
+self-test, averages a stationary FIFO capture with the high pass filter
+off, works out the trim codes that cancel the offset against the expected
+gravity vector and writes them. The result is a CalibrationProfile which
+can be saved to a JSON file and written back after the next power up,
+profiles are keyed by the SPI address since the part has no serial number
+
+    profile = calibrate(dev, gravity=(0, 0, 1))
+    save_calibration(profile, "adxl372_cal.json")
+    ...
+    apply_trims(dev, load_calibration("adxl372_cal.json", device_key(dev)))
+"""
+import os
+import json
+import numpy as np
+
+from time import time, monotonic, sleep
+from dataclasses import dataclass, field, asdict
+
+from adxl372 import ODR_HZ, OP_MODES, FIFOMode, FIFOFormat
+from defs import *
+
+
+def device_key(dev) -> str:
+    return "spi%d.%d" % (dev.major, dev.minor)
+
+
+@dataclass
+class CalibrationProfile:
+    """
+    Calibration of one device
+
+    device: Key of the device, see device_key
+    trim: Trim codes written to OFFSET_X/Y/Z
+    residual: Offset left per axis after trimming, in counts
+    trim_lsb: Counts moved per trim code per axis
+    self_test: Self-test result, None if it wasn't run
+    created: Unix time of the calibration
+    """
+
+    device: str
+    trim: tuple
+    residual: list = field(default_factory=lambda: [0.0, 0.0, 0.0])
+    trim_lsb: list = field(default_factory=lambda: [OFFSET_TRIM_LSB] * 3)
+    self_test: bool = None
+    created: float = field(default_factory=time)
+
+    def to_dict(self) -> dict:
+        d = asdict(self)
+        d["trim"] = list(self.trim)
+        return d
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "CalibrationProfile":
+        d = dict(d)
+        d["trim"] = tuple(d["trim"])
+        return cls(**d)
+
+
+def self_test(dev, timeout: float = 1.0) -> bool:
+    """
+    Run the on-chip self-test, which moves the proof mass electrostatically
+    and checks the outputs respond. The device has to be measuring and held
+    still, it is put in full bandwidth measurement for the test and returned
+    to its previous mode. Returns whether the part passed
+
+    timeout: Seconds to wait for the test to finish, raises TimeoutError after
+    """
+    op_mode = dev.op_mode
+    dev.set_op_mode(OP_MODES.FULL_BW_MEASUREMENT)
+    try:
+        dev.write(ADI_ADXL372_SELF_TEST, SELF_TEST_ST)
+        end = monotonic() + timeout
+        # the test takes about 300ms
+        while True:
+            result = dev.read(ADI_ADXL372_SELF_TEST)
+            if result & SELF_TEST_DONE:
+                return bool(result & SELF_TEST_USER_ST)
+            if monotonic() >= end:
+                raise TimeoutError("self-test did not finish in %.1fs" % timeout)
+            sleep(0.02)
+    finally:
+        dev.write(ADI_ADXL372_SELF_TEST, 0)
+        dev.set_op_mode(op_mode)
+
+
+def _average(dev, seconds: float) -> np.ndarray:
+    """
+    Mean of every sample drained from the FIFO over seconds, with the high
+    pass filter off and the FIFO streaming all three axes. The previous
+    FIFO, filter and mode settings are put back afterwards
+    """
+    if dev.stream is not None:
+        raise RuntimeError("stream running, call stop_stream first")
+    saved = (dev.op_mode, dev.hpf, dev.fifo_sets, dev.fifo_mode, dev.fifo_format)
+    with dev.configure():
+        dev.set_op_mode(OP_MODES.STAND_BY)
+        dev.set_high_pass_filter(False)
+        dev.configure_fifo(0, FIFOMode.STREAMED, FIFOFormat.XYZ_FIFO)
+
+    rate = ODR_HZ[dev.odr]
+    out = np.empty((FIFO_MAX_ENTRIES // 3, 3), dtype=np.int16)
+    total = np.zeros(3)
+    count = 0
+    try:
+        # let the filters settle and throw away what was recorded meanwhile
+        sleep(0.05)
+        dev.read_fifo_into(out)
+        end = monotonic() + seconds
+        while monotonic() < end or count == 0:
+            sleep(min(0.5 * len(out) / rate, 0.1))
+            batch = dev.read_fifo_into(out)
+            total += batch.sum(axis=0)
+            count += len(batch)
+    finally:
+        op_mode, hpf, sets, mode, qformat = saved
+        with dev.configure():
+            dev.set_op_mode(OP_MODES.STAND_BY)
+            dev.set_high_pass_filter(hpf)
+            dev.configure_fifo(sets, mode, qformat)
+            dev.set_op_mode(op_mode)
+    return total / count
+
+
+def measure_offsets(dev, seconds: float = 1.0, gravity=(0.0, 0.0, 1.0)) -> np.ndarray:
+    """
+    Zero g offset of each axis in counts, with the current trims applied.
+    The device has to be still in a known orientation
+
+    seconds: How long to average for
+    gravity: Expected reading in g per axis, (0, 0, 1) for a part lying flat
+    """
+    return _average(dev, seconds) - np.asarray(gravity) / ADXL372_SCALEG
+
+
+def measure_trim_scale(dev, seconds: float = 1.0, low: int = -4, high: int = 3) -> np.ndarray:
+    """
+    Counts moved per trim code on each axis, found by averaging at two trim
+    settings. Puts the original trims back
+
+    seconds: How long to average at each setting
+    low, high: Trim codes to compare
+    """
+    trim = dev.offset_trim
+    try:
+        dev.set_offset_trim(low, low, low)
+        a = _average(dev, seconds)
+        dev.set_offset_trim(high, high, high)
+        b = _average(dev, seconds)
+    finally:
+        dev.set_offset_trim(*trim)
+    return (b - a) / (high - low)
+
+
+def calibrate(
+    dev,
+    seconds: float = 1.0,
+    gravity=(0.0, 0.0, 1.0),
+    run_self_test: bool = True,
+    measure_scale: bool = True,
+) -> CalibrationProfile:
+    """
+    Self-test the device, measure its offsets and write the trims that
+    cancel them. The device has to be still in a known orientation. Returns
+    the profile, the trims are already applied
+
+    seconds: How long to average each measurement for
+    gravity: Expected reading in g per axis, (0, 0, 1) for a part lying flat
+    run_self_test: Run the self-test first, raises RuntimeError if it fails
+    measure_scale: Measure the counts per trim code rather than trusting
+    OFFSET_TRIM_LSB, takes two more measurements
+    """
+    passed = None
+    if run_self_test:
+        passed = self_test(dev)
+        if not passed:
+            raise RuntimeError("self-test failed")
+
+    dev.set_offset_trim(0, 0, 0)
+    offset = measure_offsets(dev, seconds, gravity)
+    if measure_scale:
+        scale = measure_trim_scale(dev, seconds)
+        # an axis that didn't respond would give a nonsense trim
+        scale = np.where(np.abs(scale) > 0.25 * OFFSET_TRIM_LSB, scale, OFFSET_TRIM_LSB)
+    else:
+        scale = np.full(3, OFFSET_TRIM_LSB)
+
+    trim = np.clip(np.round(-offset / scale), -8, 7).astype(int)
+    residual = offset + trim * scale
+    dev.set_offset_trim(*trim)
+    return CalibrationProfile(
+        device_key(dev),
+        tuple(int(t) for t in trim),
+        [float(r) for r in residual],
+        [float(s) for s in scale],
+        passed,
+    )
+
+
+def apply_trims(dev, profile: CalibrationProfile):
+    """
+    Write a saved profile's trims to the device
+    """
+    dev.set_offset_trim(*profile.trim)
+
+
+def save_calibration(profile: CalibrationProfile, path):
+    """
+    Store a profile in a JSON file of {device: profile}, replacing any
+    earlier profile for the same device. The file is replaced in one step
+    so an interrupted save leaves the old one intact
+    """
+    profiles = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            profiles = json.load(f)
+    profiles[profile.device] = profile.to_dict()
+    tmp = "%s.tmp" % path
+    with open(tmp, "w") as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(tmp, path)
+
+
+def load_calibration(path, device: str) -> CalibrationProfile:
+    """
+    The profile saved for device. Raises FileNotFoundError if there is no
+    file, KeyError if it holds no profile for device
+
+    device: Key of the device, see device_key
+    """
+    with open(path) as f:
+        profiles = json.load(f)
+    if device not in profiles:
+        raise KeyError("no calibration for %s in %s" % (device, path))
+    return CalibrationProfile.from_dict(profiles[device])
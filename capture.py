@@ -0,0 +1,402 @@
+"""
+Append only capture files of streamed samples
+
+A capture starts with a magic string, the length of a JSON header and the
+header itself, which holds the configuration of every stream in the file
+(ODR, bandwidth, FIFO format, scale factors, trim offsets). After that the
+file is a sequence of chunks, one per batch written. Each chunk is a fixed
+32 byte header followed by the int16 samples, padded to 8 bytes. Batches
+from Stream and SensorArray are evenly spaced, so a chunk stores the time
+of its first sample and the sample period rather than a timestamp each.
+
+Nothing is ever rewritten, so a capture cut short by a crash or power loss
+is readable up to the last complete chunk. CaptureReader memory maps the
+file and hands out numpy views straight into it, so seeking into a large
+capture only reads the chunk headers.
+
+Chunks can also hold the FIFO bytes exactly as they came off the bus,
+which RawRecorder writes without decoding anything. The reader decodes a
+raw chunk the first time it is used and keeps the most recently used ones
+"""
+import json
+import mmap
+import struct
+import threading
+import numpy as np
+
+from time import time
+from collections import OrderedDict
+
+from adxl372 import ODR_HZ, FIFO_FORMAT_AXES, FIFOMode, FIFOFormat, Interrupt, SampleBatch, decode_samples
+from defs import *
+from timebase import Timebase
+
+
+MAGIC = b"ADXLCAP1"
+_PREAMBLE = struct.Struct("<8sI")
+# tag, stream, flags, sample sets, dropped, first sample time, period
+CHUNK = struct.Struct("<4sHHIIdd")
+CHUNK_SAMPLES = b"SMPL"
+CHUNK_RAW = b"RAWD"
+# chunk flags, raw chunks keep their FIFO format in the high byte
+FLAG_OVERRUN = 0x1
+FLAG_FORMAT_POS = 8
+
+
+def _pad(n: int) -> int:
+    return -n % 8
+
+
+def device_config(dev) -> dict:
+    """
+    The parts of a device's configuration needed to interpret its samples
+    """
+    offsets = [dev.shadowed(reg) for reg in (ADI_ADXL372_OFFSET_X, ADI_ADXL372_OFFSET_Y, ADI_ADXL372_OFFSET_Z)]
+    return {
+        "device": "spi%d.%d" % (dev.major, dev.minor),
+        "odr_hz": ODR_HZ[dev.odr],
+        "bandwidth": dev.bw.name,
+        "fifo_format": dev.fifo_format.name,
+        "axes": list(FIFO_FORMAT_AXES[dev.fifo_format]),
+        "scale_g": ADXL372_SCALEG,
+        "scale_ms2": ADXL372_SCALE,
+        "offsets": offsets,
+    }
+
+
+class CaptureWriter:
+    """
+    Writes SampleBatches to a capture file. Writes go through a large
+    buffer so the storage sees long sequential writes, and the samples are
+    written straight from the batch's memory
+
+    path: File to create
+    sensors: {name: ADXL372} of the streams that will be written, or a
+    single ADXL372. Their configuration goes in the header
+    buffer_size: Bytes buffered before a write reaches the file
+    """
+
+    def __init__(self, path, sensors, buffer_size: int = 1 << 20):
+        if not isinstance(sensors, dict):
+            sensors = {"spi%d.%d" % (sensors.major, sensors.minor): sensors}
+        self.names = list(sensors)
+        header = {
+            "version": 1,
+            "created": time(),
+            "streams": [dict(device_config(dev), name=name) for name, dev in sensors.items()],
+        }
+        blob = json.dumps(header).encode()
+        blob += b" " * _pad(_PREAMBLE.size + len(blob))
+
+        self.file = open(path, "wb", buffering=buffer_size)
+        self.file.write(_PREAMBLE.pack(MAGIC, len(blob)))
+        self.file.write(blob)
+        self.chunks = 0
+        self.samples = 0
+        # several recorders can share a writer
+        self.lock = threading.Lock()
+
+    def write(self, batch: SampleBatch, stream=0):
+        """
+        Append a batch as one chunk
+
+        stream: Index or name of the stream the batch belongs to
+        """
+        if not isinstance(stream, int):
+            stream = self.names.index(stream)
+        n = len(batch)
+        if n == 0:
+            return
+        start, period = 0.0, 0.0
+        if batch.timestamps is not None:
+            start = float(batch.timestamps[0])
+            if n > 1:
+                period = float(batch.timestamps[-1] - start) / (n - 1)
+        flags = FLAG_OVERRUN if batch.overrun else 0
+
+        data = np.ascontiguousarray(batch.data)
+        self._chunk(CHUNK.pack(CHUNK_SAMPLES, stream, flags, n, batch.dropped, start, period), data, n)
+
+    def write_raw(
+        self,
+        data,
+        qformat: FIFOFormat,
+        start: float,
+        period: float,
+        stream=0,
+        dropped: int = 0,
+        overrun: bool = False,
+    ):
+        """
+        Append undecoded FIFO bytes, such as those from read_fifo_raw_into,
+        as one chunk
+
+        data: Whole sample sets as read from FIFO_DATA
+        qformat: The FIFO format the bytes are in
+        start: Time of the first sample set
+        period: Time between sample sets
+        """
+        if not isinstance(stream, int):
+            stream = self.names.index(stream)
+        n = len(data) // (len(FIFO_FORMAT_AXES[qformat]) * 2)
+        if n == 0:
+            return
+        flags = (FLAG_OVERRUN if overrun else 0) | (int(qformat) << FLAG_FORMAT_POS)
+        self._chunk(CHUNK.pack(CHUNK_RAW, stream, flags, n, dropped, start, period), data, n)
+
+    def _chunk(self, header, data, n):
+        nbytes = memoryview(data).nbytes
+        with self.lock:
+            self.file.write(header)
+            self.file.write(data)
+            self.file.write(bytes(_pad(nbytes)))
+            self.chunks += 1
+            self.samples += n
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CaptureReader:
+    """
+    Reads a capture file through a memory map. Opening it walks the chunk
+    headers to build an index, the samples themselves are only touched when
+    a batch is used. Batches returned share memory with the file and stay
+    valid until close(). Raw chunks are decoded when first used, and the
+    last cache_size of them are kept decoded
+
+    path: Capture file to open
+    cache_size: Decoded raw chunks to keep
+    """
+
+    def __init__(self, path, cache_size: int = 256):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, length = _PREAMBLE.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a capture file" % path)
+        offset = _PREAMBLE.size
+        self.header = json.loads(bytes(self.map[offset : offset + length]))
+        self.streams = self.header["streams"]
+        self._index(offset + length)
+
+    def _index(self, offset):
+        fields = []
+        size = len(self.map)
+        while offset + CHUNK.size <= size:
+            tag, stream, flags, count, dropped, start, period = CHUNK.unpack_from(self.map, offset)
+            axes = self._axes(tag, stream, flags)
+            nbytes = None if axes is None else count * len(axes) * 2
+            if nbytes is None or offset + CHUNK.size + nbytes > size:
+                # unknown or cut short, the capture ends here
+                break
+            fields.append((offset, stream, flags, count, dropped, start, period, tag == CHUNK_RAW))
+            offset += CHUNK.size + nbytes + _pad(nbytes)
+
+        self.index = np.array(
+            fields,
+            dtype=[
+                ("offset", np.int64),
+                ("stream", np.uint16),
+                ("flags", np.uint16),
+                ("count", np.uint32),
+                ("dropped", np.uint32),
+                ("start", np.float64),
+                ("period", np.float64),
+                ("raw", bool),
+            ],
+        )
+
+    def _axes(self, tag, stream, flags):
+        if stream >= len(self.streams):
+            return None
+        if tag == CHUNK_SAMPLES:
+            return tuple(self.streams[stream]["axes"])
+        if tag == CHUNK_RAW:
+            qformat = flags >> FLAG_FORMAT_POS
+            if qformat in FIFO_FORMAT_AXES:
+                return FIFO_FORMAT_AXES[qformat]
+        return None
+
+    def __len__(self):
+        return len(self.index)
+
+    def stream(self, name) -> int:
+        """
+        Index of the stream called name
+        """
+        return [s["name"] for s in self.streams].index(name)
+
+    def batch(self, i: int) -> SampleBatch:
+        """
+        Chunk i as a SampleBatch whose data is a view into the file
+        """
+        offset, stream, flags, count, dropped, start, period, raw = self.index[i]
+        timestamps = start + np.arange(count) * period
+        overrun = bool(flags & FLAG_OVERRUN)
+        if raw:
+            qformat = FIFOFormat(flags >> FLAG_FORMAT_POS)
+            data = self._decoded(i, qformat)
+            return SampleBatch(data, timestamps, FIFO_FORMAT_AXES[qformat], int(dropped), overrun)
+
+        axes = tuple(self.streams[stream]["axes"])
+        data = np.frombuffer(self.map, np.int16, int(count) * len(axes), int(offset) + CHUNK.size)
+        return SampleBatch(data.reshape(-1, len(axes)), timestamps, axes, int(dropped), overrun)
+
+    def raw(self, i: int):
+        """
+        The bytes of raw chunk i as stored, and the FIFO format they are in
+        """
+        offset, _, flags, count, *_, raw = self.index[i]
+        if not raw:
+            raise ValueError("chunk %d holds decoded samples" % i)
+        qformat = FIFOFormat(flags >> FLAG_FORMAT_POS)
+        start = int(offset) + CHUNK.size
+        nbytes = int(count) * len(FIFO_FORMAT_AXES[qformat]) * 2
+        return memoryview(self.map)[start : start + nbytes], qformat
+
+    def _decoded(self, i, qformat):
+        data = self._cache.get(i)
+        if data is not None:
+            self._cache.move_to_end(i)
+            return data
+        data = decode_samples(self.raw(i)[0], qformat)
+        self._cache[i] = data
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return data
+
+    def batches(self, stream=0):
+        """
+        Generator of every chunk of one stream in order
+        """
+        if not isinstance(stream, (int, np.integer)):
+            stream = self.stream(stream)
+        for i in np.flatnonzero(self.index["stream"] == stream):
+            yield self.batch(i)
+
+    def range(self, start: float, end: float, stream=0) -> list:
+        """
+        Views of the samples of one stream timed in [start, end), as one
+        SampleBatch per chunk they fall in. Chunks are found by binary search
+        on their start times
+        """
+        if not isinstance(stream, (int, np.integer)):
+            stream = self.stream(stream)
+        chunks = np.flatnonzero(self.index["stream"] == stream)
+        starts = self.index["start"][chunks]
+        first = max(np.searchsorted(starts, start, side="right") - 1, 0)
+        last = np.searchsorted(starts, end, side="left")
+
+        out = []
+        for i in chunks[first:last]:
+            batch = self.batch(i)
+            lo, hi = np.searchsorted(batch.timestamps, [start, end])
+            if hi > lo:
+                out.append(batch[lo:hi])
+        return out
+
+    def read(self, start: float, end: float, stream=0) -> SampleBatch:
+        """
+        The samples of one stream timed in [start, end) copied into a single
+        SampleBatch. Gaps inside the range are visible in the timestamps
+        """
+        parts = self.range(start, end, stream)
+        if not parts:
+            axes = self.streams[stream if isinstance(stream, int) else self.stream(stream)]["axes"]
+            return SampleBatch(np.empty((0, len(axes))), np.empty(0), axes)
+        return SampleBatch(
+            np.concatenate([p.data for p in parts]),
+            np.concatenate([p.timestamps for p in parts]),
+            parts[0].axes,
+            parts[0].dropped,
+            parts[0].overrun,
+        )
+
+    def close(self):
+        self._cache.clear()
+        try:
+            self.map.close()
+        except BufferError:
+            # batches still point into the map, it goes when they do
+            pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RawRecorder:
+    """
+    Acquisition thread that drains the FIFO into a CaptureWriter without
+    decoding anything. Each drain becomes one raw chunk timestamped by a
+    Timebase, so the per sample cost on the host is the bus transfer and a
+    buffered file write. Decoding happens later, in CaptureReader, and only
+    for the chunks someone reads
+
+    dev: ADXL372 to record, its FIFO is switched to STREAMED mode if bypassed
+    writer: CaptureWriter to append to
+    stream: Index or name of dev's stream in the writer
+    """
+
+    def __init__(self, dev, writer: CaptureWriter, stream=0):
+        self.dev = dev
+        self.writer = writer
+        self.stream = stream
+        self.timebase = Timebase(ODR_HZ[dev.odr])
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        dev = self.dev
+        if dev.fifo_mode == FIFOMode.BYPASSED:
+            dev.configure_fifo(dev.fifo_sets, FIFOMode.STREAMED, dev.fifo_format)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """
+        Stop recording, re-raising any exception from the recording thread
+        """
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        dev = self.dev
+        qformat = dev.fifo_format
+        interval = max(dev.fifo_sets, 1) / ODR_HZ[dev.odr] / 2
+        gpio = dev.interrupt_gpio(Interrupt.FIFO_RDY)
+        buf = bytearray(FIFO_MAX_ENTRIES * 2)
+        timebase = self.timebase
+        edge = None
+
+        try:
+            while not self._stop.is_set():
+                data, index, dropped, overrun = timebase.drain(dev, buf, edge=edge, raw=True)
+                if data:
+                    self.writer.write_raw(
+                        data, qformat, timebase.time_of(index), timebase.period, self.stream, dropped, overrun
+                    )
+                if gpio is not None:
+                    edge = gpio.wait(8 * interval)
+                else:
+                    self._stop.wait(interval)
+        except Exception as e:
+            self.error = e
@@ -54,6 +54,15 @@ ADI_ADXL372_SELF_TEST         = 0x40   # Self Test
 ADI_ADXL372_SRESET            = 0x41   # Reset
 ADI_ADXL372_FIFO_DATA         = 0x42   # FIFO Data
 
+# Writable configuration registers mirrored in the driver's shadow map
+SHADOW_FIRST                  = ADI_ADXL372_OFFSET_X
+SHADOW_LAST                   = ADI_ADXL372_POWER_CTL
+SHADOW_SIZE                   = SHADOW_LAST - SHADOW_FIRST + 1
+# Unchanged registers a batched write will resend to join two runs into one burst
+BURST_MAX_GAP                 = 4
+# Seconds between checks for the device coming back from a soft reset
+RESET_POLL_INTERVAL           = 0.0005
+
 ADI_ADXL372_ADI_DEVID_VAL     = 0xAD   # Analog Devices, Inc., accelerometer ID
 ADI_ADXL372_MST_DEVID_VAL     = 0x1D   # Analog Devices MEMS device ID
 ADI_ADXL372_DEVID_VAL         = 0xFA   # Device ID
@@ -69,6 +78,12 @@ PWRCTRL_OPMODE_MASK           = 0xFC
 PWRCTRL_INSTAON_THRESH_MASK   = 0xDF
 PWRCTRL_INSTAON_THRESH_MASK   = 0xDF
 PWRCTRL_FILTER_SETTLE_MASK    = 0xEF
+PWRCTRL_HPF_DISABLE_MASK      = 0xFB
+HPF_CORNER_MASK               = 0xFC
+OFFSET_TRIM_MASK              = 0xF0
+FIFO_CRL_SAMP8_MASK           = 0xFE
+FIFO_CRL_MODE_MASK            = 0xF9
+FIFO_CRL_FORMAT_MASK          = 0xC7
 
 # Position of flags in their respective registers
 MEASURE_AUTOSLEEP_POS         = 6
@@ -80,14 +95,45 @@ FIFO_CRL_SAMP8_POS            = 0
 FIFO_CRL_MODE_POS             = 1
 FIFO_CRL_FORMAT_POS           = 3
 PWRCTRL_FILTER_SETTLE_POS     = 4
+PWRCTRL_HPF_DISABLE_POS       = 2
 
 DATA_RDY      = 1
 FIFO_RDY      = 2
 FIFO_FULL     = 4
 FIFO_OVR      = 8
+USER_NVM_BUSY = 0x20
+AWAKE         = 0x40
+ERR_USER_REGS = 0x80
+
+# SELF_TEST bits
+SELF_TEST_ST      = 0x01  # start
+SELF_TEST_DONE    = 0x02
+SELF_TEST_USER_ST = 0x04  # passed
+
+# Offset trims are 4-bit two's complement. Output codes moved per trim
+# code, nominal, calibration.measure_trim_scale finds the real value
+OFFSET_TRIM_LSB   = 1.0
+
+# STATUS_2 bits
+STATUS2_INACT = 0x10
+STATUS2_ACT   = 0x20
+STATUS2_ACT2  = 0x40
+
+# INT1_MAP/INT2_MAP bits
+INT_MAP_DATA_RDY  = 0x01
+INT_MAP_FIFO_RDY  = 0x02
+INT_MAP_FIFO_FULL = 0x04
+INT_MAP_FIFO_OVR  = 0x08
+INT_MAP_INACT     = 0x10
+INT_MAP_ACT       = 0x20
+INT_MAP_AWAKE     = 0x40
+INT_MAP_LOW       = 0x80  # pin is active low
 
 ADXL_SPI_RNW  = 1
 
+SPI_MAX_TRANSFER = 4096  # default spidev bufsiz, the largest single xfer
+FIFO_MAX_ENTRIES = 512
+
 #/*Acceleremoter configuration*/
 ACT_VALUE       =  30     # Activity threshold value
 
@@ -0,0 +1,382 @@
+"""
+Streaming feature extraction for vibration and shock monitoring
+
+A Pipeline takes SampleBatches as they are drained, runs them through a
+chain of transform stages and then hands the result to one or more feature
+stages, which emit a Features frame each time a window completes. Every
+stage keeps just enough history in preallocated buffers to carry on where
+the last batch stopped, so nothing is ever processed twice. A batch that
+follows a gap resets the stages that look back in time, so windows and
+filters never span lost samples
+
+    pipe = Pipeline(
+        ODR_HZ[dev.odr],
+        Scale(),
+        RemoveDC(),
+        Decimate(4),
+        features=[WindowStats(400), Spectrum(256, bands=[(0, 50), (50, 200)])],
+    )
+    for frame in pipe.run(dev.start_stream()):
+        print(frame.kind, frame.time, frame.values)
+"""
+import numpy as np
+
+from dataclasses import dataclass
+from numpy.lib.stride_tricks import sliding_window_view
+
+from defs import ADXL372_SCALEG
+
+
+@dataclass
+class Features:
+    """
+    Output of a feature stage for one window
+
+    kind: Name of the stage that produced it
+    time: Timestamp of the last sample in the window, None without timestamps
+    values: {name: array with one value per axis, or per axis and bin}
+    """
+
+    kind: str
+    time: float
+    values: dict
+
+
+class Stage:
+    """
+    Base for pipeline stages. start() is called once with the input sample
+    rate and axis count and returns the output rate. Transform stages
+    return (data, timestamps) from push(), feature stages return a list of
+    Features. reset() drops any history kept between batches
+    """
+
+    def start(self, rate: float, axes: int) -> float:
+        self.rate = rate
+        self.axes = axes
+        self.reset()
+        return rate
+
+    def reset(self):
+        pass
+
+    def push(self, data: np.ndarray, timestamps: np.ndarray):
+        raise NotImplementedError
+
+
+class _Scratch:
+    """
+    Output buffer reused between batches, grown when a bigger batch arrives
+    """
+
+    def __init__(self, axes: int, dtype=np.float32):
+        self.buf = np.empty((0, axes), dtype=dtype)
+
+    def get(self, n: int) -> np.ndarray:
+        if len(self.buf) < n:
+            self.buf = np.empty((max(n, 2 * len(self.buf)), self.buf.shape[1]), dtype=self.buf.dtype)
+        return self.buf[:n]
+
+
+class Scale(Stage):
+    """
+    Convert raw counts to physical units
+
+    factor: ADXL372_SCALEG for g, ADXL372_SCALE for m/s^2
+    """
+
+    def __init__(self, factor: float = ADXL372_SCALEG):
+        self.factor = factor
+
+    def start(self, rate, axes):
+        self._out = _Scratch(axes)
+        return super().start(rate, axes)
+
+    def push(self, data, timestamps):
+        out = self._out.get(len(data))
+        np.multiply(data, self.factor, out=out, casting="unsafe")
+        return out, timestamps
+
+
+class RemoveDC(Stage):
+    """
+    Subtract a running mean per axis, removing gravity and offset drift.
+    The mean tracks each batch's average with a time constant of tau, so
+    the whole stage is two vectorized operations per batch
+
+    tau: Seconds over which the mean follows changes
+    """
+
+    def __init__(self, tau: float = 1.0):
+        self.tau = tau
+
+    def start(self, rate, axes):
+        self._out = _Scratch(axes)
+        return super().start(rate, axes)
+
+    def reset(self):
+        self.mean = None
+
+    def push(self, data, timestamps):
+        n = len(data)
+        if n == 0:
+            return data, timestamps
+        batch_mean = data.mean(axis=0)
+        if self.mean is None:
+            self.mean = batch_mean
+        else:
+            alpha = 1.0 - np.exp(-n / (self.tau * self.rate))
+            self.mean += alpha * (batch_mean - self.mean)
+        out = self._out.get(n)
+        np.subtract(data, self.mean, out=out, casting="unsafe")
+        return out, timestamps
+
+
+class Decimate(Stage):
+    """
+    Low pass filter and keep every factor-th sample. The filter is a
+    windowed sinc FIR cut off at 0.8 of the new Nyquist frequency, run over
+    the batch with the last taps - 1 samples of the previous batch kept in
+    front of it, and only evaluated at the samples that are kept. Output
+    timestamps are those of the center of each filter window, so the filter
+    delay doesn't shift the data in time
+
+    factor: Decimation ratio
+    taps: FIR length, defaults to 8 per unit of factor
+    """
+
+    def __init__(self, factor: int, taps: int = None):
+        if factor < 1:
+            raise ValueError("factor must be at least 1")
+        self.factor = factor
+        self.taps = taps or 8 * factor + 1
+        n = np.arange(self.taps) - (self.taps - 1) / 2
+        cutoff = 0.8 / factor
+        h = cutoff * np.sinc(cutoff * n) * np.hamming(self.taps)
+        self.h = (h / h.sum()).astype(np.float32)
+
+    def start(self, rate, axes):
+        self._out = _Scratch(axes)
+        self._ts_out = np.empty(0)
+        super().start(rate, axes)
+        return rate / self.factor
+
+    def reset(self):
+        self._buf = np.empty((0, self.axes), dtype=np.float32)
+        self._ts = np.empty(0)
+        self.held = 0
+        # position in the buffer of the last sample of the next window
+        self.due = self.taps - 1
+
+    def push(self, data, timestamps):
+        held, n = self.held, len(data)
+        if len(self._buf) < held + n:
+            size = max(held + n, 2 * len(self._buf))
+            self._buf = np.resize(self._buf, (size, self.axes))
+            self._ts = np.resize(self._ts, size)
+        buf = self._buf[: held + n]
+        buf[held:] = data
+        ts = self._ts[: held + n]
+        if timestamps is not None:
+            ts[held:] = timestamps
+
+        count = len(range(self.due, len(buf), self.factor))
+        out = self._out.get(count)
+        if count:
+            windows = sliding_window_view(buf, self.taps, axis=0)[self.due - self.taps + 1 :: self.factor]
+            np.matmul(windows[:count], self.h, out=out)
+
+        out_ts = None
+        if timestamps is not None:
+            if len(self._ts_out) < count:
+                self._ts_out = np.empty(max(count, 2 * len(self._ts_out)))
+            out_ts = self._ts_out[:count]
+            out_ts[:] = ts[self.due - (self.taps - 1) // 2 :: self.factor][:count]
+
+        # keep the last taps - 1 samples in front of the next batch
+        tail = min(len(buf), self.taps - 1)
+        shift = len(buf) - tail
+        buf[:tail] = buf[shift:]
+        ts[:tail] = ts[shift:]
+        self.held = tail
+        self.due += count * self.factor - shift
+        return out, out_ts
+
+
+class _Windows:
+    """
+    Collects samples into windows of size with a step of hop between their
+    starts, keeping the overlap in a preallocated buffer. feed() returns
+    each window that completed as (data, end timestamp) views that are only
+    valid until the next call
+    """
+
+    def __init__(self, size: int, hop: int, axes: int):
+        self.size = size
+        self.hop = hop
+        self.buf = np.empty((size, axes), dtype=np.float32)
+        self.reset()
+
+    def reset(self):
+        self.filled = 0
+        # samples still to throw away when hop is bigger than size
+        self.skip = 0
+
+    def feed(self, data, timestamps):
+        i = 0
+        n = len(data)
+        while i < n:
+            if self.skip:
+                step = min(self.skip, n - i)
+                self.skip -= step
+                i += step
+                continue
+            take = min(self.size - self.filled, n - i)
+            self.buf[self.filled : self.filled + take] = data[i : i + take]
+            self.filled += take
+            i += take
+            if self.filled == self.size:
+                yield self.buf, None if timestamps is None else float(timestamps[i - 1])
+                if self.hop < self.size:
+                    self.buf[: self.size - self.hop] = self.buf[self.hop :]
+                    self.filled = self.size - self.hop
+                else:
+                    self.filled = 0
+                    self.skip = self.hop - self.size
+
+
+class WindowStats(Stage):
+    """
+    RMS, peak absolute value and crest factor (peak / RMS) per axis over
+    sliding windows
+
+    window: Samples per window
+    hop: Samples between window starts, defaults to window (no overlap)
+    """
+
+    kind = "stats"
+
+    def __init__(self, window: int, hop: int = None):
+        self.window = window
+        self.hop = hop or window
+
+    def start(self, rate, axes):
+        self._windows = _Windows(self.window, self.hop, axes)
+        return super().start(rate, axes)
+
+    def reset(self):
+        self._windows.reset()
+
+    def push(self, data, timestamps):
+        frames = []
+        for win, end in self._windows.feed(data, timestamps):
+            rms = np.sqrt(np.einsum("ij,ij->j", win, win) / len(win))
+            peak = np.abs(win).max(axis=0)
+            crest = np.divide(peak, rms, out=np.zeros_like(peak), where=rms > 0)
+            frames.append(Features(self.kind, end, {"rms": rms, "peak": peak, "crest": crest}))
+        return frames
+
+
+class Spectrum(Stage):
+    """
+    Welch power spectral density and band energies per axis. Segments of
+    nperseg samples with a Hann window overlap by half, and average
+    segments are averaged into each output frame. The window, FFT
+    frequencies and band masks are computed once in start()
+
+    nperseg: Samples per FFT segment
+    bands: [(low_hz, high_hz), ...] to sum the power in, each band gives
+    one value per axis in values["bands"], shape (bands, axes)
+    average: Segments averaged per frame
+    psd: Also return the full spectrum in values["psd"], shape (bins, axes)
+    """
+
+    kind = "spectrum"
+
+    def __init__(self, nperseg: int = 256, bands=(), average: int = 4, psd: bool = False):
+        self.nperseg = nperseg
+        self.bands = list(bands)
+        self.average = average
+        self.psd = psd
+
+    def start(self, rate, axes):
+        self._windows = _Windows(self.nperseg, self.nperseg // 2, axes)
+        self.window = np.hanning(self.nperseg).astype(np.float32)
+        # one sided density scaling as in scipy.signal.welch
+        self.scale = 1.0 / (rate * np.sum(self.window ** 2))
+        self.freqs = np.fft.rfftfreq(self.nperseg, 1.0 / rate)
+        self.masks = np.array([(self.freqs >= lo) & (self.freqs < hi) for lo, hi in self.bands], dtype=np.float64)
+        self._acc = np.zeros((len(self.freqs), axes))
+        self._tapered = np.empty((self.nperseg, axes), dtype=np.float32)
+        return super().start(rate, axes)
+
+    def reset(self):
+        self._windows.reset()
+        self._acc[:] = 0
+        self.segments = 0
+
+    def push(self, data, timestamps):
+        frames = []
+        df = self.freqs[1] - self.freqs[0]
+        for win, end in self._windows.feed(data, timestamps):
+            np.multiply(win, self.window[:, None], out=self._tapered)
+            spec = np.fft.rfft(self._tapered, axis=0)
+            self._acc += spec.real ** 2 + spec.imag ** 2
+            self.segments += 1
+            if self.segments < self.average:
+                continue
+            psd = self._acc * (self.scale / self.segments)
+            psd[1:-1] *= 2
+            values = {"bands": self.masks @ psd * df}
+            if self.psd:
+                values["psd"] = psd
+                values["freqs"] = self.freqs
+            frames.append(Features(self.kind, end, values))
+            self._acc[:] = 0
+            self.segments = 0
+        return frames
+
+
+class Pipeline:
+    """
+    Chain of transform stages followed by feature stages that all see the
+    transformed data. push() takes a SampleBatch and returns the Features
+    frames that completed, ordered by stage
+
+    rate: Sample rate of the input in Hz, ODR_HZ[dev.odr]
+    stages: Transform stages applied in order
+    features: Feature stages run on the output of the last transform
+    axes: Number of axes in the input batches
+    """
+
+    def __init__(self, rate: float, *stages, features=(), axes: int = 3):
+        self.stages = stages
+        self.features = list(features)
+        for stage in self.stages:
+            rate = stage.start(rate, axes)
+        for stage in self.features:
+            stage.start(rate, axes)
+        # output rate after decimation
+        self.rate = rate
+
+    def reset(self):
+        for stage in (*self.stages, *self.features):
+            stage.reset()
+
+    def push(self, batch) -> list:
+        if batch.gap:
+            self.reset()
+        data, timestamps = batch.data, batch.timestamps
+        for stage in self.stages:
+            data, timestamps = stage.push(data, timestamps)
+        frames = []
+        for stage in self.features:
+            frames.extend(stage.push(data, timestamps))
+        return frames
+
+    def run(self, batches):
+        """
+        Generator of Features frames from an iterable of SampleBatches, such
+        as a Stream
+        """
+        for batch in batches:
+            yield from self.push(batch)
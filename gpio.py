@@ -0,0 +1,160 @@
+import os
+import fcntl
+import select
+import struct
+
+from time import monotonic
+
+
+# Edges to wake on
+RISING_EDGE = 1
+FALLING_EDGE = 2
+BOTH_EDGES = RISING_EDGE | FALLING_EDGE
+
+# Linux GPIO character device ABI v1, see include/uapi/linux/gpio.h
+GPIOHANDLE_REQUEST_INPUT = 1 << 0
+# struct gpioevent_request: lineoffset, handleflags, eventflags, consumer_label[32], fd
+_EVENT_REQUEST = struct.Struct("=III32si")
+# struct gpioevent_data: u64 timestamp, u32 id, padded to 16 bytes
+_EVENT_DATA = struct.Struct("=QI4x")
+
+
+def _iowr(kind, nr, size):
+    return (3 << 30) | (size << 16) | (kind << 8) | nr
+
+
+GPIO_GET_LINEEVENT_IOCTL = _iowr(0xB4, 0x04, _EVENT_REQUEST.size)
+
+
+class GPIOBackend:
+    """
+    Interface for a host GPIO line wired to one of the INT pins. The driver
+    only needs to block until an edge arrives. Backends also expose a file
+    descriptor that becomes readable on an edge so they can be handed to
+    select/poll or an asyncio loop
+    """
+
+    def fileno(self) -> int:
+        raise NotImplementedError
+
+    def read_events(self):
+        """
+        Consume every queued edge without blocking and return the time of the
+        newest one in seconds. Only call this once fileno() is readable
+        """
+        raise NotImplementedError
+
+    def wait(self, timeout: float = None):
+        """
+        Block until an edge arrives or timeout seconds pass. Returns the time
+        of the most recent edge in seconds, or None on timeout. Edges that
+        queued up while nobody was waiting are consumed together
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ChardevGPIO(GPIOBackend):
+    """
+    Edge events from /dev/gpiochipN. The kernel timestamps every edge as it
+    happens, so the returned time is when the pin moved rather than when
+    the waiting thread got scheduled. Kernels since 5.7 use CLOCK_MONOTONIC
+    for these, which matches time.monotonic
+
+    line: Line offset on the chip, probably ADXL_INT1_PIN or ADXL_INT2_PIN
+    chip: Path of the GPIO character device
+    edge: RISING_EDGE, FALLING_EDGE or BOTH_EDGES. Use FALLING_EDGE if the
+    interrupt was mapped active low
+    """
+
+    def __init__(
+        self,
+        line: int,
+        chip: str = "/dev/gpiochip0",
+        edge: int = RISING_EDGE,
+        consumer: str = "adxl372",
+    ):
+        request = bytearray(
+            _EVENT_REQUEST.pack(
+                line, GPIOHANDLE_REQUEST_INPUT, edge, consumer.encode()[:31], -1
+            )
+        )
+        chip_fd = os.open(chip, os.O_RDONLY)
+        try:
+            fcntl.ioctl(chip_fd, GPIO_GET_LINEEVENT_IOCTL, request, True)
+        finally:
+            os.close(chip_fd)
+
+        self.fd = _EVENT_REQUEST.unpack(request)[4]
+        self.line = line
+        self._poll = select.poll()
+        self._poll.register(self.fd, select.POLLIN | select.POLLPRI)
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def read_events(self):
+        data = os.read(self.fd, _EVENT_DATA.size * 16)
+        timestamp, _ = _EVENT_DATA.unpack_from(data, len(data) - _EVENT_DATA.size)
+        return timestamp / 1e9
+
+    def wait(self, timeout: float = None):
+        ms = None if timeout is None else max(int(timeout * 1000), 0)
+        if not self._poll.poll(ms):
+            return None
+        return self.read_events()
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class FakeGPIO(GPIOBackend):
+    """
+    Software stand-in for a GPIO line, backed by a pipe so it can be waited
+    on exactly like the real thing. Call trigger() from a test or simulator
+    to deliver an edge
+    """
+
+    def __init__(self):
+        self._rfd, self._wfd = os.pipe()
+        os.set_blocking(self._rfd, False)
+        self._poll = select.poll()
+        self._poll.register(self._rfd, select.POLLIN)
+
+    def fileno(self) -> int:
+        return self._rfd
+
+    def trigger(self, timestamp: float = None):
+        """
+        Deliver an edge stamped with timestamp, or the current monotonic time
+        """
+        if timestamp is None:
+            timestamp = monotonic()
+        os.write(self._wfd, struct.pack("=d", timestamp))
+
+    def read_events(self):
+        data = os.read(self._rfd, 8 * 64)
+        return struct.unpack_from("=d", data, len(data) - 8)[0]
+
+    def wait(self, timeout: float = None):
+        ms = None if timeout is None else max(int(timeout * 1000), 0)
+        if not self._poll.poll(ms):
+            return None
+        return self.read_events()
+
+    def close(self):
+        for fd in (self._rfd, self._wfd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
@@ -0,0 +1,195 @@
+import numpy as np
+
+from time import monotonic, sleep
+from dataclasses import dataclass
+
+from adxl372 import (
+    ODR_HZ,
+    FIFO_FORMAT_AXES,
+    OP_MODES,
+    FIFOMode,
+    FIFOFormat,
+    Interrupt,
+    Sample,
+    SampleBatch,
+)
+from defs import *
+
+
+@dataclass
+class ImpactEvent:
+    """
+    One captured shock
+
+    time: Host monotonic time of the trigger
+    waveform: The samples around the trigger, timestamped
+    trigger: Index in waveform of the first sample after the trigger
+    peak: Highest reading per axis from the MAXPEAK registers, in counts
+    """
+
+    time: float
+    waveform: SampleBatch
+    trigger: int
+    peak: Sample
+
+    @property
+    def peak_g(self) -> Sample:
+        return self.peak * ADXL372_SCALEG
+
+    @property
+    def pre_trigger(self) -> SampleBatch:
+        return self.waveform[: self.trigger]
+
+    @property
+    def post_trigger(self) -> SampleBatch:
+        return self.waveform[self.trigger :]
+
+
+class ImpactMonitor:
+    """
+    Captures shocks with the FIFO in TRIGGERED mode so the host does
+    nothing between events. The FIFO keeps the last pre_trigger samples
+    until activity detection fires, then fills up with what follows and
+    stops. If ACT is mapped to an attached interrupt line the host sleeps
+    on the edge, otherwise STATUS_1 is polled every poll_interval for the
+    FIFO filling. Once the FIFO is full it is drained in one pass along
+    with the MAXPEAK registers, the activity status is cleared and the
+    FIFO is re-armed
+
+        monitor = ImpactMonitor(dev, threshold_mg=20000, pre_trigger=32)
+        monitor.arm()
+        for event in monitor:
+            print(event.time, event.peak_g)
+
+    dev: ADXL372 to use, it is reconfigured by arm()
+    threshold_mg: Activity threshold that triggers a capture, in mg
+    pre_trigger: Sample sets kept from before the trigger
+    act_time_ms: How long the threshold has to be exceeded, see set_activity_time
+    qformat: FIFO format, XYZ_PEAK_FIFO stores the peak of each event instead of every sample
+    referenced: Use referenced rather than absolute activity detection
+    pin: Interrupt pin ACT is mapped to
+    active_low: Polarity of that pin, None keeps the one it was mapped with
+    poll_interval: Seconds between status reads without an interrupt line
+    """
+
+    def __init__(
+        self,
+        dev,
+        threshold_mg: int,
+        pre_trigger: int = 32,
+        act_time_ms: float = 0,
+        qformat: FIFOFormat = FIFOFormat.XYZ_FIFO,
+        referenced: bool = False,
+        pin: int = 1,
+        active_low: bool = None,
+        poll_interval: float = 0.05,
+    ):
+        self.dev = dev
+        self.threshold_mg = threshold_mg
+        self.pre_trigger = pre_trigger
+        self.act_time_ms = act_time_ms
+        self.qformat = qformat
+        self.referenced = referenced
+        self.pin = pin
+        self.active_low = dev.int_active_low[pin] if active_low is None else active_low
+        self.poll_interval = poll_interval
+        self.events = 0
+
+    @property
+    def capacity(self) -> int:
+        """
+        Sample sets held by the FIFO in the configured format
+        """
+        return FIFO_MAX_ENTRIES // len(FIFO_FORMAT_AXES[self.qformat])
+
+    def arm(self):
+        """
+        Configure activity detection, the trigger mapping and the FIFO in one
+        batch and start measuring
+        """
+        dev = self.dev
+        with dev.configure():
+            dev.set_op_mode(OP_MODES.STAND_BY)
+            dev.set_activity_threshold(
+                self.threshold_mg, self.referenced, True, ADI_ADXL372_X_THRESH_ACT_H
+            )
+            dev.set_activity_time(self.act_time_ms)
+            dev.map_interrupts(self.pin, dev.int_map[self.pin] | Interrupt.ACT, self.active_low)
+            dev.configure_fifo(self.pre_trigger, FIFOMode.TRIGGERED, self.qformat)
+        self._clear()
+
+    def rearm(self):
+        """
+        Empty the FIFO and wait for the next trigger. Leaving TRIGGERED mode
+        and coming back is what clears the trigger, so this is two writes of
+        FIFO_CTL in standby rather than a full configure_fifo
+        """
+        dev = self.dev
+        with dev.lock:
+            op_mode = dev.op_mode
+            dev.set_op_mode(OP_MODES.STAND_BY)
+            dev.update(ADI_ADXL372_FIFO_CTL, FIFO_CRL_MODE_MASK, FIFO_CRL_MODE_POS, FIFOMode.BYPASSED)
+            dev.update(ADI_ADXL372_FIFO_CTL, FIFO_CRL_MODE_MASK, FIFO_CRL_MODE_POS, FIFOMode.TRIGGERED)
+            dev.set_op_mode(op_mode)
+        self._clear()
+
+    def _clear(self):
+        # ACT latches in STATUS_2 and holds the pin until read, so the next
+        # event would not make an edge
+        self.dev.get_activity_status()
+        self.dev.get_status()
+
+    def _wait_full(self, timeout):
+        dev = self.dev
+        end = None if timeout is None else monotonic() + timeout
+        while not dev.get_status() & FIFO_FULL:
+            if end is not None and monotonic() >= end:
+                return False
+            sleep(self.poll_interval)
+        return True
+
+    def wait(self, timeout: float = None) -> ImpactEvent:
+        """
+        Sleep until an impact has been captured and return it, re-arming the
+        FIFO for the next one. Returns None if timeout passes first
+        """
+        dev = self.dev
+        period = 1.0 / ODR_HZ[dev.odr]
+        post = self.capacity - self.pre_trigger
+        gpio = dev.interrupt_gpio(Interrupt.ACT)
+
+        trigger_time = None
+        if gpio is not None:
+            trigger_time = gpio.wait(timeout)
+            if trigger_time is None:
+                return None
+            # the rest of the window is still being recorded
+            sleep(post * period)
+            if not self._wait_full(max(4 * post * period, 1.0)):
+                # an edge without a capture, e.g. left over from before arm()
+                self._clear()
+                return None
+        elif not self._wait_full(timeout):
+            return None
+
+        with dev.lock:
+            data = dev.read_fifo()
+            peak = dev.get_highest_peak_accel_data()
+        now = monotonic()
+        n = len(data)
+        trigger = min(self.pre_trigger, n)
+        if trigger_time is None:
+            # polling only knows the FIFO was full by now
+            trigger_time = now - (n - trigger) * period
+        timestamps = trigger_time + (np.arange(n) - trigger) * period
+
+        self.rearm()
+        self.events += 1
+        waveform = SampleBatch(data, timestamps, FIFO_FORMAT_AXES[self.qformat])
+        return ImpactEvent(trigger_time, waveform, trigger, peak)
+
+    def __iter__(self):
+        while True:
+            event = self.wait()
+            if event is not None:
+                yield event
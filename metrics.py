@@ -0,0 +1,221 @@
+"""
+Hot path instrumentation
+
+enable_metrics() puts an InstrumentedTransport between the driver and its
+bus and hands the driver a Metrics object, so every transfer is counted per
+register and timed, and the drain, decode and polling paths report into
+it. While metrics are off the driver's only cost is one attribute check
+in those paths
+
+    metrics = dev.enable_metrics()
+    ...
+    print(metrics.snapshot())
+    open("/var/lib/node_exporter/adxl372.prom", "w").write(metrics.prometheus())
+"""
+import threading
+
+from bisect import bisect_left
+
+import defs
+from defs import *
+from spi import CountingTransport, Transport
+
+
+# register address to name, for labels
+REGISTER_NAMES = {
+    val: name[len("ADI_ADXL372_") :]
+    for name, val in vars(defs).items()
+    if name.startswith("ADI_ADXL372_") and not name.endswith("_VAL")
+}
+
+# upper bounds of the histogram buckets
+TRANSFER_BUCKETS = (10e-6, 25e-6, 50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 2.5e-3, 5e-3, 10e-3)
+DECODE_BUCKETS = (1e-6, 5e-6, 10e-6, 25e-6, 50e-6, 100e-6, 250e-6, 1e-3)
+FILL_BUCKETS = (16, 32, 64, 128, 192, 256, 320, 384, 448, 511)
+
+
+class Histogram:
+    """
+    Counts of observations per bucket with their sum, as Prometheus
+    histograms keep them
+
+    bounds: Increasing upper bounds of the buckets, one more bucket holds
+    everything above the last
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        return {
+            "buckets": dict(zip((*self.bounds, float("inf")), self.counts)),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+    def prometheus(self, name: str, labels: str) -> list:
+        lines = []
+        total = 0
+        for bound, count in zip((*self.bounds, "+Inf"), self.counts):
+            total += count
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, labels, bound, total))
+        lines.append("%s_sum{%s} %r" % (name, labels.rstrip(","), self.sum))
+        lines.append("%s_count{%s} %d" % (name, labels.rstrip(","), self.count))
+        return lines
+
+
+class Metrics:
+    """
+    Counters for one device
+
+    registers: {register: [reads, writes, bytes]} of transfers starting there
+    transfer_seconds: Time spent in each bus transfer
+    status_spins: Polls in get_accel_data that found no new sample
+    fifo_fill: FIFO entries found at each drain
+    overruns: Drains that found FIFO_OVR set
+    dropped: Samples the stream timebases found missing
+    lapped: Samples a slow consumer missed because the ring buffer wrapped
+    decode_seconds: Time spent decoding each FIFO drain
+    """
+
+    def __init__(self, device: str = ""):
+        self.device = device
+        self.lock = threading.Lock()
+        self.transfer_seconds = Histogram(TRANSFER_BUCKETS)
+        self.decode_seconds = Histogram(DECODE_BUCKETS)
+        self.fifo_fill = Histogram(FILL_BUCKETS)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.registers = {}
+            self.status_spins = 0
+            self.overruns = 0
+            self.dropped = 0
+            self.lapped = 0
+            for hist in (self.transfer_seconds, self.decode_seconds, self.fifo_fill):
+                hist.reset()
+
+    def transfer(self, cmd: int, nbytes: int, seconds: float):
+        with self.lock:
+            counts = self.registers.get(cmd >> 1)
+            if counts is None:
+                counts = self.registers[cmd >> 1] = [0, 0, 0]
+            counts[0 if cmd & ADXL_SPI_RNW else 1] += 1
+            counts[2] += nbytes
+            self.transfer_seconds.observe(seconds)
+
+    def drain(self, entries: int, status: int):
+        with self.lock:
+            self.fifo_fill.observe(entries)
+            if status & FIFO_OVR:
+                self.overruns += 1
+
+    def decoded(self, seconds: float):
+        with self.lock:
+            self.decode_seconds.observe(seconds)
+
+    def spin(self):
+        with self.lock:
+            self.status_spins += 1
+
+    def gap(self, dropped: int):
+        with self.lock:
+            self.dropped += dropped
+
+    def lap(self, missed: int):
+        with self.lock:
+            self.lapped += missed
+
+    def snapshot(self) -> dict:
+        """
+        All counters as plain data, register keys as names
+        """
+        with self.lock:
+            registers = {
+                REGISTER_NAMES.get(reg, hex(reg)): {"reads": r, "writes": w, "bytes": b}
+                for reg, (r, w, b) in sorted(self.registers.items())
+            }
+            return {
+                "device": self.device,
+                "transactions": sum(r + w for r, w, _ in self.registers.values()),
+                "bytes": sum(b for _, _, b in self.registers.values()),
+                "registers": registers,
+                "transfer_seconds": self.transfer_seconds.snapshot(),
+                "status_spins": self.status_spins,
+                "fifo_fill": self.fifo_fill.snapshot(),
+                "overruns": self.overruns,
+                "dropped": self.dropped,
+                "lapped": self.lapped,
+                "decode_seconds": self.decode_seconds.snapshot(),
+            }
+
+    def prometheus(self, prefix: str = "adxl372") -> str:
+        """
+        The counters in the Prometheus text exposition format, labelled with
+        the device
+        """
+        device = 'device="%s",' % self.device
+        lines = []
+
+        def metric(name, kind, help):
+            lines.append("# HELP %s_%s %s" % (prefix, name, help))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+
+        with self.lock:
+            metric("spi_transactions_total", "counter", "SPI transfers by starting register and direction")
+            for reg, (reads, writes, _) in sorted(self.registers.items()):
+                name = REGISTER_NAMES.get(reg, hex(reg))
+                for direction, count in (("read", reads), ("write", writes)):
+                    if count:
+                        lines.append(
+                            '%s_spi_transactions_total{%sregister="%s",direction="%s"} %d'
+                            % (prefix, device, name, direction, count)
+                        )
+            metric("spi_bytes_total", "counter", "Bytes clocked by starting register")
+            for reg, (_, _, nbytes) in sorted(self.registers.items()):
+                lines.append(
+                    '%s_spi_bytes_total{%sregister="%s"} %d'
+                    % (prefix, device, REGISTER_NAMES.get(reg, hex(reg)), nbytes)
+                )
+            metric("spi_transfer_seconds", "histogram", "Duration of each SPI transfer")
+            lines += self.transfer_seconds.prometheus(prefix + "_spi_transfer_seconds", device)
+            metric("fifo_fill_entries", "histogram", "FIFO entries found at each drain")
+            lines += self.fifo_fill.prometheus(prefix + "_fifo_fill_entries", device)
+            metric("decode_seconds", "histogram", "Time spent decoding each FIFO drain")
+            lines += self.decode_seconds.prometheus(prefix + "_decode_seconds", device)
+            for name, help, value in (
+                ("status_spins_total", "Status polls that found no new sample", self.status_spins),
+                ("fifo_overruns_total", "Drains that found the FIFO overrun", self.overruns),
+                ("dropped_samples_total", "Samples missing from the stream", self.dropped),
+                ("lapped_samples_total", "Samples a consumer missed to the ring buffer wrapping", self.lapped),
+            ):
+                metric(name, "counter", help)
+                lines.append("%s_%s{%s} %d" % (prefix, name, device.rstrip(","), value))
+        return "\n".join(lines) + "\n"
+
+
+class InstrumentedTransport(CountingTransport):
+    """
+    CountingTransport that also reports every transfer to a Metrics object,
+    by the register it starts at, its direction, size and duration
+    """
+
+    def __init__(self, transport: Transport, metrics: Metrics):
+        super().__init__(transport)
+        self.metrics = metrics
+
+    def _count(self, cmd: int, nbytes: int, seconds: float):
+        super()._count(cmd, nbytes, seconds)
+        self.metrics.transfer(cmd, nbytes, seconds)
@@ -0,0 +1,200 @@
+import numpy as np
+
+from time import monotonic, sleep
+
+from adxl372 import (
+    ODR_HZ,
+    FIFO_FORMAT_AXES,
+    OP_MODES,
+    WUR,
+    ActivityMode,
+    FIFOMode,
+    Interrupt,
+    InstantOnThresh,
+    SampleBatch,
+)
+from defs import *
+from timebase import Timebase
+
+
+# length of the power down phase of each wake up rate
+WUR_SECONDS = {
+    WUR.WUR_52ms: 0.052,
+    WUR.WUR_104ms: 0.104,
+    WUR.WUR_208ms: 0.208,
+    WUR.WUR_512ms: 0.512,
+    WUR.WUR_2048ms: 2.048,
+    WUR.WUR_4096ms: 4.096,
+    WUR.WUR_8192ms: 8.192,
+    WUR.WUR_24576ms: 24.576,
+}
+
+
+class PowerMonitor:
+    """
+    Duty cycled acquisition for battery powered nodes. The device is left in
+    WAKE_UP mode, or INSTANT_ON, with autosleep and looped activity
+    processing so it switches itself between its low power mode and full
+    measurement: activity wakes it and inactivity puts it back to sleep. The
+    host follows the AWAKE status bit. While the device sleeps the host
+    sleeps on the AWAKE edge of the interrupt pin, or checks STATUS_1 once
+    per wake up period without one. While it is awake the FIFO is drained
+    as in Stream and the batches are yielded from run(), and since every
+    drain reads STATUS_1 anyway falling asleep is noticed for free. The
+    time spent in each state is kept in times
+
+        monitor = PowerMonitor(dev, act_threshold_mg=1500, inact_threshold_mg=500, inact_time_ms=2000)
+        monitor.arm()
+        for batch in monitor.run():
+            ...
+        print(monitor.report())
+
+    dev: ADXL372 to use, it is reconfigured by arm()
+    act_threshold_mg: Activity threshold that wakes the device, in mg
+    inact_threshold_mg: Level every axis has to stay under to count as inactive, in mg
+    inact_time_ms: How long the device has to be inactive before it sleeps
+    act_time_ms: How long the activity threshold has to be exceeded
+    wakeup_rate: How often the device samples while asleep
+    instant_on: Sleep in INSTANT_ON mode with this threshold instead of
+    WAKE_UP with the activity threshold
+    watermark: FIFO watermark in sample sets while awake
+    pin: Interrupt pin AWAKE is mapped to
+    active_low: Polarity of that pin, None keeps the one it was mapped with
+    """
+
+    def __init__(
+        self,
+        dev,
+        act_threshold_mg: int,
+        inact_threshold_mg: int,
+        inact_time_ms: int,
+        act_time_ms: float = 0,
+        wakeup_rate: WUR = WUR.WUR_104ms,
+        instant_on: InstantOnThresh = None,
+        watermark: int = 64,
+        pin: int = 1,
+        active_low: bool = None,
+    ):
+        self.dev = dev
+        self.act_threshold_mg = act_threshold_mg
+        self.inact_threshold_mg = inact_threshold_mg
+        self.inact_time_ms = inact_time_ms
+        self.act_time_ms = act_time_ms
+        self.wakeup_rate = wakeup_rate
+        self.instant_on = instant_on
+        self.watermark = watermark
+        self.pin = pin
+        self.active_low = dev.int_active_low[pin] if active_low is None else active_low
+
+        self.times = {"asleep": 0.0, "awake": 0.0}
+        self.wakeups = 0
+        self.state = None
+        self._since = None
+
+    def arm(self):
+        """
+        Configure thresholds, timers, autosleep, the FIFO and the AWAKE
+        mapping in one batch and drop the device into its low power mode
+        """
+        dev = self.dev
+        with dev.configure():
+            dev.set_op_mode(OP_MODES.STAND_BY)
+            dev.set_activity_threshold(
+                self.act_threshold_mg, True, True, ADI_ADXL372_X_THRESH_ACT_H
+            )
+            dev.set_activity_threshold(
+                self.inact_threshold_mg, True, True, ADI_ADXL372_X_THRESH_INACT_H
+            )
+            dev.set_activity_time(self.act_time_ms)
+            dev.set_inactivity_time(self.inact_time_ms)
+            dev.set_activity_processing_mode(ActivityMode.LOOPED)
+            dev.set_autosleep(True)
+            dev.set_wakeup_rate(self.wakeup_rate)
+            if self.instant_on is not None:
+                dev.set_instant_on_thresh(self.instant_on)
+            dev.map_interrupts(self.pin, dev.int_map[self.pin] | Interrupt.AWAKE, self.active_low)
+            dev.configure_fifo(self.watermark, FIFOMode.STREAMED, dev.fifo_format)
+            dev.set_op_mode(OP_MODES.INSTANT_ON if self.instant_on is not None else OP_MODES.WAKE_UP)
+        self._enter("asleep")
+
+    def _enter(self, state):
+        now = monotonic()
+        if self.state is not None:
+            self.times[self.state] += now - self._since
+        if state == "awake":
+            self.wakeups += 1
+        self.state, self._since = state, now
+
+    def report(self) -> dict:
+        """
+        Seconds spent asleep and awake so far, the number of wake ups and the
+        fraction of the time awake
+        """
+        times = dict(self.times)
+        if self.state is not None:
+            times[self.state] += monotonic() - self._since
+        total = sum(times.values())
+        return {
+            **times,
+            "wakeups": self.wakeups,
+            "duty_cycle": times["awake"] / total if total else 0.0,
+        }
+
+    def _wait_awake(self, timeout):
+        dev = self.dev
+        gpio = dev.interrupt_gpio(Interrupt.AWAKE)
+        end = None if timeout is None else monotonic() + timeout
+        # an edge may have come before we started waiting
+        while not dev.get_status() & AWAKE:
+            left = None if end is None else end - monotonic()
+            if left is not None and left <= 0:
+                return False
+            # check again every wake up period, in case the edge was missed
+            wait = WUR_SECONDS[self.wakeup_rate]
+            if left is not None:
+                wait = min(wait, left)
+            if gpio is not None:
+                gpio.wait(wait)
+            else:
+                sleep(wait)
+        return True
+
+    def run(self, timeout: float = None):
+        """
+        Generator of SampleBatches taken while the device is awake. Blocks
+        while it sleeps, the first batch after each wake up has dropped set
+        to the sample periods spent asleep so pipelines treat it as a gap.
+        Stops after timeout seconds asleep, or never if timeout is None
+        """
+        dev = self.dev
+        axes = FIFO_FORMAT_AXES[dev.fifo_format]
+        rate = ODR_HZ[dev.odr]
+        interval = max(dev.fifo_sets, 1) / rate / 2
+        gpio = dev.interrupt_gpio(Interrupt.FIFO_RDY)
+        out = np.empty((FIFO_MAX_ENTRIES // len(axes), len(axes)), dtype=np.int16)
+        timestamps = np.empty(len(out), dtype=np.float64)
+        timebase = Timebase(rate)
+
+        while True:
+            asleep_at = monotonic()
+            if not self._wait_awake(timeout):
+                return
+            self._enter("awake")
+            timebase.reset()
+            slept = int((monotonic() - asleep_at) * rate)
+
+            awake = True
+            while awake:
+                batch, _, dropped, overrun = timebase.drain(dev, out, timestamps)
+                awake = bool(dev.fifo_status & AWAKE)
+                n = len(batch)
+                if n:
+                    yield SampleBatch(batch.copy(), timestamps[:n].copy(), axes, dropped + slept, overrun)
+                    slept = 0
+                if not awake:
+                    break
+                if gpio is not None:
+                    gpio.wait(8 * interval)
+                else:
+                    sleep(interval)
+            self._enter("asleep")
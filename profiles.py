@@ -0,0 +1,274 @@
+"""
+Declarative device configuration
+
+A Profile lists the settings a sensor should run with, any left as None
+are left alone. Profiles load from and save to JSON, with enums written by
+name
+
+    {
+        "odr": "ODR_3200Hz",
+        "bandwidth": "BW_1600Hz",
+        "act": {"mg": 1500},
+        "fifo_samples": 64,
+        "fifo_mode": "STREAMED",
+        "int1": ["FIFO_RDY", "ACT"],
+        "op_mode": "FULL_BW_MEASUREMENT"
+    }
+
+apply() reseeds the shadow map from the device, runs the setters inside a
+configure() block and so only writes the registers whose contents differ,
+as bursts, going through standby only if FIFO or timing registers change.
+A service restarting against a sensor that is still configured sends
+nothing at all
+
+    dev = ADXL372(0, 0)
+    apply(dev, load("sensor.json"))
+"""
+import json
+
+from dataclasses import dataclass, fields
+
+from adxl372 import (
+    OP_MODES,
+    ODR,
+    BW,
+    WUR,
+    ActivityMode,
+    FIFOFormat,
+    FIFOMode,
+    Interrupt,
+    InstantOnThresh,
+    FilterSettle,
+)
+from defs import *
+
+
+@dataclass
+class Threshold:
+    """
+    Activity threshold, applied to all three axes
+
+    mg: Threshold in mg, 100 mg per code
+    referenced: Referenced rather than absolute detection
+    enabled: Use the axes for detection
+    """
+
+    mg: int
+    referenced: bool = False
+    enabled: bool = True
+
+
+# enum type of each field that holds one
+_ENUMS = {
+    "op_mode": OP_MODES,
+    "odr": ODR,
+    "bandwidth": BW,
+    "wakeup_rate": WUR,
+    "activity_mode": ActivityMode,
+    "filter_settle": FilterSettle,
+    "instant_on_thresh": InstantOnThresh,
+    "fifo_mode": FIFOMode,
+    "fifo_format": FIFOFormat,
+}
+_THRESHOLDS = {
+    "act": ADI_ADXL372_X_THRESH_ACT_H,
+    "act2": ADI_ADXL372_X_THRESH_ACT2_H,
+    "inact": ADI_ADXL372_X_THRESH_INACT_H,
+}
+_INTERRUPTS = ("int1", "int2")
+
+
+@dataclass
+class Profile:
+    """
+    Settings for one device, None leaves a setting as it is. The fields
+    follow the setters of ADXL372
+
+    op_mode: Mode to finish in, defaults to the mode the device was in
+    act, act2, inact: Threshold for each detector
+    fifo_samples: FIFO watermark in sample sets, as in configure_fifo
+    int1, int2: Interrupt sources mapped to each pin
+    """
+
+    op_mode: OP_MODES = None
+    odr: ODR = None
+    bandwidth: BW = None
+    autosleep: bool = None
+    wakeup_rate: WUR = None
+    activity_mode: ActivityMode = None
+    filter_settle: FilterSettle = None
+    instant_on_thresh: InstantOnThresh = None
+    high_pass_filter: bool = None
+    act: Threshold = None
+    act2: Threshold = None
+    inact: Threshold = None
+    act_time_ms: float = None
+    inact_time_ms: float = None
+    fifo_samples: int = None
+    fifo_mode: FIFOMode = None
+    fifo_format: FIFOFormat = None
+    int1: Interrupt = None
+    int2: Interrupt = None
+    int1_active_low: bool = None
+    int2_active_low: bool = None
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Profile":
+        """
+        Build a profile from a dict as found in a JSON file. Enums are given
+        by name, interrupts as a list of names. Unknown keys raise
+        ValueError rather than being silently ignored
+        """
+        known = {f.name for f in fields(cls)}
+        unknown = set(d) - known
+        if unknown:
+            raise ValueError("unknown profile settings: %s" % ", ".join(sorted(unknown)))
+        kwargs = {}
+        for name, val in d.items():
+            if val is None:
+                pass
+            elif name in _ENUMS:
+                enum = _ENUMS[name]
+                val = enum[val] if isinstance(val, str) else enum(val)
+            elif name in _THRESHOLDS:
+                val = Threshold(**val) if isinstance(val, dict) else Threshold(val)
+            elif name in _INTERRUPTS:
+                events = Interrupt(0)
+                for event in val:
+                    events |= Interrupt[event]
+                val = events
+            kwargs[name] = val
+        return cls(**kwargs)
+
+    def to_dict(self) -> dict:
+        """
+        The settings that are set, in the form from_dict takes
+        """
+        d = {}
+        for f in fields(self):
+            val = getattr(self, f.name)
+            if val is None:
+                continue
+            if f.name in _ENUMS:
+                val = val.name
+            elif f.name in _THRESHOLDS:
+                val = {"mg": val.mg, "referenced": val.referenced, "enabled": val.enabled}
+            elif f.name in _INTERRUPTS:
+                val = [event.name for event in Interrupt if event & val]
+            d[f.name] = val
+        return d
+
+
+def _threshold(dev, reg) -> Threshold:
+    high, low = dev.shadowed(reg), dev.shadowed(reg + 1)
+    return Threshold(((high << 3) | (low >> 5)) * 100, bool(low & 0x2), bool(low & 0x1))
+
+
+def from_device(dev) -> Profile:
+    """
+    A complete profile of how the device is configured now, according to the
+    shadow map. Call dev.sync() first if it may have been changed elsewhere
+    """
+    return Profile(
+        op_mode=dev.op_mode,
+        odr=dev.odr,
+        bandwidth=dev.bw,
+        autosleep=dev.autosleep,
+        wakeup_rate=dev.wakeup_rate,
+        activity_mode=dev.activity_mode,
+        filter_settle=dev.filter_settle,
+        instant_on_thresh=dev.instant_on_thresh,
+        high_pass_filter=dev.hpf,
+        act_time_ms=dev.act_time_ms,
+        inact_time_ms=dev.inact_time_ms,
+        fifo_samples=dev.fifo_sets,
+        fifo_mode=dev.fifo_mode,
+        fifo_format=dev.fifo_format,
+        int1=dev.int_map[1],
+        int2=dev.int_map[2],
+        int1_active_low=dev.int_active_low[1],
+        int2_active_low=dev.int_active_low[2],
+        **{name: _threshold(dev, reg) for name, reg in _THRESHOLDS.items()},
+    )
+
+
+def apply(dev, profile: Profile, sync: bool = True) -> dict:
+    """
+    Bring the device in line with profile, writing only the registers that
+    differ. Returns {register: (old, new)} for each register written
+
+    sync: Reread the registers from the device first, rather than trusting
+    the shadow map
+    """
+    p = profile
+    with dev.lock:
+        if sync:
+            dev.sync()
+        before = bytes(dev.shadow)
+        op_mode = p.op_mode if p.op_mode is not None else dev.op_mode
+
+        with dev.configure():
+            dev.set_op_mode(OP_MODES.STAND_BY)
+            # the timers count in periods that depend on the ODR, so it goes first
+            if p.odr is not None:
+                dev.set_ODR(p.odr)
+            if p.bandwidth is not None:
+                dev.set_bandwidth(p.bandwidth)
+            if p.autosleep is not None:
+                dev.set_autosleep(p.autosleep)
+            if p.wakeup_rate is not None:
+                dev.set_wakeup_rate(p.wakeup_rate)
+            if p.activity_mode is not None:
+                dev.set_activity_processing_mode(p.activity_mode)
+            if p.filter_settle is not None:
+                dev.set_filter_settle(p.filter_settle)
+            if p.instant_on_thresh is not None:
+                dev.set_instant_on_thresh(p.instant_on_thresh)
+            if p.high_pass_filter is not None:
+                dev.set_high_pass_filter(p.high_pass_filter)
+            for name, reg in _THRESHOLDS.items():
+                thresh = getattr(p, name)
+                if thresh is not None:
+                    dev.set_activity_threshold(thresh.mg, thresh.referenced, thresh.enabled, reg)
+            if p.act_time_ms is not None:
+                dev.set_activity_time(p.act_time_ms)
+            if p.inact_time_ms is not None:
+                dev.set_inactivity_time(p.inact_time_ms)
+            if (p.fifo_samples, p.fifo_mode, p.fifo_format) != (None, None, None):
+                dev.configure_fifo(
+                    p.fifo_samples if p.fifo_samples is not None else dev.fifo_sets,
+                    p.fifo_mode if p.fifo_mode is not None else dev.fifo_mode,
+                    p.fifo_format if p.fifo_format is not None else dev.fifo_format,
+                )
+            for pin in (1, 2):
+                events = getattr(p, "int%d" % pin)
+                active_low = getattr(p, "int%d_active_low" % pin)
+                if events is not None or active_low is not None:
+                    dev.map_interrupts(
+                        pin,
+                        events if events is not None else dev.int_map[pin],
+                        active_low if active_low is not None else dev.int_active_low[pin],
+                    )
+            dev.set_op_mode(op_mode)
+
+        return {
+            SHADOW_FIRST + i: (before[i], dev.shadow[i])
+            for i in range(SHADOW_SIZE)
+            if before[i] != dev.shadow[i]
+        }
+
+
+def load(path) -> Profile:
+    """
+    Read a profile from a JSON file
+    """
+    with open(path) as f:
+        return Profile.from_dict(json.load(f))
+
+
+def save(profile: Profile, path):
+    """
+    Write a profile to a JSON file
+    """
+    with open(path, "w") as f:
+        json.dump(profile.to_dict(), f, indent=2)
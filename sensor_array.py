@@ -0,0 +1,224 @@
+import queue
+import select
+import threading
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+from adxl372 import ODR_HZ, FIFO_FORMAT_AXES, FIFOMode, Interrupt, SampleBatch
+from defs import FIFO_MAX_ENTRIES
+from timebase import Timebase
+
+
+class SensorArray:
+    """
+    Services many ADXL372s at once. Sensors are grouped by SPI bus and each
+    bus gets one worker thread, since transfers on a bus have to take turns
+    but separate buses can run in parallel. A worker visits its sensors
+    round robin and only drains the ones that have reached their watermark,
+    sleeping on their FIFO_RDY lines when every sensor on the bus has one
+    attached. Drained batches are timestamped by a Timebase per sensor and
+    put on the batches queue as (name, SampleBatch), and frames() lines them
+    up in time across sensors. Samples a sensor lost show up as the dropped
+    count on its next batch
+
+    sensors: {name: ADXL372}, or a list of ADXL372 named "spi<major>.<minor>"
+    queue_size: Batches held for the consumer before the oldest are dropped
+    """
+
+    def __init__(self, sensors, queue_size: int = 4096):
+        if not isinstance(sensors, dict):
+            sensors = {"spi%d.%d" % (dev.major, dev.minor): dev for dev in sensors}
+        self.sensors = sensors
+        self.buses = {}
+        for name, dev in sensors.items():
+            self.buses.setdefault(dev.major, []).append(name)
+
+        self.batches = queue.Queue(queue_size)
+        # batches thrown away because the consumer fell behind
+        self.dropped = 0
+        # one worker per bus may be dropping at once
+        self._dropped_lock = threading.Lock()
+        self.errors = {}
+        self._stop = threading.Event()
+        self._workers = []
+
+    def for_each(self, fn) -> dict:
+        """
+        Call fn(name, dev) for every sensor with one thread per bus, so
+        sensors sharing a bus go one after another and buses run in parallel.
+        Returns {name: result}
+        """
+
+        def run_bus(names):
+            return [(name, fn(name, self.sensors[name])) for name in names]
+
+        with ThreadPoolExecutor(max_workers=len(self.buses) or 1) as pool:
+            futures = [pool.submit(run_bus, names) for names in self.buses.values()]
+            results = {}
+            for future in futures:
+                results.update(future.result())
+        return results
+
+    def configure(self, fn):
+        """
+        Apply the same configuration to every sensor. fn(cfg) is called inside
+        each device's configure() block, so its writes go out as bursts
+
+        array.configure(lambda cfg: cfg.set_ODR(ODR.ODR_6400Hz))
+        """
+
+        def apply(name, dev):
+            with dev.configure() as cfg:
+                fn(cfg)
+
+        self.for_each(apply)
+
+    def start(self):
+        """
+        Start one worker per bus. Sensors whose FIFO is bypassed are switched
+        to STREAMED mode first
+        """
+        if self._workers:
+            raise RuntimeError("array already running")
+
+        def stream(name, dev):
+            if dev.fifo_mode == FIFOMode.BYPASSED:
+                dev.configure_fifo(dev.fifo_sets, FIFOMode.STREAMED, dev.fifo_format)
+
+        self.for_each(stream)
+        self._stop.clear()
+        for bus, names in self.buses.items():
+            worker = threading.Thread(target=self._service, args=(bus, names), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        self._stop.set()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def _deliver(self, name, batch):
+        while True:
+            try:
+                self.batches.put_nowait((name, batch))
+                return
+            except queue.Full:
+                # never block acquisition on the consumer, drop the oldest
+                try:
+                    self.batches.get_nowait()
+                    with self._dropped_lock:
+                        self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def _service(self, bus, names):
+        sensors = []
+        for name in names:
+            dev = self.sensors[name]
+            axes = FIFO_FORMAT_AXES[dev.fifo_format]
+            max_sets = FIFO_MAX_ENTRIES // len(axes)
+            sensors.append(
+                (
+                    name,
+                    dev,
+                    axes,
+                    # drain once the watermark is reached, less the sample left behind
+                    max(dev.fifo_sets - 1, 1),
+                    np.empty((max_sets, len(axes)), dtype=np.int16),
+                    np.empty(max_sets, dtype=np.float64),
+                    Timebase(ODR_HZ[dev.odr]),
+                )
+            )
+        # wake at half the shortest watermark period
+        interval = min(
+            max(dev.fifo_sets, 1) / ODR_HZ[dev.odr] / 2 for _, dev, _, _, _, _, _ in sensors
+        )
+
+        gpios = [dev.interrupt_gpio(Interrupt.FIFO_RDY) for _, dev, _, _, _, _, _ in sensors]
+        poller = None
+        if all(gpio is not None for gpio in gpios):
+            poller = select.poll()
+            lines = {gpio.fileno(): gpio for gpio in gpios}
+            for fd in lines:
+                poller.register(fd, select.POLLIN | select.POLLPRI)
+
+        try:
+            while not self._stop.is_set():
+                drained = 0
+                for name, dev, axes, min_sets, out, timestamps, timebase in sensors:
+                    batch, _, dropped, overrun = timebase.drain(dev, out, timestamps, min_sets=min_sets)
+                    n = len(batch)
+                    if not n:
+                        continue
+                    # the consumer keeps the batch past the next drain
+                    self._deliver(
+                        name, SampleBatch(batch.copy(), timestamps[:n].copy(), axes, dropped, overrun)
+                    )
+                    drained += 1
+
+                if drained:
+                    continue
+                if poller is not None:
+                    for fd, _ in poller.poll(8 * interval * 1000):
+                        lines[fd].read_events()
+                else:
+                    self._stop.wait(interval)
+        except Exception as e:
+            self.errors[bus] = e
+
+    def frames(self, period: float, timeout: float = None):
+        """
+        Generator of time-aligned frames built from the batches queue. Each
+        frame is (start, {name: SampleBatch}) holding every sensor's samples
+        with timestamps in [start, start + period). Frames start once every
+        sensor has delivered data, and a frame is only emitted after all
+        sensors have data past its end. A sensor's batch in a frame carries
+        the dropped count of any gap that falls inside the frame. Stops after
+        timeout seconds without a new batch, or never if timeout is None
+
+        period: Length of each frame in seconds
+        """
+        pending = {name: [] for name in self.sensors}
+        start = None
+        while True:
+            try:
+                name, batch = self.batches.get(timeout=timeout)
+            except queue.Empty:
+                return
+            pending[name].append(batch)
+
+            if start is None:
+                if not all(pending.values()):
+                    continue
+                start = max(p[0].timestamps[0] for p in pending.values())
+
+            while all(p and p[-1].timestamps[-1] >= start + period for p in pending.values()):
+                frame = {}
+                for name, batches in pending.items():
+                    data = np.concatenate([b.data for b in batches])
+                    timestamps = np.concatenate([b.timestamps for b in batches])
+                    lo, hi = np.searchsorted(timestamps, [start, start + period])
+                    axes = batches[0].axes
+                    # gaps stay with whichever frame the batch after them starts in
+                    now = [b for b in batches if b.start is None or b.start < start + period]
+                    later = [b for b in batches if b not in now]
+                    frame[name] = SampleBatch(
+                        data[lo:hi],
+                        timestamps[lo:hi],
+                        axes,
+                        sum(b.dropped for b in now),
+                        any(b.overrun for b in now),
+                    )
+                    pending[name] = [
+                        SampleBatch(
+                            data[hi:],
+                            timestamps[hi:],
+                            axes,
+                            sum(b.dropped for b in later),
+                            any(b.overrun for b in later),
+                        )
+                    ]
+                yield start, frame
+                start += period
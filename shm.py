@@ -0,0 +1,319 @@
+"""
+Sharing a stream with other processes
+
+Only one process can own the bus, so the acquiring process streams into a
+SharedRing, a RingBuffer laid out in a multiprocessing.shared_memory
+segment, and any number of Subscribers in other processes attach to it by
+name and read numpy views straight out of the segment. The samples are
+written once however many subscribers there are, and the writer never
+waits for any of them: a subscriber that falls more than the capacity
+behind skips ahead and counts what it missed
+
+    # acquiring process
+    stream = dev.start_stream(capacity=1 << 16, publish="adxl372-spi0.0")
+
+    # any other process
+    sub = Subscriber("adxl372-spi0.0")
+    for batch in sub:
+        ...
+
+The segment starts with a header holding the ODR, FIFO format and scale
+factors, then a table of the most recent gaps, then the samples and
+timestamps mirrored as in RingBuffer. Two sequence numbers in the header
+order the writes: reserved moves past a batch before any of it is written
+and head once all of it is, so a reader knows which samples may be in the
+middle of being overwritten
+"""
+import threading
+import numpy as np
+
+from time import monotonic, sleep
+from multiprocessing import shared_memory
+
+from adxl372 import FIFO_FORMAT_AXES, FIFOFormat, SampleBatch
+from defs import *
+from stream import RingBuffer, RingReader, split_gaps
+
+
+MAGIC = b"ADXLSHM1"
+HEADER = np.dtype(
+    [
+        ("magic", "S8"),
+        ("capacity", "<u4"),
+        ("axes", "<u4"),
+        ("fifo_format", "<u4"),
+        ("gap_slots", "<u4"),
+        ("odr_hz", "<f8"),
+        ("scale_g", "<f8"),
+        ("scale_ms2", "<f8"),
+        # samples ever written, and written or being written
+        ("head", "<u8"),
+        ("reserved", "<u8"),
+        ("gap_count", "<u8"),
+        # set once the publisher stops
+        ("closed", "<u8"),
+    ]
+)
+GAP = np.dtype([("position", "<u8"), ("dropped", "<u4"), ("overrun", "<u4")])
+
+
+def _layout(capacity: int, axes: int, gap_slots: int):
+    # offsets of the gap table, samples and timestamps, and the total size
+    gaps = -(-HEADER.itemsize // 8) * 8
+    data = gaps + gap_slots * GAP.itemsize
+    timestamps = data + -(-2 * capacity * axes * 2 // 8) * 8
+    return gaps, data, timestamps, timestamps + 2 * capacity * 8
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        pass
+    # before 3.13 attaching registers the segment with the resource tracker,
+    # which would unlink it from under the publisher when this process exits
+    from multiprocessing import resource_tracker
+
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name)
+    finally:
+        resource_tracker.register = register
+
+
+class GapTable:
+    """
+    The newest (ring position, dropped, overrun) gaps kept in the shared
+    segment, used by Stream in place of its deque
+    """
+
+    def __init__(self, header, table):
+        self.header = header
+        self.table = table
+
+    def append(self, gap):
+        position, dropped, overrun = gap
+        count = int(self.header["gap_count"])
+        self.table[count % len(self.table)] = (position, dropped, overrun)
+        self.header["gap_count"] = count + 1
+
+    def __len__(self):
+        return min(int(self.header["gap_count"]), len(self.table))
+
+    def __iter__(self):
+        count = int(self.header["gap_count"])
+        for i in range(max(count - len(self.table), 0), count):
+            position, dropped, overrun = self.table[i % len(self.table)]
+            yield int(position), int(dropped), bool(overrun)
+
+
+class SharedRing(RingBuffer):
+    """
+    RingBuffer in a named shared memory segment. The acquiring process
+    creates it with create() and writes to it as to any RingBuffer,
+    other processes open it with attach() and only read. Readers in other
+    processes can't be woken by the writer, so wait() polls head, and see
+    the ring closed through a flag in the header
+
+    shm: The SharedMemory holding the ring
+    owner: This process created the segment and unlinks it on close()
+    poll_interval: Seconds between checks of head in wait()
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool = False, poll_interval: float = 0.001):
+        header = np.ndarray((), HEADER, shm.buf)
+        if bytes(header["magic"]) != MAGIC:
+            raise ValueError("%s is not an ADXL372 shared ring" % shm.name)
+        capacity, axes, gap_slots = int(header["capacity"]), int(header["axes"]), int(header["gap_slots"])
+        gaps, data, timestamps, _ = _layout(capacity, axes, gap_slots)
+
+        self.shm = shm
+        self.owner = owner
+        self.poll_interval = poll_interval
+        self.header = header
+        self.capacity = capacity
+        self.axes = axes
+        self.gaps = GapTable(header, np.ndarray((gap_slots,), GAP, shm.buf, gaps))
+        self.data = np.ndarray((2 * capacity, axes), np.int16, shm.buf, data)
+        self.timestamps = np.ndarray((2 * capacity,), np.float64, shm.buf, timestamps)
+        self._new_data = threading.Condition()
+
+    @classmethod
+    def create(
+        cls,
+        name: str,
+        capacity: int,
+        qformat: FIFOFormat = FIFOFormat.XYZ_FIFO,
+        odr_hz: float = 0.0,
+        gap_slots: int = 1024,
+    ) -> "SharedRing":
+        """
+        Create the segment for a new ring
+
+        name: Name other processes attach with
+        capacity: Sample sets held
+        qformat: FIFO format of the samples, sets the number of axes
+        odr_hz: Sample rate, for subscribers
+        gap_slots: Number of recent gaps kept for subscribers
+        """
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        axes = len(FIFO_FORMAT_AXES[qformat])
+        shm = shared_memory.SharedMemory(name, create=True, size=_layout(capacity, axes, gap_slots)[-1])
+        header = np.ndarray((), HEADER, shm.buf)
+        header[()] = (MAGIC, capacity, axes, qformat, gap_slots, odr_hz, ADXL372_SCALEG, ADXL372_SCALE, 0, 0, 0, 0)
+        del header
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str, poll_interval: float = 0.001) -> "SharedRing":
+        """
+        Open a ring another process created
+        """
+        return cls(_attach(name), poll_interval=poll_interval)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @property
+    def fifo_format(self) -> FIFOFormat:
+        return FIFOFormat(int(self.header["fifo_format"]))
+
+    @property
+    def odr_hz(self) -> float:
+        return float(self.header["odr_hz"])
+
+    @property
+    def head(self) -> int:
+        return int(self.header["head"])
+
+    @head.setter
+    def head(self, value: int):
+        self.header["head"] = value
+
+    @property
+    def closed(self) -> bool:
+        return bool(self.header["closed"])
+
+    @closed.setter
+    def closed(self, value: bool):
+        self.header["closed"] = value
+
+    @property
+    def oldest(self) -> int:
+        # anything a write in progress may be overwriting is already gone
+        return int(self.header["reserved"]) - self.capacity
+
+    def latest(self, n: int):
+        head = self.head
+        n = max(min(n, head - self.oldest, head), 0)
+        return self.window(head - n, head)
+
+    def write(self, samples, timestamps):
+        n = len(samples)
+        if n:
+            self.header["reserved"] = self.head + n
+        super().write(samples, timestamps)
+
+    def wait(self, position: int, timeout: float = None) -> bool:
+        end = None if timeout is None else monotonic() + timeout
+        while self.head <= position:
+            if self.closed or end is not None and monotonic() >= end:
+                return False
+            sleep(self.poll_interval)
+        return True
+
+    def close(self):
+        """
+        If this process created the segment, mark the ring closed so
+        subscribers stop once they have read the rest, and unlink it so no
+        one else can attach. The memory stays mapped until every view of it
+        is gone
+        """
+        if self.owner:
+            self.owner = False
+            super().close()
+            self.shm.unlink()
+
+    def detach(self):
+        """
+        Unmap the segment. Fails quietly while views into it are still held,
+        it is unmapped when they go
+        """
+        self.close()
+        self.header = self.data = self.timestamps = self.gaps = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass
+
+
+class Subscriber:
+    """
+    Reads a stream another process publishes to a SharedRing. Iterating
+    yields SampleBatch views into shared memory of each new run of samples,
+    split at gaps like iterating a Stream. Nothing is copied, so a view is
+    only good until the writer laps it: a consumer that holds on to a batch
+    or takes a long time over one can check with lapped(), or copy it.
+    Samples missed by falling more than the capacity behind are counted in
+    lost and in the dropped count of the next batch
+
+    name: Name the ring was published under
+    timeout: Stop iterating after this many seconds without new data, None
+    only stops once the publisher does
+    poll_interval: Seconds between checks for new data
+    """
+
+    def __init__(self, name: str, timeout: float = None, poll_interval: float = 0.001):
+        self.ring = SharedRing.attach(name, poll_interval)
+        self.axes = FIFO_FORMAT_AXES[self.ring.fifo_format]
+        self.reader = RingReader(self.ring, self.ring.head, timeout)
+
+    @property
+    def odr_hz(self) -> float:
+        return self.ring.odr_hz
+
+    @property
+    def fifo_format(self) -> FIFOFormat:
+        return self.ring.fifo_format
+
+    @property
+    def scale_g(self) -> float:
+        return float(self.ring.header["scale_g"])
+
+    @property
+    def lost(self) -> int:
+        return self.reader.lost
+
+    def latest(self, n: int) -> SampleBatch:
+        """
+        SampleBatch view of the newest n samples
+        """
+        return SampleBatch(*self.ring.latest(n), self.axes)
+
+    def lapped(self, batch: SampleBatch) -> bool:
+        """
+        True if the writer may have overwritten some of batch since it was
+        returned, so its contents can't be trusted. batch has to be from the
+        latest run of samples iterating returned
+        """
+        ring = self.ring
+        offset = (batch.data.ctypes.data - ring.data.ctypes.data) // ring.data.strides[0]
+        # the sample number that lands at offset, counting back from the reader
+        end = self.reader.position
+        start = end - 1 - (end - 1 - offset) % ring.capacity
+        return start < ring.oldest
+
+    def __iter__(self):
+        return split_gaps(self.reader, self.ring.gaps, self.axes)
+
+    def close(self):
+        self.ring.detach()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
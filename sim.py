@@ -0,0 +1,439 @@
+import threading
+import numpy as np
+
+from time import monotonic, sleep
+
+from adxl372 import ODR_HZ, FIFO_FORMAT_AXES, FIFOMode, FIFOFormat
+from defs import *
+from spi import Transport, check_read
+
+
+# Registers that don't come out of reset as zero
+RESET_VALUES = {
+    ADI_ADXL372_ADI_DEVID: ADI_ADXL372_ADI_DEVID_VAL,
+    ADI_ADXL372_MST_DEVID: ADI_ADXL372_MST_DEVID_VAL,
+    ADI_ADXL372_DEVID: ADI_ADXL372_DEVID_VAL,
+    ADI_ADXL372_REVID: ADI_ADXL372_REVID_VAL,
+    ADI_ADXL372_FIFO_SAMPLES: 0x80,
+}
+
+AXIS_INDEX = {"x": 0, "y": 1, "z": 2}
+
+# x msb register of each set of three thresholds
+THRESHOLDS = (ADI_ADXL372_X_THRESH_ACT_H, ADI_ADXL372_X_THRESH_ACT2_H, ADI_ADXL372_X_THRESH_INACT_H)
+
+
+def sine_waveform(freqs=(80.0, 160.0, 320.0), amplitude: float = 2.0, gravity=(0.0, 0.0, 1.0)):
+    """
+    Returns a waveform for SimulatedADXL372 with a sine of the given
+    frequency in Hz and amplitude in g on each axis, on top of gravity
+    """
+    freqs = np.asarray(freqs, dtype=np.float64)
+    gravity = np.asarray(gravity, dtype=np.float64)
+
+    def waveform(t):
+        return amplitude * np.sin(2 * np.pi * t[:, None] * freqs) + gravity
+
+    return waveform
+
+
+class SimulatedADXL372(Transport):
+    """
+    In-process model of an ADXL372 behind the Transport interface, so the
+    driver can run without hardware. It implements the register map with
+    address auto-increment, the device and status registers, FIFO entry
+    counts, every FIFO format and mode, absolute and referenced activity and
+    inactivity detection, the MAXPEAK registers, self-test and soft reset.
+    Samples are generated from waveform at the configured ODR as simulated
+    time passes, whenever the bus is touched, or continuously once start()
+    is called so interrupt lines attached with attach_gpio fire while the
+    host sleeps. In XYZ_PEAK_FIFO mode the FIFO holds ordinary samples
+    rather than peaks
+
+    waveform: Callable taking an array of sample times in seconds and
+    returning an (N, 3) array of acceleration in g, see sine_waveform
+    latency: Seconds added to every transaction
+    speed_hz: If set, every transaction also takes as long as its bytes
+    would on a bus clocked at this rate
+    clock: Time source in seconds, defaults to time.monotonic
+    """
+
+    # how long the device ignores the bus after a soft reset
+    reset_time = 0.0005
+    # how long self-test takes to finish
+    self_test_time = 0.3
+
+    def __init__(self, waveform=None, latency: float = 0.0, speed_hz: int = None, clock=monotonic):
+        self.waveform = waveform if waveform is not None else sine_waveform()
+        self.latency = latency
+        self.speed_hz = speed_hz
+        self.clock = clock
+        self.lock = threading.RLock()
+        # bus traffic since creation
+        self.transactions = 0
+        self.bytes = 0
+        self.gpio = {1: None, 2: None}
+        self._ticker = None
+        self._ticking = threading.Event()
+        self._reset()
+
+    def _reset(self):
+        self.regs = bytearray(ADI_ADXL372_FIFO_DATA + 1)
+        for reg, val in RESET_VALUES.items():
+            self.regs[reg] = val
+        self.fifo = bytearray()
+        self.latest = np.zeros(3, dtype=np.int16)
+        self.peak = np.zeros(3, dtype=np.int16)
+        self.data_rdy = False
+        self.overrun = False
+        self.status2 = 0
+        self.awake = False
+        self.triggered = False
+        self.quiet_samples = 0
+        # referenced detection compares against these, {x msb register: sample}
+        self.refs = {}
+        # time measurement started and samples produced since, None in standby
+        self.started = None
+        self.generated = 0
+        self.busy_until = 0.0
+        self.self_test_started = None
+        self.int_level = {1: False, 2: False}
+
+    @property
+    def op_mode(self) -> int:
+        return self.regs[ADI_ADXL372_POWER_CTL] & (PWRCTRL_OPMODE_MASK ^ 0xFF)
+
+    @property
+    def trim(self) -> np.ndarray:
+        # 4-bit two's complement per axis
+        codes = np.array(self.regs[ADI_ADXL372_OFFSET_X : ADI_ADXL372_OFFSET_Z + 1], dtype=np.int32) & 0xF
+        return np.where(codes > 7, codes - 16, codes)
+
+    @property
+    def odr_hz(self) -> int:
+        return ODR_HZ.get(self.regs[ADI_ADXL372_TIMING] >> TIMING_ODR_POS, 6400)
+
+    @property
+    def fifo_mode(self) -> FIFOMode:
+        ctl = self.regs[ADI_ADXL372_FIFO_CTL]
+        return FIFOMode((ctl & (FIFO_CRL_MODE_MASK ^ 0xFF)) >> FIFO_CRL_MODE_POS)
+
+    @property
+    def fifo_format(self) -> FIFOFormat:
+        ctl = self.regs[ADI_ADXL372_FIFO_CTL]
+        return FIFOFormat((ctl & (FIFO_CRL_FORMAT_MASK ^ 0xFF)) >> FIFO_CRL_FORMAT_POS)
+
+    @property
+    def watermark(self) -> int:
+        samp8 = self.regs[ADI_ADXL372_FIFO_CTL] & (FIFO_CRL_SAMP8_MASK ^ 0xFF)
+        return (samp8 << 8) | self.regs[ADI_ADXL372_FIFO_SAMPLES]
+
+    @property
+    def fifo_entries(self) -> int:
+        return len(self.fifo) // 2
+
+    @property
+    def fifo_capacity(self) -> int:
+        # the FIFO only ever holds whole sample sets
+        set_size = len(FIFO_FORMAT_AXES[self.fifo_format])
+        return FIFO_MAX_ENTRIES // set_size * set_size
+
+    def sample_time(self, behind: int = 0) -> float:
+        """
+        Clock time at which the newest sample, or the one behind samples
+        before it, was produced. Lets benchmarks measure delivery latency
+        """
+        with self.lock:
+            if self.started is None:
+                return None
+            return self.started + (self.generated - 1 - behind) / self.odr_hz
+
+    def attach_gpio(self, pin: int, gpio):
+        """
+        Drive a gpio.FakeGPIO whenever the sources mapped to INT1 or INT2
+        become active. Pair with start() so edges arrive without bus traffic
+        """
+        self.gpio[pin] = gpio
+
+    def start(self, tick: float = 0.001):
+        """
+        Advance simulated time on a background thread every tick seconds
+        """
+        if self._ticker is not None:
+            return
+        self._ticking.clear()
+        self._ticker = threading.Thread(target=self._tick, args=(tick,), daemon=True)
+        self._ticker.start()
+
+    def stop(self):
+        if self._ticker is not None:
+            self._ticking.set()
+            self._ticker.join()
+            self._ticker = None
+
+    def close(self):
+        self.stop()
+
+    def _tick(self, tick):
+        while not self._ticking.wait(tick):
+            with self.lock:
+                self._advance()
+                self._interrupts()
+
+    def _thresholds(self, first):
+        # three (threshold code, enabled) pairs starting at an x msb register
+        out = []
+        for axis in range(3):
+            high = self.regs[first + 2 * axis]
+            low = self.regs[first + 2 * axis + 1]
+            out.append(((high << 3) | (low >> 5), low & 1))
+        return out
+
+    def _referenced(self, first) -> bool:
+        # the REF bit of the x lsb register covers all three axes
+        return bool(self.regs[first + 1] & 0x2)
+
+    def _over(self, codes, first):
+        if self._referenced(first):
+            if first not in self.refs:
+                # the first sample seen after arming is the reference
+                self.refs[first] = codes[0].astype(np.int32)
+            codes = codes.astype(np.int32) - self.refs[first]
+        mask = np.zeros(len(codes), dtype=bool)
+        for axis, (thresh, enabled) in enumerate(self._thresholds(first)):
+            if enabled:
+                mask |= np.abs(codes[:, axis]) > thresh
+        return mask
+
+    def _advance(self):
+        now = self.clock()
+        if self.op_mode == 0 or now < self.busy_until:
+            self.started = None
+            return
+        if self.started is None:
+            self.started = now
+            self.generated = 0
+            self.refs.clear()
+            return
+
+        odr = self.odr_hz
+        due = int((now - self.started) * odr)
+        n = due - self.generated
+        if n <= 0:
+            return
+        # nothing older than a full FIFO could still be observed
+        skipped = max(n - FIFO_MAX_ENTRIES, 0)
+        t = np.arange(self.generated + skipped, due, dtype=np.float64) / odr
+        self.generated = due
+
+        g = np.asarray(self.waveform(t), dtype=np.float64).reshape(-1, 3)
+        codes = np.round(g / ADXL372_SCALEG) + self.trim * OFFSET_TRIM_LSB
+        codes = np.clip(codes, -2048, 2047).astype(np.int16)
+        self._samples(codes, skipped)
+
+    def _samples(self, codes, skipped):
+        self.latest[:] = codes[-1]
+        self.data_rdy = True
+        for axis in range(3):
+            i = np.argmax(np.abs(codes[:, axis]))
+            if abs(int(codes[i, axis])) > abs(int(self.peak[axis])):
+                self.peak[axis] = codes[i, axis]
+
+        active = self._over(codes, ADI_ADXL372_X_THRESH_ACT_H)
+        if active.any():
+            self.status2 |= STATUS2_ACT
+            self.awake = True
+        if self._over(codes, ADI_ADXL372_X_THRESH_ACT2_H).any():
+            self.status2 |= STATUS2_ACT2
+
+        # inactivity needs TIME_INACT periods with every enabled axis under
+        # the threshold, the periods are 26ms, or 13ms at 6400Hz. A loud
+        # sample restarts the timer, and referenced inactivity is measured
+        # from that sample onwards
+        first = ADI_ADXL372_X_THRESH_INACT_H
+        start = 0
+        while True:
+            loud = self._over(codes[start:], first)
+            if not loud.any():
+                break
+            start += len(loud) - np.argmax(loud[::-1])
+            self.quiet_samples = 0
+            if not self._referenced(first):
+                break
+            self.refs[first] = codes[start - 1].astype(np.int32)
+        self.quiet_samples += len(codes) - start
+        period = 0.013 if self.odr_hz == 6400 else 0.026
+        time_inact = (self.regs[ADI_ADXL372_TIME_INACT_H] << 8) | self.regs[ADI_ADXL372_TIME_INACT_L]
+        inact_enabled = any(en for _, en in self._thresholds(ADI_ADXL372_X_THRESH_INACT_H))
+        if inact_enabled and self.awake:
+            if self.quiet_samples >= max(time_inact, 1) * period * self.odr_hz:
+                self.status2 |= STATUS2_INACT
+                self.awake = False
+                # activity detection restarts from where the device settled
+                self.refs[ADI_ADXL372_X_THRESH_ACT_H] = codes[-1].astype(np.int32)
+
+        mode = self.fifo_mode
+        if mode == FIFOMode.BYPASSED:
+            return
+        if skipped:
+            self.overrun = True
+        self._fill_fifo(codes, active, mode)
+
+    def _fill_fifo(self, codes, active, mode):
+        cols = [AXIS_INDEX[axis] for axis in FIFO_FORMAT_AXES[self.fifo_format]]
+        words = (codes[:, cols].astype(np.int32) & 0xFFF) << 4
+        # the first axis of every set is flagged in bit 0
+        words[:, 0] |= 1
+        data = words.astype(">u2").tobytes()
+
+        set_bytes = len(cols) * 2
+        capacity = self.fifo_capacity * 2
+
+        if mode == FIFOMode.TRIGGERED and not self.triggered:
+            hit = np.argmax(active) if active.any() else len(active)
+            self.fifo += data[: hit * set_bytes]
+            # hold on to the watermark worth of samples before the trigger
+            keep = (self.watermark + 1) // len(cols) * set_bytes
+            if len(self.fifo) > keep:
+                del self.fifo[: len(self.fifo) - keep]
+            if hit == len(active):
+                return
+            self.triggered = True
+            data = data[hit * set_bytes :]
+
+        if mode == FIFOMode.STREAMED:
+            self.fifo += data
+            if len(self.fifo) > capacity:
+                del self.fifo[: len(self.fifo) - capacity]
+                self.overrun = True
+        else:
+            room = capacity - len(self.fifo)
+            if len(data) > room:
+                self.overrun = True
+            self.fifo += data[: max(room, 0)]
+
+    def _flags(self) -> int:
+        flags = 0
+        if self.data_rdy:
+            flags |= DATA_RDY
+        if self.fifo_mode != FIFOMode.BYPASSED and self.fifo_entries > self.watermark:
+            flags |= FIFO_RDY
+        if self.fifo_entries >= self.fifo_capacity:
+            flags |= FIFO_FULL
+        if self.overrun:
+            flags |= FIFO_OVR
+        if self.awake:
+            flags |= AWAKE
+        return flags
+
+    def _interrupts(self):
+        # the STATUS_1/STATUS_2 bits line up with the INTx_MAP bits
+        flags = self._flags() | (self.status2 & (STATUS2_INACT | STATUS2_ACT))
+        for pin, reg in ((1, ADI_ADXL372_INT1_MAP), (2, ADI_ADXL372_INT2_MAP)):
+            level = bool(flags & self.regs[reg] & (INT_MAP_LOW ^ 0xFF))
+            if level and not self.int_level[pin] and self.gpio[pin] is not None:
+                self.gpio[pin].trigger(self.clock())
+            self.int_level[pin] = level
+
+    def _read_reg(self, reg) -> int:
+        if reg == ADI_ADXL372_STATUS_1:
+            val = self._flags()
+            self.overrun = False
+            return val
+        if reg == ADI_ADXL372_STATUS_2:
+            val, self.status2 = self.status2, 0
+            return val
+        if reg == ADI_ADXL372_FIFO_ENTRIES_2:
+            return (self.fifo_entries >> 8) & 0x3
+        if reg == ADI_ADXL372_FIFO_ENTRIES_1:
+            return self.fifo_entries & 0xFF
+        if ADI_ADXL372_X_DATA_H <= reg <= ADI_ADXL372_Z_DATA_L:
+            self.data_rdy = False
+            word = (int(self.latest[(reg - ADI_ADXL372_X_DATA_H) // 2]) & 0xFFF) << 4
+            return word >> 8 if reg % 2 == 0 else word & 0xFF
+        if ADI_ADXL372_X_MAXPEAK_H <= reg <= ADI_ADXL372_Z_MAXPEAK_L:
+            offset = reg - ADI_ADXL372_X_MAXPEAK_H
+            word = (int(self.peak[offset // 2]) & 0xFFF) << 4
+            if reg == ADI_ADXL372_Z_MAXPEAK_L:
+                self.peak[:] = 0
+            return word >> 8 if offset % 2 == 0 else word & 0xFF
+        if reg == ADI_ADXL372_SELF_TEST and self.self_test_started is not None:
+            if self.clock() - self.self_test_started >= self.self_test_time:
+                # ST_DONE and USER_ST, the part always passes
+                self.regs[reg] = 0x06
+                self.self_test_started = None
+        return self.regs[reg] if reg < len(self.regs) else 0
+
+    def _read(self, reg, nbytes) -> bytes:
+        if self.clock() < self.busy_until:
+            return bytes([USER_NVM_BUSY if reg == ADI_ADXL372_STATUS_1 else 0]) + bytes(nbytes - 1)
+        if reg == ADI_ADXL372_FIFO_DATA:
+            # FIFO_DATA doesn't auto-increment, every byte pops the queue
+            out = bytes(self.fifo[:nbytes])
+            del self.fifo[:nbytes]
+            return out + bytes(nbytes - len(out))
+        return bytes(self._read_reg(reg + i) for i in range(nbytes))
+
+    def _write(self, reg, data):
+        if self.clock() < self.busy_until:
+            return
+        for i, val in enumerate(data):
+            r = reg + i
+            if r == ADI_ADXL372_SRESET:
+                if val == 0x52:
+                    gpio = self.gpio
+                    self._reset()
+                    self.gpio = gpio
+                    self.busy_until = self.clock() + self.reset_time
+                return
+            if r < ADI_ADXL372_OFFSET_X or r > ADI_ADXL372_SELF_TEST:
+                continue
+            restart = r in (ADI_ADXL372_TIMING, ADI_ADXL372_POWER_CTL) and self.regs[r] != val
+            self.regs[r] = val
+            if restart:
+                # the sample clock starts over when the rate or mode changes
+                self.started = self.clock() if self.op_mode else None
+                self.generated = 0
+                self.refs.clear()
+            for first in THRESHOLDS:
+                if first <= r < first + 6:
+                    # rewriting the thresholds re-arms detection with a new reference
+                    self.refs.pop(first, None)
+            if r in (ADI_ADXL372_FIFO_CTL, ADI_ADXL372_FIFO_SAMPLES):
+                # reconfiguring the FIFO empties it
+                self.fifo.clear()
+                self.triggered = False
+            if r == ADI_ADXL372_SELF_TEST and val & 1:
+                self.self_test_started = self.clock()
+
+    def xfer(self, data: list) -> list:
+        with self.lock:
+            self.transactions += 1
+            self.bytes += len(data)
+            self._advance()
+            cmd, reg = data[0], data[0] >> 1
+            if cmd & ADXL_SPI_RNW:
+                out = [0] + list(self._read(reg, len(data) - 1))
+            else:
+                self._write(reg, data[1:])
+                out = [0] * len(data)
+            self._interrupts()
+        self._delay(len(data))
+        return out
+
+    def readinto(self, cmd: int, buf, nbytes: int):
+        check_read(buf, nbytes)
+        with self.lock:
+            self.transactions += 1
+            self.bytes += nbytes + 1
+            self._advance()
+            memoryview(buf).cast("B")[:nbytes] = self._read(cmd >> 1, nbytes)
+            self._interrupts()
+        self._delay(nbytes + 1)
+
+    def _delay(self, nbytes):
+        delay = self.latency
+        if self.speed_hz:
+            delay += 8 * nbytes / self.speed_hz
+        if delay > 0:
+            sleep(delay)
@@ -0,0 +1,202 @@
+import ctypes
+import fcntl
+
+from time import perf_counter
+
+
+# struct spi_ioc_transfer from include/uapi/linux/spi/spidev.h
+class SpiIocTransfer(ctypes.Structure):
+    _fields_ = [
+        ("tx_buf", ctypes.c_uint64),
+        ("rx_buf", ctypes.c_uint64),
+        ("len", ctypes.c_uint32),
+        ("speed_hz", ctypes.c_uint32),
+        ("delay_usecs", ctypes.c_uint16),
+        ("bits_per_word", ctypes.c_uint8),
+        ("cs_change", ctypes.c_uint8),
+        ("tx_nbits", ctypes.c_uint8),
+        ("rx_nbits", ctypes.c_uint8),
+        ("word_delay_usecs", ctypes.c_uint8),
+        ("pad", ctypes.c_uint8),
+    ]
+
+
+def check_read(buf, nbytes: int) -> int:
+    """
+    Raise ValueError unless nbytes fit in buf, before anything is clocked
+    into it. Returns the size of buf in bytes
+    """
+    size = memoryview(buf).nbytes
+    if nbytes > size:
+        raise ValueError("can't read %d bytes into a %d byte buffer" % (nbytes, size))
+    return size
+
+
+def SPI_IOC_MESSAGE(n):
+    # _IOW('k', 0, char[n * sizeof(struct spi_ioc_transfer)])
+    return (1 << 30) | ((n * ctypes.sizeof(SpiIocTransfer)) << 16) | (ord("k") << 8)
+
+
+class SpiIoc:
+    """
+    Register reads straight into caller owned buffers through the spidev
+    SPI_IOC_MESSAGE ioctl. A read is one message of two transfers with chip
+    select held between them: the command byte goes out of a preallocated
+    buffer, then the reply is clocked directly into the caller's buffer.
+    Nothing is converted to or from Python lists and the transfer structs
+    are reused between calls. Buffers the driver reads into on every
+    transfer are registered once and keep their ctypes view, any other
+    buffer gets one for the length of the ioctl only, so it can still be
+    resized afterwards
+
+    fd: File descriptor of an open spidev device, SpiDev.fileno()
+    speed_hz: Clock rate for the transfers
+    """
+
+    def __init__(self, fd: int, speed_hz: int):
+        self.fd = fd
+        self._request = SPI_IOC_MESSAGE(2)
+        self._cmd = ctypes.c_uint8()
+        self._xfers = (SpiIocTransfer * 2)()
+        self._xfers[0].tx_buf = ctypes.addressof(self._cmd)
+        self._xfers[0].len = 1
+        self._xfers[0].speed_hz = speed_hz
+        self._xfers[1].speed_hz = speed_hz
+        # id of each registered buffer to the buffer, its address, size and
+        # ctypes view
+        self._views = {}
+
+    def register_buffer(self, buf):
+        """
+        Keep a ctypes view of buf for later reads. buf stays exported, so it
+        can't be resized, and is held until the SpiIoc goes away
+        """
+        size = memoryview(buf).nbytes
+        view = (ctypes.c_char * size).from_buffer(buf)
+        self._views[id(buf)] = (buf, ctypes.addressof(view), size, view)
+
+    def readinto(self, cmd: int, buf, nbytes: int):
+        """
+        Send cmd and read nbytes of the reply into the start of buf, which
+        must be a writable contiguous buffer of at least nbytes. The kernel
+        writes wherever rx_buf points, so a short buffer raises ValueError
+        """
+        registered = self._views.get(id(buf))
+        if registered is not None and registered[0] is buf:
+            if nbytes > registered[2]:
+                raise ValueError("can't read %d bytes into a %d byte buffer" % (nbytes, registered[2]))
+            self._cmd.value = cmd
+            self._xfers[1].len = nbytes
+            self._xfers[1].rx_buf = registered[1]
+            fcntl.ioctl(self.fd, self._request, self._xfers)
+            return
+        size = check_read(buf, nbytes)
+        self._cmd.value = cmd
+        self._xfers[1].len = nbytes
+        # the view pins buf's address, let it go as soon as the read is done
+        view = (ctypes.c_char * size).from_buffer(buf)
+        try:
+            self._xfers[1].rx_buf = ctypes.addressof(view)
+            fcntl.ioctl(self.fd, self._request, self._xfers)
+        finally:
+            del view
+
+
+class Transport:
+    """
+    The bus as the driver sees it. A transport only has to implement xfer,
+    a full duplex transfer of a list of bytes that returns the bytes clocked
+    back. readinto has a generic fallback on top of xfer, transports that
+    can read straight into a buffer should override it
+    """
+
+    def xfer(self, data: list) -> list:
+        raise NotImplementedError
+
+    def readinto(self, cmd: int, buf, nbytes: int):
+        """
+        Send cmd and read nbytes of the reply into the start of buf. Raises
+        ValueError if buf is shorter than nbytes
+        """
+        check_read(buf, nbytes)
+        data = self.xfer([cmd] + [0x00] * nbytes)
+        memoryview(buf).cast("B")[:nbytes] = bytes(data[1:])
+
+    def register_buffer(self, buf):
+        """
+        Called once for each buffer the driver reads into on every transfer,
+        so a transport can set up per buffer state ahead of time
+        """
+
+    def close(self):
+        pass
+
+
+class SpidevTransport(Transport):
+    """
+    A real device on /dev/spidev<major>.<minor>. Register reads into
+    buffers go through SpiIoc so they skip the list conversions spidev does
+
+    major: SPI bus number
+    minor: Chip select on that bus
+    speed_hz: SPI clock rate
+    """
+
+    def __init__(self, major: int, minor: int, speed_hz: int = 10 ** 7):
+        import spidev
+
+        self.spi = spidev.SpiDev(major, minor)
+        self.spi.max_speed_hz = speed_hz
+        self.ioc = SpiIoc(self.spi.fileno(), speed_hz)
+
+    def xfer(self, data: list) -> list:
+        return self.spi.xfer(data)
+
+    def readinto(self, cmd: int, buf, nbytes: int):
+        self.ioc.readinto(cmd, buf, nbytes)
+
+    def register_buffer(self, buf):
+        self.ioc.register_buffer(buf)
+
+    def close(self):
+        self.spi.close()
+
+
+class CountingTransport(Transport):
+    """
+    Wraps another transport and counts the transactions, bytes and time
+    spent on the bus. Used by bench.py and as the base of
+    metrics.InstrumentedTransport, works with real or simulated devices
+    """
+
+    def __init__(self, transport: Transport):
+        self.transport = transport
+        self.reset_counts()
+
+    def reset_counts(self):
+        self.transactions = 0
+        self.bytes = 0
+        self.bus_time = 0.0
+
+    def _count(self, cmd: int, nbytes: int, seconds: float):
+        # every transfer goes through here, subclasses extend it
+        self.bus_time += seconds
+        self.transactions += 1
+        self.bytes += nbytes
+
+    def xfer(self, data: list) -> list:
+        start = perf_counter()
+        out = self.transport.xfer(data)
+        self._count(data[0], len(data), perf_counter() - start)
+        return out
+
+    def readinto(self, cmd: int, buf, nbytes: int):
+        start = perf_counter()
+        self.transport.readinto(cmd, buf, nbytes)
+        self._count(cmd, nbytes + 1, perf_counter() - start)
+
+    def register_buffer(self, buf):
+        self.transport.register_buffer(buf)
+
+    def close(self):
+        self.transport.close()
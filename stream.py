@@ -0,0 +1,312 @@
+import threading
+import numpy as np
+
+from collections import deque
+
+from adxl372 import ODR_HZ, FIFO_FORMAT_AXES, Interrupt, SampleBatch
+from defs import FIFO_MAX_ENTRIES
+from timebase import Timebase
+
+
+class RingBuffer:
+    """
+    Preallocated ring buffer of decoded samples and their timestamps for a
+    single writer and any number of readers. Every sample is stored twice,
+    at i and at i + capacity, so any window of up to capacity samples is one
+    contiguous slice and can be handed out as a view without copying. The
+    writer only advances head once the data is in place, so readers never
+    need a lock. A view is only valid until the writer laps it, readers that
+    fall more than capacity samples behind should check lapped(). Once the
+    writer closes the ring, readers stop after the last of the data
+    """
+
+    def __init__(self, capacity: int, axes: int = 3):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.axes = axes
+        self.data = np.zeros((2 * capacity, axes), dtype=np.int16)
+        self.timestamps = np.zeros(2 * capacity, dtype=np.float64)
+        # total number of samples ever written, never wraps
+        self.head = 0
+        self.closed = False
+        self._new_data = threading.Condition()
+
+    def _put(self, arr, start, values):
+        end = start + len(values)
+        arr[start:end] = values
+        if end <= self.capacity:
+            arr[start + self.capacity : end + self.capacity] = values
+        else:
+            # the part past capacity already landed in the mirror half
+            split = self.capacity - start
+            arr[start + self.capacity :] = values[:split]
+            arr[: end - self.capacity] = values[split:]
+
+    def write(self, samples: np.ndarray, timestamps: np.ndarray):
+        """
+        Append a batch of samples. Only the newest capacity samples of an
+        oversized batch are kept, but head still advances past all of them
+
+        samples: (N, axes) int16 array
+        timestamps: (N,) array of sample times in seconds
+        """
+        n = len(samples)
+        if n == 0:
+            return
+        skipped = max(n - self.capacity, 0)
+        start = (self.head + skipped) % self.capacity
+
+        self._put(self.data, start, samples[skipped:])
+        self._put(self.timestamps, start, timestamps[skipped:])
+
+        with self._new_data:
+            self.head += n
+            self._new_data.notify_all()
+
+    @property
+    def oldest(self) -> int:
+        """
+        Number of the oldest sample that is safe to read
+        """
+        return self.head - self.capacity
+
+    def window(self, start: int, end: int):
+        """
+        Return views over the samples numbered start up to end, where the
+        numbering is the same as head. The range must be within the last
+        capacity samples
+        """
+        if end - start > self.capacity or start < self.oldest:
+            raise IndexError("range is no longer held in the ring buffer")
+        offset = start % self.capacity
+        n = end - start
+        return (
+            self.data[offset : offset + n],
+            self.timestamps[offset : offset + n],
+        )
+
+    def latest(self, n: int):
+        """
+        Return (samples, timestamps) views over the newest n samples, or
+        fewer if not that many have been written yet
+        """
+        head = self.head
+        n = min(n, head, self.capacity)
+        return self.window(head - n, head)
+
+    def lapped(self, position: int) -> bool:
+        """
+        True if the sample numbered position has been overwritten
+        """
+        return position < self.oldest
+
+    def wait(self, position: int, timeout: float = None) -> bool:
+        """
+        Block until head moves past position. Returns False on timeout, or
+        if the ring is closed with nothing past position
+        """
+        with self._new_data:
+            self._new_data.wait_for(lambda: self.head > position or self.closed, timeout)
+            return self.head > position
+
+    def reader(self, timeout: float = None):
+        """
+        Return a RingReader starting at the current head
+        """
+        return RingReader(self, self.head, timeout)
+
+    def close(self):
+        """
+        Mark the ring as finished and wake any waiting readers, called when
+        the stream writing it stops
+        """
+        with self._new_data:
+            self.closed = True
+            self._new_data.notify_all()
+
+
+class RingReader:
+    """
+    Iterator over a RingBuffer yielding (samples, timestamps) views of each
+    new run of data. If the reader falls more than capacity samples behind
+    it skips ahead to the oldest data still held and counts the samples it
+    missed in lost. Iteration stops once the ring is closed and read to the
+    end, or once timeout passes without new data, never if timeout is None
+    """
+
+    def __init__(self, ring: RingBuffer, position: int = 0, timeout: float = None):
+        self.ring = ring
+        self.position = position
+        self.timeout = timeout
+        self.lost = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        ring = self.ring
+        if not ring.wait(self.position, self.timeout):
+            raise StopIteration
+
+        while True:
+            head = ring.head
+            oldest = ring.oldest
+            if self.position < oldest:
+                self.lost += oldest - self.position
+                self.position = oldest
+            try:
+                window = ring.window(self.position, head)
+            except IndexError:
+                # a writer in another process started on the oldest samples
+                # between reading head and the window, look again
+                continue
+            self.position = head
+            return window
+
+
+def split_gaps(reader: RingReader, gaps, axes):
+    """
+    Generator of SampleBatch views of what reader returns, split wherever
+    gaps, an iterable of (ring position, dropped, overrun), says samples
+    were lost. The batch after a gap carries its dropped count, and the
+    samples reader missed by being lapped are added to the next batch
+    """
+    lost = 0
+    for samples, timestamps in reader:
+        end = reader.position
+        start = end - len(samples)
+        # a reader that got lapped missed samples too
+        dropped, overrun, lost = reader.lost - lost, False, reader.lost
+        cut = 0
+        for position, gap, gap_overrun in tuple(gaps):
+            if not start <= position < end:
+                continue
+            if position > start + cut:
+                i = position - start
+                yield SampleBatch(samples[cut:i], timestamps[cut:i], axes, dropped, overrun)
+                cut, dropped, overrun = i, 0, False
+            dropped += gap
+            overrun = overrun or gap_overrun
+        yield SampleBatch(samples[cut:], timestamps[cut:], axes, dropped, overrun)
+
+
+class Stream:
+    """
+    Background acquisition engine. A dedicated thread owns the bus, drains
+    the FIFO whenever the watermark should have been reached and writes the
+    decoded samples into a RingBuffer. If FIFO_RDY is mapped to an attached
+    interrupt line the thread sleeps on the watermark edge, otherwise it
+    wakes on a timer. Sample times come from a Timebase, which keeps them
+    evenly spaced at the sample period and locked to the host clock through
+    the watermark edges, and which notices samples lost to overruns or
+    stalls. Consumers read SampleBatch views through latest(n) or by
+    iterating, neither of which touches the bus or blocks the acquisition
+    thread. Iterating never joins data across a gap, a batch is split there
+    and the part after it carries the dropped count. Iteration ends once the
+    stream stops and the data left is read, re-raising the exception that
+    killed the acquisition thread if there was one. With a
+    WatermarkTuner each drain is reported to it and the wake interval
+    follows the watermark it picks. The ring can be passed in, such as a
+    shm.SharedRing that other processes read
+    """
+
+    def __init__(self, dev, capacity: int = 1 << 16, tuner=None, ring: RingBuffer = None):
+        self.dev = dev
+        self.tuner = tuner
+        self.axes = FIFO_FORMAT_AXES[dev.fifo_format]
+        self.ring = ring if ring is not None else RingBuffer(capacity, len(self.axes))
+        self.timebase = Timebase(ODR_HZ[dev.odr])
+        # (ring position, dropped, overrun) of the most recent gaps, a
+        # shared ring keeps them where other processes can see them
+        self.gaps = getattr(self.ring, "gaps", None)
+        if self.gaps is None:
+            self.gaps = deque(maxlen=1024)
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """
+        Stop the acquisition thread and wait for it to exit. An exception
+        raised on the acquisition thread is re-raised here
+        """
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        self.ring.close()
+        if self.error is not None:
+            raise self.error
+
+    @property
+    def running(self) -> bool:
+        return self._thread.is_alive()
+
+    def latest(self, n: int) -> SampleBatch:
+        """
+        Returns a SampleBatch view of the newest n samples
+        """
+        return SampleBatch(*self.ring.latest(n), self.axes)
+
+    @property
+    def dropped(self) -> int:
+        """
+        Samples estimated lost to overruns and stalls since the stream started
+        """
+        return self.timebase.dropped
+
+    @property
+    def overruns(self) -> int:
+        return self.timebase.overruns
+
+    def __iter__(self):
+        reader = self.ring.reader()
+        lost = 0
+        for batch in split_gaps(reader, self.gaps, self.axes):
+            if reader.lost != lost and self.dev.metrics is not None:
+                self.dev.metrics.lap(reader.lost - lost)
+            lost = reader.lost
+            yield batch
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        dev = self.dev
+        period = 1.0 / ODR_HZ[dev.odr]
+        set_size = len(FIFO_FORMAT_AXES[dev.fifo_format])
+        # wake at half the watermark so the FIFO never gets close to full
+        interval = max(dev.fifo_sets, 1) * period / 2
+        gpio = dev.interrupt_gpio(Interrupt.FIFO_RDY)
+
+        # everything the loop touches is allocated up front
+        max_sets = FIFO_MAX_ENTRIES // set_size
+        samples = np.empty((max_sets, set_size), dtype=np.int16)
+        timestamps = np.empty(max_sets, dtype=np.float64)
+        timebase = self.timebase
+        edge = None
+
+        try:
+            while not self._stop.is_set():
+                batch, _, dropped, overrun = timebase.drain(dev, samples, timestamps, edge)
+                n = len(batch)
+                if n:
+                    if dropped or overrun:
+                        self.gaps.append((self.ring.head, dropped, overrun))
+                    self.ring.write(batch, timestamps[:n])
+                    if self.tuner is not None and self.tuner.observe(n, dev.fifo_status):
+                        interval = max(dev.fifo_sets, 1) * period / 2
+                        # going through standby emptied the FIFO, that's not data loss
+                        timebase.restart()
+                if gpio is not None:
+                    # time out now and then to notice stop() and missed edges
+                    edge = gpio.wait(8 * interval)
+                else:
+                    self._stop.wait(interval)
+        except Exception as e:
+            self.error = e
+        finally:
+            # readers finish what is left and stop
+            self.ring.close()
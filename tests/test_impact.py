@@ -0,0 +1,19 @@
+from adxl372 import ADXL372, Interrupt
+from defs import ADI_ADXL372_INT1_MAP, INT_MAP_LOW
+from impact import ImpactMonitor
+from sim import SimulatedADXL372
+
+
+def test_arm_keeps_pin_polarity():
+    dev = ADXL372(transport=SimulatedADXL372())
+    dev.map_interrupts(1, Interrupt.DATA_RDY, active_low=True)
+    ImpactMonitor(dev, threshold_mg=20000).arm()
+    assert dev.int_active_low[1]
+    assert dev.read(ADI_ADXL372_INT1_MAP) & INT_MAP_LOW
+    assert dev.int_map[1] == Interrupt.DATA_RDY | Interrupt.ACT
+
+
+def test_arm_sets_requested_polarity():
+    dev = ADXL372(transport=SimulatedADXL372())
+    ImpactMonitor(dev, threshold_mg=20000, active_low=True).arm()
+    assert dev.read(ADI_ADXL372_INT1_MAP) & INT_MAP_LOW
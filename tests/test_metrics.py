@@ -0,0 +1,18 @@
+from adxl372 import ADXL372, OP_MODES
+from metrics import InstrumentedTransport
+from sim import SimulatedADXL372
+
+
+def test_transport_counts_match_metrics():
+    dev = ADXL372(transport=SimulatedADXL372())
+    metrics = dev.enable_metrics()
+    dev.set_op_mode(OP_MODES.FULL_BW_MEASUREMENT)
+    dev.snapshot()
+    dev.get_status()
+
+    bus = dev.dev
+    assert isinstance(bus, InstrumentedTransport)
+    snap = metrics.snapshot()
+    assert bus.transactions == snap["transactions"] > 0
+    assert bus.bytes == snap["bytes"]
+    assert bus.bus_time == metrics.transfer_seconds.sum > 0
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from adxl372 import ADXL372, ODR, OP_MODES, ActivityMode
+from defs import (
+    ADI_ADXL372_X_THRESH_ACT_H,
+    ADI_ADXL372_X_THRESH_INACT_H,
+    AWAKE,
+    STATUS2_ACT,
+    STATUS2_INACT,
+)
+from sim import SimulatedADXL372
+
+
+def shake(t):
+    # 1g of gravity on z, with 3g of shaking on x from 0.5s to 1s
+    g = np.zeros((len(t), 3))
+    g[:, 2] = 1.0
+    g[:, 0] = np.where((t >= 0.5) & (t < 1.0), 3.0 * np.sin(2 * np.pi * 50 * t), 0.0)
+    return g
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def monitor(referenced):
+    clock = Clock()
+    dev = ADXL372(transport=SimulatedADXL372(shake, clock=clock))
+    with dev.configure():
+        dev.set_op_mode(OP_MODES.STAND_BY)
+        dev.set_ODR(ODR.ODR_400Hz)
+        dev.set_activity_threshold(1500, referenced, True, ADI_ADXL372_X_THRESH_ACT_H)
+        dev.set_activity_threshold(500, referenced, True, ADI_ADXL372_X_THRESH_INACT_H)
+        dev.set_inactivity_time(104)
+        dev.set_activity_processing_mode(ActivityMode.LOOPED)
+        dev.set_op_mode(OP_MODES.FULL_BW_MEASUREMENT)
+    return dev, clock
+
+
+def run_until(dev, clock, end):
+    # touch the bus every 10ms of simulated time
+    status = 0
+    while clock.now < end:
+        clock.now += 0.01
+        dev.get_status()
+        status |= dev.get_activity_status()
+    return status, dev.get_status()
+
+
+def test_referenced_activity_and_inactivity():
+    dev, clock = monitor(referenced=True)
+    status, status1 = run_until(dev, clock, 0.4)
+    # gravity alone is 10 codes, over the 5 code inactivity threshold, but
+    # referenced detection only sees changes
+    assert not status & STATUS2_ACT
+    assert not status1 & AWAKE
+
+    status, status1 = run_until(dev, clock, 0.9)
+    assert status & STATUS2_ACT
+    assert status1 & AWAKE
+
+    status, status1 = run_until(dev, clock, 1.5)
+    assert status & STATUS2_INACT
+    assert not status1 & AWAKE
+
+
+def test_absolute_inactivity_sees_gravity():
+    dev, clock = monitor(referenced=False)
+    run_until(dev, clock, 0.9)
+    status, status1 = run_until(dev, clock, 1.5)
+    assert not status & STATUS2_INACT
+    assert status1 & AWAKE
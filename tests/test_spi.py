@@ -0,0 +1,65 @@
+import pytest
+
+import spi
+from adxl372 import ADXL372
+from defs import ADI_ADXL372_STATUS_1
+from sim import SimulatedADXL372
+
+
+@pytest.fixture
+def ioctls(monkeypatch):
+    calls = []
+    monkeypatch.setattr(spi.fcntl, "ioctl", lambda fd, request, xfers: calls.append(xfers[1].len))
+    return calls
+
+
+def test_ioc_reads_fit(ioctls):
+    ioc = spi.SpiIoc(0, 10 ** 6)
+    buf = bytearray(4)
+    ioc.readinto(0x01, buf, 4)
+    assert ioctls == [4]
+
+
+def test_ioc_rejects_short_buffer(ioctls):
+    ioc = spi.SpiIoc(0, 10 ** 6)
+    with pytest.raises(ValueError):
+        ioc.readinto(0x01, bytearray(4), 5)
+    assert ioctls == []
+
+
+def test_ioc_rejects_short_registered_buffer(ioctls):
+    ioc = spi.SpiIoc(0, 10 ** 6)
+    buf = bytearray(4)
+    ioc.register_buffer(buf)
+    with pytest.raises(ValueError):
+        ioc.readinto(0x01, buf, 1024)
+    assert ioctls == []
+
+
+def test_ioc_releases_caller_buffer(ioctls):
+    ioc = spi.SpiIoc(0, 10 ** 6)
+    buf = bytearray(16)
+    ioc.readinto(0x01, buf, 16)
+    # no view may be left on caller memory
+    del buf[:]
+
+
+def test_fallback_rejects_short_buffer():
+    class Bus(spi.Transport):
+        sent = []
+
+        def xfer(self, data):
+            self.sent.append(data)
+            return [0] * len(data)
+
+    bus = Bus()
+    with pytest.raises(ValueError):
+        bus.readinto(0x01, bytearray(2), 3)
+    assert bus.sent == []
+
+
+def test_device_rejects_short_buffer():
+    dev = ADXL372(transport=SimulatedADXL372())
+    with pytest.raises(ValueError):
+        dev.readinto(ADI_ADXL372_STATUS_1, bytearray(2), 4)
+    assert dev.readinto(ADI_ADXL372_STATUS_1, bytearray(4), 2) == 2
@@ -0,0 +1,225 @@
+import numpy as np
+
+from time import monotonic
+
+from adxl372 import FIFO_FORMAT_AXES
+from defs import FIFO_OVR
+
+
+class Timebase:
+    """
+    Sample clock for FIFO data. Every sample set drained gets an index and
+    is timed at a fixed period from an anchor sample, so timestamps within
+    and across batches are spaced exactly by the sample period instead of
+    jittering with the drain. The anchor and period start from the nominal
+    ODR and are pulled toward the host monotonic clock at each drain. The
+    period is measured between the earliest looking reference of the
+    first second of the timeline and of each second after, so the latency
+    of single drains doesn't bend it. The watermark interrupt time is the best reference, the kernel stamps it
+    when the FIFO reaches the watermark, so it marks when a known sample
+    was taken. Without one the drain time is used, which can only be later
+    than the newest sample drained, so an error that way is taken out
+    faster than the other way. Corrections never move
+    samples already handed out or step the timeline: the batch starts one
+    period after the last sample and the error is worked off by adjusting
+    the period, within tolerance of the nominal, until the next drain.
+
+    Gaps are found by comparing the newest sample drained against the
+    number of samples the host clock says should exist by now. A gap is
+    declared if FIFO_OVR is set or the difference is more than slack, and
+    the index skips ahead by the estimated number of dropped samples and
+    the timeline restarts from the host clock, the only time it jumps
+
+    rate: Nominal sample rate in Hz, ODR_HZ[dev.odr]
+    tolerance: Largest relative error of the sample clock accepted
+    slack: Seconds the host clock can run ahead of the FIFO before the
+    difference is treated as lost samples
+    """
+
+    EDGE_GAIN = 0.2
+    DRAIN_GAIN = 0.01
+    LATE_GAIN = 0.1
+    # seconds of samples each reference for measuring the period is picked from
+    RATE_WINDOW = 1.0
+
+    def __init__(self, rate: float, tolerance: float = 0.02, slack: float = 0.005):
+        self.nominal = 1.0 / rate
+        self.tolerance = tolerance
+        self.slack = max(slack, 4 * self.nominal)
+        self._steps = np.arange(0, dtype=np.float64)
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the timeline, the next batch starts a new one at index 0
+        """
+        # estimated sample period, and the one in use with the correction
+        # being worked off added
+        self.rate_period = self.nominal
+        self.period = self.nominal
+        self.anchor = 0
+        self.t_anchor = None
+        # index of the next sample set to be drained
+        self.index = 0
+        self.dropped = 0
+        self.overruns = 0
+        self._last_ref = 0
+        self._restart_rate()
+
+    def restart(self):
+        """
+        Start a new timeline from the next batch without counting the
+        samples in between as dropped, for when the FIFO was emptied on
+        purpose, such as by reconfiguring it. The index, the counts and the
+        measured period carry on
+        """
+        self.t_anchor = None
+        self.period = self.rate_period
+        self._restart_rate()
+
+    def _restart_rate(self):
+        # (index, time) of the earliest looking reference in the first
+        # window of the timeline, and so far in the current one
+        self._base = None
+        self._window = None
+        self._window_start = None
+
+    def time_of(self, index) -> float:
+        return self.t_anchor + (index - self.anchor) * self.period
+
+    def update(self, n: int, now: float, status: int = 0, behind: int = 0, edge=None):
+        """
+        Account for a drain of n sample sets and return (index, dropped,
+        overrun) for the batch: the index of its first sample, the samples
+        estimated lost just before it and whether the device reported an
+        overrun. Get the batch's timestamps with fill() afterwards
+
+        n: Sample sets in the batch
+        now: Host monotonic time taken right after the drain
+        status: STATUS_1 read with the drain, dev.fifo_status
+        behind: Sample sets that were in the FIFO but left for the next drain
+        edge: (time, sets) of the watermark edge if there was one since the
+        last drain, sets being the watermark
+        """
+        overrun = bool(status & FIFO_OVR)
+        if overrun:
+            self.overruns += 1
+        newest = now - behind * self.period
+
+        if self.t_anchor is None:
+            start = self.index
+            self.anchor, self.t_anchor = start + n - 1, newest
+            if edge is not None and n >= edge[1]:
+                self.anchor, self.t_anchor = start + edge[1] - 1, edge[0]
+            self._last_ref = self.anchor
+            self.index = start + n
+            return start, 0, overrun
+
+        start = self.index
+        # samples the host clock says were taken since the last drain but
+        # never arrived
+        missing = (newest - self.time_of(start + n - 1)) / self.period
+        dropped = 0
+        if overrun or missing * self.period > self.slack:
+            dropped = max(int(round(missing)), 0)
+        self.dropped += dropped
+        self.index = start + dropped + n
+
+        if dropped or overrun:
+            # the run of samples is broken, start the timeline again from
+            # the drain, never earlier than just after the last sample
+            last = self.time_of(start - 1)
+            start += dropped
+            self.period = self.rate_period
+            self.anchor = start + n - 1
+            self.t_anchor = max(newest, last + (dropped + n) * self.period)
+            self._last_ref = self.anchor
+            # the indices after a gap are estimates, measure the period afresh
+            self._restart_rate()
+            return start, dropped, overrun
+
+        if edge is not None and n >= edge[1]:
+            ref, t_ref, gain = start + edge[1] - 1, edge[0], self.EDGE_GAIN
+        else:
+            ref, t_ref = start + n - 1, newest
+            gain = self.LATE_GAIN if newest < self.time_of(ref) else self.DRAIN_GAIN
+        self._correct(start, ref, t_ref, gain)
+        return start, 0, False
+
+    def drain(self, dev, out, timestamps=None, edge: float = None, min_sets: int = 1, raw: bool = False):
+        """
+        Drain dev's FIFO and account for the batch as update() does, taking
+        the host time straight after the transfer and the samples left
+        behind from the FIFO level read with it. Samples found dropped are
+        also reported to dev.metrics. Returns (batch, index, dropped,
+        overrun), batch being the filled part of out
+
+        dev: ADXL372 to drain
+        out: int16 array of sample sets to decode into, as for
+        read_fifo_into, or with raw a writable buffer for the FIFO bytes
+        timestamps: Preallocated float64 array as long as out is in sample
+        sets, the batch's timestamps are written to its start. None skips them
+        edge: Time of the watermark edge if there was one since the last drain
+        min_sets: As in read_fifo_into
+        raw: Take the bytes with read_fifo_raw_into rather than decoding
+        """
+        set_size = len(FIFO_FORMAT_AXES[dev.fifo_format])
+        if raw:
+            batch = dev.read_fifo_raw_into(out, min_sets)
+            n = len(batch) // (set_size * 2)
+        else:
+            batch = dev.read_fifo_into(out, min_sets)
+            n = len(batch)
+        now = monotonic()
+        if not n:
+            return batch, self.index, 0, False
+
+        behind = max(dev.fifo_level - 1, 0) // set_size - n
+        if edge is not None:
+            edge = (edge, dev.fifo_sets)
+        index, dropped, overrun = self.update(n, now, dev.fifo_status, behind, edge)
+        if dropped and dev.metrics is not None:
+            dev.metrics.gap(dropped)
+        if timestamps is not None:
+            self.fill(index, timestamps[:n])
+        return batch, index, dropped, overrun
+
+    def _correct(self, start, ref, time, gain):
+        error = time - self.time_of(ref)
+        span = max(ref - self._last_ref, 1)
+        low, high = self.nominal * (1 - self.tolerance), self.nominal * (1 + self.tolerance)
+        self._measure_rate(ref, time, low, high)
+        # the batch carries on one period after the last sample, and the
+        # phase error is worked off over about as many samples as came since
+        # the last reference
+        self.t_anchor, self.anchor = self.time_of(start), start
+        self.period = min(max(self.rate_period + gain * error / span, low), high)
+        self._last_ref = ref
+
+    def _measure_rate(self, ref, time, low, high):
+        # the reference with the least latency in a window is the one that
+        # looks earliest against the nominal clock
+        if self._window is None or time - ref * self.nominal < self._window[1] - self._window[0] * self.nominal:
+            self._window = (ref, time)
+        if self._window_start is None:
+            self._window_start = ref
+        if (ref - self._window_start) * self.nominal < self.RATE_WINDOW:
+            return
+        if self._base is None:
+            self._base = self._window
+        else:
+            (base, t_base), (end, t_end) = self._base, self._window
+            self.rate_period = min(max((t_end - t_base) / (end - base), low), high)
+        self._window = None
+        self._window_start = ref
+
+    def fill(self, index: int, out: np.ndarray) -> np.ndarray:
+        """
+        Write the timestamps of the sample sets starting at index into out
+        """
+        n = len(out)
+        if len(self._steps) < n:
+            self._steps = np.arange(n, dtype=np.float64)
+        np.multiply(self._steps[:n], self.period, out=out)
+        out += self.time_of(index)
+        return out
@@ -0,0 +1,117 @@
+from adxl372 import ODR_HZ, FIFO_FORMAT_AXES
+from defs import FIFO_MAX_ENTRIES, FIFO_FULL, FIFO_OVR
+
+
+class WatermarkTuner:
+    """
+    Picks the FIFO watermark for a streaming device and keeps adjusting it
+    from what each drain finds. A low watermark keeps latency down but
+    costs more transfers per sample, a high one is cheaper on the bus but
+    leaves less headroom before the FIFO overruns. The tuner starts from
+    about 10ms worth of samples at the configured ODR and format. How late
+    drains run is tracked as the number of sets found past the watermark,
+    decaying peak hold, and the target is the largest watermark that keeps
+    twice that lateness inside the FIFO. The watermark moves to the target
+    in one step, and only once it is off by more than the hysteresis, so
+    jitter in the drains doesn't keep rewriting it. A drain that finds the
+    FIFO full, overrun or nearly so halves it straight away. The FIFO is
+    configured in standby, so each change empties it, and the stream starts
+    a new timeline after one rather than reporting a gap
+
+    dev: ADXL372 to tune, changes go through set_fifo_watermark
+    target_latency: Longest time in seconds a sample should wait in the
+    FIFO, or None to only be limited by the FIFO size
+    min_sets: Smallest watermark to use, in sample sets
+    max_sets: Largest watermark to use, defaults to the FIFO size
+    settle: Drains without trouble before the watermark is raised again
+    """
+
+    # fraction of the FIFO treated as an imminent overrun
+    HIGH_WATER = 0.85
+    # fraction of the watermark the target has to move by before it is applied
+    HYSTERESIS = 0.25
+    DECAY = 0.95
+
+    def __init__(
+        self,
+        dev,
+        target_latency: float = None,
+        min_sets: int = 4,
+        max_sets: int = None,
+        settle: int = 8,
+    ):
+        self.dev = dev
+        self.target_latency = target_latency
+        self.min_sets = min_sets
+        self.max_sets = max_sets
+        self.settle = settle
+        self.lateness = 0.0
+        self.calm = 0
+        # number of times the watermark was lowered because of an overrun
+        self.overruns = 0
+
+    @property
+    def capacity(self) -> int:
+        """
+        FIFO size in sample sets for the configured format
+        """
+        return FIFO_MAX_ENTRIES // len(FIFO_FORMAT_AXES[self.dev.fifo_format])
+
+    def ceiling(self) -> int:
+        """
+        The largest watermark allowed right now, the target the tuner moves to
+        """
+        odr = ODR_HZ[self.dev.odr]
+        ceiling = self.capacity - 1
+        if self.max_sets is not None:
+            ceiling = min(ceiling, self.max_sets)
+        if self.target_latency is not None:
+            ceiling = min(ceiling, int(self.target_latency * odr))
+        # room for the slowest recent drain twice over
+        ceiling = min(ceiling, int(self.capacity - 2 * self.lateness) - 1)
+        return max(ceiling, self.min_sets)
+
+    def initial(self) -> int:
+        """
+        Watermark to start streaming with, about 10ms of samples
+        """
+        sets = int(ODR_HZ[self.dev.odr] * 0.01)
+        return max(self.min_sets, min(sets, self.ceiling()))
+
+    def observe(self, sets: int, status: int) -> bool:
+        """
+        Feed the result of one drain. Returns True if the watermark was changed
+
+        sets: Sample sets the drain took from the FIFO
+        status: STATUS_1 read with the drain, dev.fifo_status
+        """
+        watermark = self.dev.fifo_sets
+        capacity = self.capacity
+        self.lateness = max(self.lateness * self.DECAY, float(sets - watermark))
+
+        if status & (FIFO_FULL | FIFO_OVR) or sets >= self.HIGH_WATER * capacity:
+            self.overruns += 1
+            if self.calm:
+                # whatever lateness caused this is at least what got through,
+                # the drains that follow are still clearing the same stall
+                self.lateness = max(self.lateness, capacity - watermark)
+            self.calm = 0
+            return self._apply(max(watermark // 2, self.min_sets))
+
+        target = self.ceiling()
+        if watermark > target:
+            # too little headroom, drop straight to the target
+            self.calm = 0
+            return self._apply(target)
+
+        self.calm += 1
+        if self.calm < self.settle or target <= watermark * (1 + self.HYSTERESIS):
+            return False
+        self.calm = 0
+        return self._apply(target)
+
+    def _apply(self, sets: int) -> bool:
+        if sets == self.dev.fifo_sets:
+            return False
+        self.dev.set_fifo_watermark(sets)
+        return True